@@ -0,0 +1,94 @@
+"""HTTP 压测脚本，对比开发服务器与 gunicorn gevent 模式的吞吐量和延迟
+
+用法:
+    python bench_http_load.py http://127.0.0.1:5007/online -c 50 -n 2000
+    python bench_http_load.py http://127.0.0.1:5003/webhook -c 50 -n 2000 --json payload.json
+"""
+import argparse
+import json
+import threading
+import time
+
+import requests
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_load(url, concurrency, total, method='GET', body=None, body_factory=None):
+    """用 concurrency 个线程发送 total 个请求，返回统计结果
+
+    body_factory(i) 返回第 i 个请求的 JSON 数据，优先于 body
+    """
+    latencies = []
+    statuses = {}
+    errors = 0
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        nonlocal errors
+        session = requests.Session()
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            payload = body_factory(index) if body_factory else body
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url, json=payload, timeout=30)
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if status is None:
+                    errors += 1
+                else:
+                    statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'url': url,
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'duration': round(duration, 3),
+        'rps': round(len(latencies) / duration, 1) if duration else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'statuses': statuses,
+        'errors': errors,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url')
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('--json', help='以 POST 方式发送该文件中的 JSON 数据')
+    args = parser.parse_args()
+
+    body = None
+    method = 'GET'
+    if args.json:
+        with open(args.json, 'r', encoding='utf-8') as f:
+            body = json.load(f)
+        method = 'POST'
+
+    print(json.dumps(run_load(args.url, args.concurrency, args.requests, method, body), ensure_ascii=False))
@@ -0,0 +1,58 @@
+"""对比每条消息新建连接与共享连接池的发送延迟
+
+用法: python bench_telegram_client.py -n 500
+"""
+import argparse
+import statistics
+import time
+
+import requests
+
+from telegram_client import TelegramClient
+from telegram_stub import start_stub
+
+
+def measure(send, count):
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        send(f"benchmark message {i}")
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<12} mean={statistics.mean(latencies) * 1000:.3f}ms "
+          f"p50={statistics.median(latencies) * 1000:.3f}ms p99={p99 * 1000:.3f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=500)
+    parser.add_argument('--api-base', help='使用已有的桩服务或 Bot API 地址')
+    args = parser.parse_args()
+
+    server = None
+    api_base = args.api_base
+    if not api_base:
+        server, api_base = start_stub()
+
+    token = 'BENCH'
+    url = f"{api_base}/bot{token}/sendMessage"
+
+    def bare_post(text):
+        requests.post(url, json={'chat_id': 1, 'text': text}).raise_for_status()
+
+    client = TelegramClient(token, api_base=api_base)
+
+    def pooled_post(text):
+        client.send_message(1, text).raise_for_status()
+
+    report('requests.post', measure(bare_post, args.count))
+    report('pooled', measure(pooled_post, args.count))
+
+    client.close()
+    if server:
+        server.shutdown()
@@ -0,0 +1,242 @@
+"""Prometheus 文本格式指标
+
+热路径上每个 OS 线程只写自己的分片，不需要加锁；/metrics 请求时再把所有分片相加。
+gevent 下同一线程中的协程共用一个分片: 协程只在阻塞调用处切换，计数过程中不会被打断。
+"""
+import bisect
+import threading
+import time
+
+try:
+    # gevent 打补丁后 threading.get_ident 返回协程 ID，分片需要按真正的线程区分
+    from gevent.monkey import get_original
+    _thread_ident = get_original('_thread', 'get_ident')
+except ImportError:
+    from _thread import get_ident as _thread_ident
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # 线程ID -> 该线程的分片；线程结束后ID可能被新线程复用，分片继续累加
+        self.shards = {}
+
+    def _values(self):
+        """当前线程的分片，首次使用时创建"""
+        shard = self.shards.get(_thread_ident())
+        if shard is None:
+            with self.lock:
+                shard = self.shards.setdefault(_thread_ident(), {})
+        return shard
+
+    def _merge(self, total, value):
+        return value if total is None else total + value
+
+    def _snapshot(self):
+        totals = {}
+        with self.lock:
+            shards = list(self.shards.values())
+        for shard in shards:
+            for key, value in list(shard.items()):
+                totals[key] = self._merge(totals.get(key), self._copy(value))
+        return totals
+
+    def _copy(self, value):
+        return value
+
+    def _label_key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+        return tuple(str(value) for value in labels)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._render_samples(self._snapshot()))
+        return lines
+
+    def _render_samples(self, totals):
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in sorted(totals.items())]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        values = self._values()
+        key = self._label_key(labels)
+        values[key] = values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """只支持 inc/dec 的计量值，适合统计进行中的请求数"""
+    metric_type = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        values = self._values()
+        key = self._label_key(labels)
+        values[key] = values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class CallbackGauge(_Metric):
+    """采集时调用 func 获取数值，func 返回数字或 {标签值元组: 数字}"""
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+
+    def _snapshot(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return {self._label_key(key if isinstance(key, tuple) else (key,)): item
+                    for key, item in value.items()}
+        return {(): value}
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        values = self._values()
+        key = self._label_key(labels)
+        data = values.get(key)
+        if data is None:
+            # 各桶计数(最后一个为 +Inf)、总和
+            data = [0] * (len(self.buckets) + 1) + [0.0]
+            values[key] = data
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def _copy(self, value):
+        return list(value)
+
+    def _merge(self, total, value):
+        if total is None:
+            return value
+        return [a + b for a, b in zip(total, value)]
+
+    def _render_samples(self, totals):
+        lines = []
+        for key, data in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), data[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {data[-1]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def callback_gauge(self, name, documentation, func, labelnames=()):
+        return self._register(CallbackGauge(name, documentation, func, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# 采集 {metric.name} 失败: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+# 进程内默认的指标注册表
+REGISTRY = MetricsRegistry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def install_flask_metrics(app, registry=REGISTRY, prefix='app'):
+    """为 Flask 应用添加 /metrics 路由和进行中请求数统计"""
+    from flask import Response, request
+
+    in_flight = registry.gauge(f"{prefix}_http_requests_in_flight", "正在处理的 HTTP 请求数", ('endpoint',))
+    requests_total = registry.counter(f"{prefix}_http_requests_total", "HTTP 请求数", ('endpoint', 'status'))
+
+    @app.before_request
+    def _track_start():
+        if request.endpoint != 'metrics':
+            in_flight.inc(request.endpoint or 'unknown')
+
+    @app.teardown_request
+    def _track_end(exc):
+        if request.endpoint != 'metrics':
+            in_flight.dec(request.endpoint or 'unknown')
+
+    @app.after_request
+    def _track_status(response):
+        if request.endpoint != 'metrics':
+            requests_total.inc(request.endpoint or 'unknown', response.status_code)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,220 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 优先级，数值越小越先发送
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class RateLimitError(Exception):
+    """等待发送超时或等待队列已满"""
+
+
+class TokenBucket:
+    """令牌桶，支持在收到 429 后暂停到指定时间"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """距离下一个可用令牌还需等待的秒数，0 表示可立即发送"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+        self.updated = max(self.updated, self.paused_until)
+
+
+class TelegramRateLimiter:
+    """全局 + 每个聊天的令牌桶调度器，按优先级放行等待中的发送请求
+
+    等待者按聊天分组，每组是按 (优先级, 序号) 排列的小顶堆，只有队首参与调度:
+    聊天令牌已可用的队首在 ready 堆中按优先级排列，其余队首在 timed 堆中按令牌可用时间排列。
+    每次放行和入队都是 O(log n)，不需要对全部等待者排序；离开的等待者只做标记，出堆时丢弃。
+    """
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, group_rate=20 / 60,
+                 max_waiting=1000, max_chats=10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_waiting = max_waiting
+        self.max_chats = max_chats
+        # 最近使用的聊天桶，超过 max_chats 时淘汰最久未用的
+        self.chat_buckets = OrderedDict()
+        # 聊天 -> 等待者小顶堆，等待者为 [优先级, 序号, 聊天, 是否仍在等待]
+        self.chat_queues = {}
+        # (优先级, 序号, 聊天): 聊天令牌已可用的队首
+        self.ready = []
+        # (令牌可用时间, 序号, 聊天): 等待聊天令牌的队首
+        self.timed = []
+        self.waiting = 0
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        # 最近一次被唤醒去发送的等待者，避免重复唤醒
+        self.woken = None
+        self.stats = {'queued': 0, 'sent': 0, 'delayed': 0, 'dropped': 0, 'throttled': 0}
+
+    @classmethod
+    def from_env(cls):
+        """根据环境变量创建调度器"""
+        return cls(
+            global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', 30)),
+            chat_rate=float(os.getenv('TELEGRAM_CHAT_RATE', 1)),
+            group_rate=float(os.getenv('TELEGRAM_GROUP_RATE', 20)) / 60,
+            max_waiting=int(os.getenv('TELEGRAM_MAX_WAITING', 1000)),
+        )
+
+    def _chat_bucket(self, chat_id):
+        key = str(chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            # 群组和频道的 chat_id 为负数，限制更严格
+            rate = self.group_rate if key.startswith('-') else self.chat_rate
+            bucket = TokenBucket(rate, 1)
+            self.chat_buckets[key] = bucket
+            while len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(key)
+        return bucket
+
+    def _head(self, key):
+        """聊天的队首等待者，丢弃已经离开的"""
+        queue = self.chat_queues.get(key)
+        while queue and not queue[0][3]:
+            heapq.heappop(queue)
+        if not queue:
+            self.chat_queues.pop(key, None)
+            return None
+        return queue[0]
+
+    def _schedule(self, key, now):
+        """按聊天令牌是否可用，把队首放入 ready 或 timed 堆"""
+        head = self._head(key)
+        if head is None:
+            return
+        wait = self._chat_bucket(key).wait_time(now)
+        if wait <= 0:
+            heapq.heappush(self.ready, (head[0], head[1], key))
+        else:
+            heapq.heappush(self.timed, (now + wait, head[1], key))
+
+    def _next_ready(self, now):
+        """按优先级找到第一个可以发送的等待者，没有时返回 None"""
+        while self.timed and self.timed[0][0] <= now:
+            _, sequence, key = heapq.heappop(self.timed)
+            head = self._head(key)
+            if head is not None and head[1] == sequence:
+                self._schedule(key, now)
+        if self.global_bucket.wait_time(now) > 0:
+            return None
+        while self.ready:
+            _, sequence, key = self.ready[0]
+            head = self._head(key)
+            if head is None or head[1] != sequence:
+                # 已发送或已离开的队首
+                heapq.heappop(self.ready)
+                continue
+            if self._chat_bucket(key).wait_time(now) > 0:
+                # 收到 429 后聊天被暂停
+                heapq.heappop(self.ready)
+                self._schedule(key, now)
+                continue
+            return head
+        return None
+
+    def acquire(self, chat_id, priority=PRIORITY_NORMAL, timeout=None):
+        """阻塞直到可以向 chat_id 发送一条消息；超时或队列已满时返回 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        key = str(chat_id)
+        with self.condition:
+            if self.waiting >= self.max_waiting:
+                self.stats['dropped'] += 1
+                return False
+            entry = [priority, next(self.sequence), key, True]
+            heapq.heappush(self.chat_queues.setdefault(key, []), entry)
+            self.waiting += 1
+            if self._head(key) is entry:
+                self._schedule(key, time.monotonic())
+            self.stats['queued'] += 1
+            delayed = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    ready = self._next_ready(now)
+                    if ready is entry:
+                        self.global_bucket.consume(now)
+                        self._chat_bucket(key).consume(now)
+                        self.stats['sent'] += 1
+                        if delayed:
+                            self.stats['delayed'] += 1
+                        return True
+                    delayed = True
+                    if ready is not None:
+                        # 轮到其他等待者: 唤醒它一次，自己等它发送后的通知，不用 wait(0) 空转
+                        if ready is not self.woken:
+                            self.woken = ready
+                            self.condition.notify_all()
+                        wait = None
+                    else:
+                        wait = max(self.global_bucket.wait_time(now), self._chat_bucket(key).wait_time(now))
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            self.stats['dropped'] += 1
+                            return False
+                        wait = remaining if wait is None else min(wait, remaining)
+                    # 等到自己的令牌可用；其他等待者被放行后也会唤醒这里重新检查
+                    self.condition.wait(wait)
+            finally:
+                was_head = self._head(key) is entry
+                entry[3] = False
+                self.waiting -= 1
+                if was_head:
+                    # 下一个等待者成为队首
+                    self._schedule(key, time.monotonic())
+                self.condition.notify_all()
+
+    def observe(self, chat_id, status_code, result=None):
+        """根据 Bot API 响应调整限流；遇到 429 时暂停对应聊天并返回 retry_after"""
+        if status_code != 429:
+            return None
+        retry_after = 1
+        if isinstance(result, dict):
+            retry_after = (result.get('parameters') or {}).get('retry_after', retry_after)
+        with self.condition:
+            self.stats['throttled'] += 1
+            self._chat_bucket(chat_id).pause(retry_after, time.monotonic())
+            self.condition.notify_all()
+        return retry_after
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['waiting'] = self.waiting
+        return stats
@@ -0,0 +1,282 @@
+"""本地 Redis 协议桩服务，用于在没有 Redis 的环境中测试多进程共享状态
+
+只实现机器人状态存储用到的命令(字符串、集合、有序集合、过期时间、解锁和续期脚本)，
+数据保存在内存中。
+用法: python redis_stub.py --port 6390
+"""
+import argparse
+import fnmatch
+import socketserver
+import threading
+import time
+
+# 支持的 EVAL 脚本: 值等于 ARGV[1] 时删除 KEYS[1] / 把 KEYS[1] 的过期时间设为 ARGV[2] 毫秒
+UNLOCK_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) else return 0 end"
+)
+RENEW_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+)
+
+
+class CommandError(Exception):
+    pass
+
+
+def _encode(value, resp3=False):
+    if value is None:
+        return b'_\r\n' if resp3 else b'$-1\r\n'
+    if isinstance(value, CommandError):
+        return b'-ERR ' + str(value).encode() + b'\r\n'
+    if value is True:
+        return b'+OK\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, (list, tuple)):
+        return b'*%d\r\n' % len(value) + b''.join(_encode(item, resp3) for item in value)
+    if isinstance(value, dict):
+        return b'%%%d\r\n' % len(value) + b''.join(
+            _encode(key, resp3) + _encode(item, resp3) for key, item in value.items())
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, float):
+        value = repr(value).encode()
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class RedisStubHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+    # 客户端用 HELLO 3 切换到 RESP3 后，空值和映射按 RESP3 编码
+    resp3 = False
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if args is None:
+                break
+            name = args[0].decode().upper()
+            if name == 'HELLO':
+                self.resp3 = len(args) > 1 and args[1] == b'3'
+                reply = {'server': 'redis', 'version': '7.0.0', 'proto': 3 if self.resp3 else 2, 'mode': 'standalone'}
+                self.wfile.write(_encode(reply, self.resp3))
+                self.wfile.flush()
+                continue
+            try:
+                with self.server.lock:
+                    reply = self.server.execute(name, args[1:])
+            except CommandError as e:
+                reply = e
+            except (ValueError, IndexError) as e:
+                reply = CommandError(f"{name}: {e}")
+            self.wfile.write(_encode(reply, self.resp3))
+            self.wfile.flush()
+
+
+class RedisStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, RedisStubHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.expires = {}
+        self.command_count = 0
+
+    def _alive(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _get(self, key, kind):
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if not isinstance(value, kind):
+            raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def execute(self, name, args):
+        self.command_count += 1
+        handler = getattr(self, 'cmd_' + name.lower(), None)
+        if handler is None:
+            raise CommandError(f"unknown command '{name}'")
+        return handler(*args)
+
+    def cmd_ping(self, *args):
+        return args[0] if args else b'PONG'
+
+    def cmd_select(self, db):
+        return True
+
+    def cmd_client(self, *args):
+        return True
+
+    def cmd_flushdb(self, *args):
+        self.data.clear()
+        self.expires.clear()
+        return True
+
+    def cmd_get(self, key):
+        return self._get(key, bytes)
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() if isinstance(option, bytes) else option for option in options]
+        exists = self._alive(key)
+        if b'NX' in options and exists or b'XX' in options and not exists:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        for unit, scale in ((b'EX', 1.0), (b'PX', 0.001)):
+            if unit in options:
+                self.expires[key] = time.time() + int(options[options.index(unit) + 1]) * scale
+        return True
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._alive(key))
+
+    def cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_keys(self, pattern):
+        pattern = pattern.decode()
+        return [key for key in list(self.data) if self._alive(key) and fnmatch.fnmatchcase(key.decode(), pattern)]
+
+    def cmd_sadd(self, key, *members):
+        members_set = self._get(key, set)
+        if members_set is None:
+            members_set = self.data[key] = set()
+        before = len(members_set)
+        members_set.update(members)
+        return len(members_set) - before
+
+    def cmd_srem(self, key, *members):
+        members_set = self._get(key, set) or set()
+        before = len(members_set)
+        members_set.difference_update(members)
+        return before - len(members_set)
+
+    def cmd_sismember(self, key, member):
+        return int(member in (self._get(key, set) or ()))
+
+    def cmd_smembers(self, key):
+        return list(self._get(key, set) or ())
+
+    def cmd_scard(self, key):
+        return len(self._get(key, set) or ())
+
+    def cmd_zadd(self, key, *args):
+        flags = set()
+        while args and args[0].upper() in (b'NX', b'XX', b'CH'):
+            flags.add(args[0].upper())
+            args = args[1:]
+        zset = self._get(key, dict)
+        if zset is None:
+            zset = self.data[key] = {}
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            exists = member in zset
+            if b'NX' in flags and exists or b'XX' in flags and not exists:
+                continue
+            zset[member] = float(score)
+            added += not exists
+        return added
+
+    def cmd_zrem(self, key, *members):
+        zset = self._get(key, dict) or {}
+        return sum(1 for member in members if zset.pop(member, None) is not None)
+
+    def cmd_zscore(self, key, member):
+        score = (self._get(key, dict) or {}).get(member)
+        return None if score is None else repr(score)
+
+    def cmd_zcard(self, key):
+        return len(self._get(key, dict) or {})
+
+    def cmd_zrangebyscore(self, key, minimum, maximum, *options):
+        def bound(value, default):
+            value = value.decode()
+            if value in ('-inf', '+inf', 'inf'):
+                return default
+            return float(value.lstrip('('))
+        low, high = bound(minimum, float('-inf')), bound(maximum, float('inf'))
+        options = [option.upper() for option in options]
+        items = sorted(((score, member) for member, score in (self._get(key, dict) or {}).items()
+                        if low <= score <= high))
+        if b'LIMIT' in options:
+            index = options.index(b'LIMIT')
+            offset, count = int(options[index + 1]), int(options[index + 2])
+            items = items[offset:offset + count if count >= 0 else None]
+        if b'WITHSCORES' in options:
+            return [value for score, member in items for value in (member, repr(score))]
+        return [member for _, member in items]
+
+    def cmd_pexpire(self, key, milliseconds):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.time() + int(milliseconds) / 1000
+        return 1
+
+    def cmd_eval(self, script, numkeys, *args):
+        script = script.decode()
+        if script not in (UNLOCK_SCRIPT, RENEW_SCRIPT) or int(numkeys) != 1:
+            raise CommandError("桩服务只支持解锁和续期脚本")
+        key, token = args[0], args[1]
+        if self._get(key, bytes) != token:
+            return 0
+        if script == UNLOCK_SCRIPT:
+            return self.cmd_del(key)
+        return self.cmd_pexpire(key, args[2])
+
+
+def start_stub(host='127.0.0.1', port=0):
+    """在后台线程中启动桩服务，返回 (server, url)"""
+    server = RedisStubServer((host, port))
+    thread = threading.Thread(target=server.serve_forever, name="redis-stub", daemon=True)
+    thread.start()
+    return server, f"redis://{host}:{server.server_address[1]}/0"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 Redis 协议桩服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    server = RedisStubServer((args.host, args.port))
+    print(f"Redis 桩服务: redis://{args.host}:{args.port}/0")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
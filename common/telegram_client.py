@@ -0,0 +1,106 @@
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import REGISTRY
+from rate_limiter import PRIORITY_NORMAL, RateLimitError, TelegramRateLimiter
+
+try:
+    import httpx
+except ImportError:  # HTTP/2 为可选功能
+    httpx = None
+
+DEFAULT_API_BASE = 'https://api.telegram.org'
+
+SEND_SECONDS = REGISTRY.histogram('telegram_request_seconds', 'Telegram Bot API 请求耗时', ('method',))
+ERRORS_TOTAL = REGISTRY.counter('telegram_errors_total', 'Telegram Bot API 请求失败次数', ('method', 'status'))
+
+
+class TelegramClient:
+    """共享的 Telegram Bot API 客户端，复用连接池并设置超时"""
+
+    def __init__(self, token, api_base=None, connect_timeout=3.05, read_timeout=10.0,
+                 pool_size=10, http2=False, rate_limiter=None, acquire_timeout=None):
+        self.token = token
+        self.rate_limiter = rate_limiter
+        self.acquire_timeout = acquire_timeout
+        if rate_limiter is not None:
+            REGISTRY.callback_gauge(
+                'telegram_rate_limiter', 'Telegram 限流调度器统计(累计值和当前等待数)',
+                rate_limiter.get_stats, ('stat',)
+            )
+        self.api_base = (api_base or DEFAULT_API_BASE).rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = bool(http2 and httpx is not None)
+        if http2 and httpx is None:
+            print("未安装 httpx[http2]，回退到 HTTP/1.1 连接池")
+
+        if self.http2:
+            self.session = httpx.Client(
+                http2=True,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+        else:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_env(cls, token):
+        """根据环境变量创建客户端"""
+        return cls(
+            token,
+            api_base=os.getenv('TELEGRAM_API_BASE'),
+            connect_timeout=float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', 3.05)),
+            read_timeout=float(os.getenv('TELEGRAM_READ_TIMEOUT', 10)),
+            pool_size=int(os.getenv('TELEGRAM_POOL_SIZE', 10)),
+            http2=os.getenv('TELEGRAM_HTTP2', 'False').lower() == 'true',
+            rate_limiter=TelegramRateLimiter.from_env(),
+            acquire_timeout=float(os.getenv('TELEGRAM_ACQUIRE_TIMEOUT', 60)),
+        )
+
+    def method_url(self, method):
+        return f"{self.api_base}/bot{self.token}/{method}"
+
+    def call(self, method, payload):
+        """调用 Bot API 方法，返回响应对象"""
+        started = time.perf_counter()
+        try:
+            if self.http2:
+                response = self.session.post(self.method_url(method), json=payload)
+            else:
+                response = self.session.post(self.method_url(method), json=payload, timeout=self.timeout)
+        except Exception:
+            ERRORS_TOTAL.inc(method, 'exception')
+            raise
+        finally:
+            SEND_SECONDS.observe(time.perf_counter() - started, method)
+        if response.status_code >= 400:
+            ERRORS_TOTAL.inc(method, response.status_code)
+        return response
+
+    def send_message(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        """发送文本消息，配置了限流器时先按优先级排队"""
+        payload = {'chat_id': chat_id, 'text': text}
+        payload.update(kwargs)
+        if self.rate_limiter is None:
+            return self.call('sendMessage', payload)
+
+        if not self.rate_limiter.acquire(chat_id, priority, self.acquire_timeout):
+            raise RateLimitError(f"发送到 {chat_id} 的消息等待超时或队列已满")
+        response = self.call('sendMessage', payload)
+        if response.status_code == 429:
+            try:
+                result = response.json()
+            except ValueError:
+                result = None
+            retry_after = self.rate_limiter.observe(chat_id, response.status_code, result)
+            print(f"触发 Telegram 限流，{retry_after} 秒后重试")
+        return response
+
+    def close(self):
+        self.session.close()
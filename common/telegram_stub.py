@@ -0,0 +1,86 @@
+"""本地 Telegram Bot API 桩服务，用于基准测试
+
+用法: python telegram_stub.py --port 8081 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持 keep-alive
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            server.request_count += 1
+            message_id = server.request_count
+
+        if server.error_rate and random.random() < server.error_rate:
+            with server.lock:
+                server.error_count += 1
+            status = random.choice([429, 500])
+            result = {'ok': False, 'error_code': status, 'description': 'stub error'}
+            if status == 429:
+                result['parameters'] = {'retry_after': 1}
+        else:
+            status = 200
+            try:
+                payload = json.loads(body or b'{}')
+            except ValueError:
+                payload = {}
+            result = {'ok': True, 'result': {
+                'message_id': message_id,
+                'chat': {'id': payload.get('chat_id')},
+                'date': int(time.time()),
+                'text': payload.get('text', ''),
+            }}
+
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(host='127.0.0.1', port=0, latency=0.0, error_rate=0.0):
+    """在后台线程启动桩服务，返回 (server, base_url)"""
+    ThreadingHTTPServer.request_queue_size = 1024  # 默认的 5 在压测时会导致连接被重置
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.request_count = 0
+    server.error_count = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地 Telegram Bot API 桩服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的额外延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 429/500 的概率')
+    args = parser.parse_args()
+    server, base_url = start_stub(args.host, args.port, args.latency, args.error_rate)
+    print(f"Telegram 桩服务运行于 {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
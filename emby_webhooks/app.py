@@ -1,9 +1,21 @@
 from flask import Flask, request, jsonify
-import requests
 from datetime import datetime, timezone
 import json
 from dotenv import load_dotenv
 import os
+import sys
+from spool import DeliverySpool
+from coalesce import PlaybackCoalescer
+from digest import LibraryDigest
+from dedup import WebhookDeduplicator
+from routing import EventRouter
+from renderer import MessageRenderer, format_notification_type
+
+# 共享模块位于仓库根目录的 common 目录
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from telegram_client import TelegramClient
+from rate_limiter import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from metrics import REGISTRY, install_flask_metrics
 
 # 加载.env文件
 load_dotenv()
@@ -15,8 +27,29 @@ SERVER_NAME = os.getenv('SERVER_NAME')
 FLASK_HOST = os.getenv('FLASK_HOST')
 FLASK_PORT = int(os.getenv('FLASK_PORT', 5003))
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+SPOOL_WORKERS = int(os.getenv('SPOOL_WORKERS', 2))
+PLAYBACK_COALESCE = os.getenv('PLAYBACK_COALESCE', 'True').lower() == 'true'
+PLAYBACK_IDLE_TIMEOUT = int(os.getenv('PLAYBACK_IDLE_TIMEOUT', 600))
+PLAYBACK_MAX_SESSIONS = int(os.getenv('PLAYBACK_MAX_SESSIONS', 1000))
+MESSAGE_TEMPLATES = os.getenv('MESSAGE_TEMPLATES')
+LIBRARY_DIGEST = os.getenv('LIBRARY_DIGEST', 'True').lower() == 'true'
+LIBRARY_DIGEST_WINDOW = int(os.getenv('LIBRARY_DIGEST_WINDOW', 300))
+LIBRARY_DIGEST_QUIET = int(os.getenv('LIBRARY_DIGEST_QUIET', 30))
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', 600))
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', 10000))
+DEDUP_SNAPSHOT = os.getenv('DEDUP_SNAPSHOT', 'dedup.json')
+ROUTING_RULES = os.getenv('ROUTING_RULES')
 
 app = Flask(__name__)
+telegram_client = TelegramClient.from_env(TELEGRAM_BOT_TOKEN)
+install_flask_metrics(app, prefix='emby')
+
+EVENTS_TOTAL = REGISTRY.counter('emby_webhook_events_total', '收到的 Emby 事件数', ('event',))
+FORMAT_SECONDS = REGISTRY.histogram(
+    'emby_format_seconds', '消息格式化耗时',
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+)
 
 def get_current_time():
     """获取当前本地时间"""
@@ -24,143 +57,149 @@ def get_current_time():
     local_time = utc_time.astimezone()  # 自动转换为本地时间
     return local_time.strftime('%Y-%m-%d %H:%M:%S %Z')
 
-def format_notification_type(notification_type):
-    """格式化通知类型"""
-    type_mapping = {
-        # 播放相关
-        "playback.start": "开始播放",
-        "playback.stop": "停止播放",
-        "playback.pause": "暂停播放",
-        "playback.unpause": "继续播放",
-        "playback.progress": "播放进度",
-        
-        # 系统相关
-        "system.webhooktest": "系统测试",
-        "system.notificationtest": "通知测试",
-        "system.wakingup": "系统唤醒",
-        "system.shuttingdown": "系统关闭",
-        "system.resumed": "系统恢复",
-        "system.update.available": "系统更新可用",
-        "system.updateavailable": "系统更新可用",  # 新增此行
-        "system.update.installed": "系统更新完成",
-        "system.serverrestartrequired": "服务器需要重启",  # 新增
-        
-        # 库相关
-        "library.new": "新增媒体",
-        "library.update": "库更新",
-        "library.deleted": "删除媒体",  # 添加此行
-        "library.scanning": "库扫描中",
-        "library.scancomplete": "库扫描完成",
-        
-        # 用户相关
-        "user.login": "用户登录",
-        "user.logout": "用户登出",
-        "user.new": "新用户创建",
-        "user.delete": "用户删除",
-        "user.authenticated": "用户验证成功",
-        "user.authentication.success": "用户验证成功",
-        "user.authenticationfailed": "用户认证失败",  # 添加此行
-        "user.authenticationerror": "用户认证错误",   # 添加此行
-        "user.password.reset": "用户密码重置",
-        "user.policyupdated": "用户策略更新",  # 添加此行
-        
-        # 会话相关
-        "session.start": "会话开始",
-        "session.end": "会话结束",
-        "session.timeout": "会话超时",
-        
-        # 设备相关
-        "device.new": "新设备连接",
-        "device.delete": "设备移除",
-        
-        # 任务相关
-        "task.completed": "任务完成",
-        "task.failed": "任务失败",
-        
-        # 转码相关
-        "transcoding.start": "开始转码",
-        "transcoding.end": "转码完成",
-        "transcoding.error": "转码错误",
-        
-        # 插件相关
-        "plugins.pluginupdated": "插件已更新",
-        "plugins.plugininstalled": "插件已安装",  # 新增此行
-        
-        # 项目相关
-        "item.rate": "项目评分"  # 新增此行
-    }
-    return type_mapping.get(notification_type, f"未知事件({notification_type})")
-
-def send_telegram_message(message):
-    """发送消息到 Telegram"""
+# 消息模板在启动时编译
+message_renderer = MessageRenderer(SERVER_NAME, get_current_time, MESSAGE_TEMPLATES)
+
+# 管理类告警优先发送，播放类消息最后发送
+HIGH_PRIORITY_EVENTS = {
+    "user.authenticationfailed",
+    "user.authenticationerror",
+    "system.shuttingdown",
+    "system.serverrestartrequired",
+    "task.failed",
+    "transcoding.error",
+}
+
+def get_event_priority(event_type):
+    """获取事件的发送优先级"""
+    if event_type in HIGH_PRIORITY_EVENTS:
+        return PRIORITY_HIGH
+    if event_type.startswith('playback.'):
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
+
+def send_telegram_message(message, priority=PRIORITY_NORMAL, chat_id=None):
+    """发送消息到 Telegram，chat_id 为空时发送到默认聊天"""
     try:
-        url = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage'
-        payload = {
-            'chat_id': TELEGRAM_CHAT_ID,
-            'text': message,
-            'parse_mode': 'HTML',
-            'disable_web_page_preview': True
-        }
-        response = requests.post(url, json=payload)
+        response = telegram_client.send_message(
+            chat_id or TELEGRAM_CHAT_ID,
+            message,
+            priority=priority,
+            parse_mode='HTML',
+            disable_web_page_preview=True
+        )
         response.raise_for_status()
         return True
     except Exception as e:
         print(f"发送消息失败: {str(e)}")
         return False
 
+# 待发送消息先写入磁盘队列，由后台线程发送
+delivery_spool = DeliverySpool(SPOOL_DIR, send_telegram_message, workers=SPOOL_WORKERS)
+
+# 按规则把事件分发到不同聊天，未匹配任何规则时发送到 TELEGRAM_CHAT_ID
+event_router = EventRouter.from_file(ROUTING_RULES, TELEGRAM_CHAT_ID)
+
+def enqueue_message(message, data, priority=PRIORITY_NORMAL):
+    """为每个目标聊天各写入一条发送记录，由发送线程并发发送"""
+    for chat_id in event_router.route(data):
+        delivery_spool.enqueue(message, priority, chat_id)
+
+# 播放进度/暂停等高频事件按会话合并后再发送
+playback_coalescer = PlaybackCoalescer(
+    lambda summary: enqueue_message(format_playback_summary(summary), summary['data'], PRIORITY_LOW),
+    idle_timeout=PLAYBACK_IDLE_TIMEOUT,
+    max_sessions=PLAYBACK_MAX_SESSIONS
+)
+
 def format_message(data):
     """格式化通知消息"""
     try:
-        event_type = data.get('Event', '未知事件')
-        notification_type = format_notification_type(event_type)
-        
-        server_info = data.get('Server', {})
-        server_name = server_info.get('Name') or SERVER_NAME
-        server_version = server_info.get('Version', '')
-        
-        user_info = data.get('User', {})
-        user_name = user_info.get('Name', '')
-        
-        message_parts = [
-            "<b>🎬 Emby 通知</b>",
-            f"\n📺 服务器: {server_name}"
-        ]
-        
-        if server_version:
-            message_parts[-1] += f" (v{server_version})"
-        
-        message_parts.append(f"\n📝 类型: {notification_type}")
-        
-        if user_name:
-            message_parts.append(f"\n👤 用户: {user_name}")
-        
-        title = data.get('Title')
-        if title:
-            message_parts.append(f"\n🎵 标题: {title}")
-        
-        description = data.get('Description')
-        if description:
-            message_parts.append(f"\n📝 描述: {description}")
-
-        event_date = data.get('Date')
-        if event_date:
-            try:
-                dt = datetime.fromisoformat(event_date.replace('Z', '+00:00'))
-                local_time = dt.astimezone()
-                formatted_time = local_time.strftime('%Y-%m-%d %H:%M:%S')
-                message_parts.append(f"\n⏰ 事件时间: {formatted_time}")
-            except (ValueError, TypeError) as e:
-                print(f"时间格式化错误: {e}")
-
-        current_time = get_current_time()
-        message_parts.append(f"\n⌚ 通知时间: {current_time}")
-
-        return "\n".join(message_parts)
-
+        with FORMAT_SECONDS.time():
+            return message_renderer.format_message(data)
     except Exception as e:
         print(f"格式化消息失败: {str(e)}")
         return "消息格式化错误"
 
+def format_playback_summary(summary):
+    """格式化播放会话汇总消息"""
+    data = dict(summary['data'], Event='playback.summary')
+
+    steps = []
+    if summary['started']:
+        steps.append("开始播放")
+    if summary['pause_count']:
+        steps.append(f"暂停 {summary['pause_count']} 次")
+    if summary['stopped']:
+        if summary['percent'] is not None:
+            steps.append(f"停止于 {summary['percent']:.0f}%")
+        else:
+            steps.append("停止播放")
+    else:
+        if summary['percent'] is not None:
+            steps.append(f"最后进度 {summary['percent']:.0f}%")
+        steps.append("未收到停止事件")
+
+    title = data.get('Title') or data.get('Item', {}).get('Name')
+    return message_renderer.format_message(data, steps=' / '.join(steps), title=title)
+
+# 过滤 Emby 因响应慢而重试的重复请求
+webhook_dedup = WebhookDeduplicator(DEDUP_TTL, DEDUP_MAX_ENTRIES, DEDUP_SNAPSHOT or None)
+
+REGISTRY.callback_gauge('emby_spool_pending', '发送队列中等待发送的消息数', lambda: delivery_spool.pending())
+REGISTRY.callback_gauge(
+    'emby_dedup', '去重缓存统计(命中/未命中/当前条数)',
+    lambda: webhook_dedup.get_stats(), ('stat',)
+)
+
+def start_background_workers():
+    """启动发送线程和播放事件合并线程"""
+    webhook_dedup.start()
+    delivery_spool.start()
+    if PLAYBACK_COALESCE:
+        playback_coalescer.start()
+    if LIBRARY_DIGEST:
+        library_digest.start()
+
+def stop_background_workers():
+    """输出未结束的播放汇总并等待发送中的消息完成"""
+    if PLAYBACK_COALESCE:
+        playback_coalescer.stop()
+    if LIBRARY_DIGEST:
+        library_digest.stop()
+    delivery_spool.stop()
+    webhook_dedup.stop()
+
+def format_library_digest(digest):
+    """格式化媒体库汇总消息，单条事件仍使用普通格式"""
+    if digest['count'] == 1:
+        return [format_message(digest['data'])]
+
+    titles = list(digest['titles'])
+    hidden = digest['count'] - len(titles)
+    if hidden > 0:
+        titles.append(f"... 以及另外 {hidden} 项")
+    return message_renderer.format_paged(
+        'library.digest',
+        digest['data'],
+        titles,
+        group_name=digest['group_name'],
+        library_name=digest['library_name'],
+        count=digest['count']
+    )
+
+def enqueue_library_digest(digest):
+    for message in format_library_digest(digest):
+        enqueue_message(message, digest['data'], PRIORITY_NORMAL)
+
+# 扫描媒体库时的大量新增/删除事件按剧集合并
+library_digest = LibraryDigest(
+    enqueue_library_digest,
+    window=LIBRARY_DIGEST_WINDOW,
+    quiet_period=LIBRARY_DIGEST_QUIET,
+    library_map=event_router.library_map
+)
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """处理 webhook 请求"""
@@ -172,13 +211,27 @@ def webhook():
         if 'Event' not in data:
             return jsonify({'status': 'error', 'message': '缺少事件类型'}), 400
 
+        EVENTS_TOTAL.inc(data['Event'])
+        if webhook_dedup.seen(data):
+            return jsonify({'status': 'duplicate', 'message': '重复的通知已忽略'}), 200
+
+        if PLAYBACK_COALESCE and playback_coalescer.handles(data['Event']):
+            playback_coalescer.add(data)
+            return jsonify({'status': 'accepted', 'message': '播放事件已合并'}), 202
+
+        if LIBRARY_DIGEST and library_digest.handles(data['Event']):
+            library_digest.add(data)
+            return jsonify({'status': 'accepted', 'message': '媒体库事件已合并'}), 202
+
         message = format_message(data)
-        success = send_telegram_message(message)
+        try:
+            enqueue_message(message, data, get_event_priority(data['Event']))
+        except OSError as e:
+            print(f"写入发送队列失败: {e}")
+            webhook_dedup.forget(data)
+            return jsonify({'status': 'error', 'message': '写入发送队列失败'}), 500
 
-        if success:
-            return jsonify({'status': 'success', 'message': '通知已发送'}), 200
-        else:
-            return jsonify({'status': 'error', 'message': '发送通知失败'}), 500
+        return jsonify({'status': 'accepted', 'message': '通知已加入发送队列'}), 202
 
     except json.JSONDecodeError:
         return jsonify({'status': 'error', 'message': '无效的 JSON 数据'}), 400
@@ -187,6 +240,24 @@ def webhook():
         print(error_msg)
         return jsonify({'status': 'error', 'message': error_msg}), 500
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """查看去重、发送队列和限流统计"""
+    return jsonify({
+        'dedup': webhook_dedup.get_stats(),
+        'spool_pending': delivery_spool.pending(),
+        'rate_limiter': telegram_client.rate_limiter.get_stats() if telegram_client.rate_limiter else {}
+    })
+
 if __name__ == '__main__':
     print(f"Emby Webhook 服务启动于 http://{FLASK_HOST}:{FLASK_PORT}")
+    # 调试模式下只在重载器的子进程中启动发送线程，避免重复发送
+    if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
+        cleanups = []
+        if PLAYBACK_COALESCE:
+            cleanups.append(playback_coalescer.stop)
+        if LIBRARY_DIGEST:
+            cleanups.append(library_digest.stop)
+        delivery_spool.install_signal_handlers(*cleanups)
     app.run(host=FLASK_HOST, port=FLASK_PORT, debug=DEBUG)
\ No newline at end of file
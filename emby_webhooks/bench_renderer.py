@@ -0,0 +1,44 @@
+"""渲染一批 Emby webhook 数据，统计每秒渲染次数
+
+用法: python bench_renderer.py -n 200000
+"""
+import argparse
+import time
+
+from renderer import MessageRenderer, NOTIFICATION_TYPES
+
+
+def build_corpus():
+    """为每种事件构造一条示例数据，部分字段包含需要转义的字符"""
+    corpus = []
+    for i, event_type in enumerate(NOTIFICATION_TYPES):
+        data = {
+            'Event': event_type,
+            'Date': f"2024-05-{i % 28 + 1:02d}T12:{i % 60:02d}:00.0000000Z",
+            'Server': {'Name': 'nas', 'Version': '4.8.0.0'},
+        }
+        if i % 2 == 0:
+            data['User'] = {'Name': f'user{i}', 'Id': str(i)}
+        if i % 3 != 0:
+            data['Title'] = f"Tom & Jerry <S01E{i:02d}>"
+            data['Description'] = "某用户在 <客厅电视> 上播放"
+        corpus.append(data)
+    return corpus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=200000)
+    parser.add_argument('--templates', help='自定义模板 JSON 文件')
+    args = parser.parse_args()
+
+    renderer = MessageRenderer('nas', lambda: '2024-05-01 12:00:00 CST', args.templates)
+    corpus = build_corpus()
+
+    started = time.perf_counter()
+    for i in range(args.count):
+        renderer.format_message(corpus[i % len(corpus)])
+    elapsed = time.perf_counter() - started
+
+    print(f"payloads={len(corpus)} renders={args.count} "
+          f"elapsed={elapsed:.3f}s renders/s={args.count / elapsed:,.0f}")
@@ -0,0 +1,144 @@
+"""回放 Emby webhook 语料，测量 /webhook 的吞吐量、延迟和发送失败率
+
+默认在本进程内启动服务，并把 Telegram API 指向本地桩服务:
+    python bench_replay.py -c 20 -n 2000 --latency 0.05 --error-rate 0.02 -o result.json
+也可以压测已经运行的服务(此时只统计 HTTP 结果):
+    python bench_replay.py --url http://127.0.0.1:5003/webhook
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'common'))
+
+from bench_http_load import run_load
+from telegram_stub import start_stub
+
+BASE_DATE = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+def load_corpus(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def make_body_factory(corpus):
+    """按顺序循环语料，每次改写事件时间，避免被去重缓存过滤"""
+    def body_factory(index):
+        data = copy.deepcopy(corpus[index % len(corpus)])
+        event_time = BASE_DATE + timedelta(microseconds=index)
+        data['Date'] = event_time.strftime('%Y-%m-%dT%H:%M:%S.%f0Z')
+        return data
+    return body_factory
+
+
+def start_local_service(latency, error_rate):
+    """启动桩服务和本进程内的 webhook 服务，返回 (stub, app 模块, webhook 地址, http 服务)"""
+    stub, api_base = start_stub(latency=latency, error_rate=error_rate)
+    os.environ.update({
+        'TELEGRAM_API_BASE': api_base,
+        'TELEGRAM_BOT_TOKEN': 'BENCH',
+        'TELEGRAM_CHAT_ID': '1',
+        'SPOOL_DIR': tempfile.mkdtemp(prefix='emby-bench-spool-'),
+        'DEDUP_SNAPSHOT': '',
+        # 桩服务不限流，调度器只保留优先级排序
+        'TELEGRAM_GLOBAL_RATE': os.getenv('TELEGRAM_GLOBAL_RATE', '100000'),
+        'TELEGRAM_CHAT_RATE': os.getenv('TELEGRAM_CHAT_RATE', '100000'),
+        'TELEGRAM_MAX_WAITING': os.getenv('TELEGRAM_MAX_WAITING', '100000'),
+    })
+    sys.path.insert(0, BASE_DIR)
+    import app as webhook_app
+    from werkzeug.serving import make_server
+
+    webhook_app.delivery_spool.base_delay = 0.05
+    webhook_app.delivery_spool.max_delay = 1.0
+    server = make_server('127.0.0.1', 0, webhook_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook_app.start_background_workers()
+    url = f"http://127.0.0.1:{server.server_port}/webhook"
+    return stub, webhook_app, url, server
+
+
+def wait_for_drain(webhook_app, timeout):
+    """输出所有合并中的事件并等待发送队列清空，返回耗时"""
+    started = time.perf_counter()
+    webhook_app.playback_coalescer.flush()
+    webhook_app.library_digest.flush()
+    spool = webhook_app.delivery_spool
+    while time.perf_counter() - started < timeout:
+        with spool.lock:
+            if not spool.queued_ids:
+                break
+        time.sleep(0.05)
+    return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--concurrency', type=int, default=20)
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('--corpus', default=os.path.join(BASE_DIR, 'bench_corpus.json'))
+    parser.add_argument('--latency', type=float, default=0.0, help='桩服务每个请求的延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='桩服务返回 429/500 的概率')
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--url', help='压测已运行的服务，不启动本地桩服务')
+    parser.add_argument('-o', '--output', help='结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    stub = webhook_app = server = None
+    url = args.url
+    if not url:
+        stub, webhook_app, url, server = start_local_service(args.latency, args.error_rate)
+
+    result = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'corpus_size': len(corpus),
+        'config': {
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+        },
+    }
+    http_result = run_load(url, args.concurrency, args.requests, 'POST', body_factory=make_body_factory(corpus))
+    http_failures = http_result['errors'] + sum(
+        count for status, count in http_result['statuses'].items() if status >= 400)
+    http_result['failure_rate'] = round(http_failures / max(1, http_result['requests']), 4)
+    result['http'] = http_result
+
+    if webhook_app:
+        drain_time = wait_for_drain(webhook_app, args.drain_timeout)
+        spool = webhook_app.delivery_spool
+        failed = len(os.listdir(spool.failed_dir))
+        with spool.lock:
+            undelivered = len(spool.queued_ids)
+        attempts = stub.request_count
+        result['delivery'] = {
+            'telegram_requests': attempts,
+            'telegram_errors_injected': stub.error_count,
+            'delivered': attempts - stub.error_count,
+            'undelivered': undelivered,
+            'failed': failed,
+            'retry_rate': round(stub.error_count / max(1, attempts), 4),
+            'drain_seconds': round(drain_time, 3),
+            'rate_limiter': webhook_app.telegram_client.rate_limiter.get_stats(),
+            'dedup': webhook_app.webhook_dedup.get_stats(),
+        }
+        server.shutdown()
+        stub.shutdown()
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
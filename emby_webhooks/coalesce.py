@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+
+PLAYBACK_EVENTS = {
+    "playback.start",
+    "playback.stop",
+    "playback.pause",
+    "playback.unpause",
+    "playback.progress",
+}
+
+
+class PlaybackCoalescer:
+    """按 用户/设备/媒体 聚合播放事件，每个播放会话只发送一条汇总消息"""
+
+    def __init__(self, emit, idle_timeout=600, max_sessions=1000, sweep_interval=30):
+        self.emit = emit
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        # 按最近活跃时间排序，最久未活跃的在最前
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def handles(event_type):
+        return event_type in PLAYBACK_EVENTS
+
+    @staticmethod
+    def session_key(data):
+        user = data.get('User') or {}
+        session = data.get('Session') or {}
+        item = data.get('Item') or {}
+        return (
+            user.get('Id') or user.get('Name', ''),
+            session.get('DeviceId') or session.get('DeviceName', ''),
+            item.get('Id') or data.get('Title', ''),
+        )
+
+    @staticmethod
+    def _position_percent(data):
+        position = (data.get('PlaybackInfo') or {}).get('PositionTicks')
+        runtime = (data.get('Item') or {}).get('RunTimeTicks')
+        if position is None or not runtime:
+            return None
+        return max(0.0, min(100.0, position * 100.0 / runtime))
+
+    def add(self, data):
+        """记录一个播放事件，会话结束时触发 emit"""
+        event_type = data.get('Event')
+        key = self.session_key(data)
+        now = time.monotonic()
+        finished = []
+
+        with self.lock:
+            state = self.sessions.pop(key, None)
+            if state is None:
+                state = {
+                    'data': data,
+                    'started': event_type == 'playback.start',
+                    'pause_count': 0,
+                    'event_count': 0,
+                    'percent': None,
+                    'first_date': data.get('Date'),
+                }
+            state['event_count'] += 1
+            state['last_seen'] = now
+            state['last_date'] = data.get('Date') or state.get('last_date')
+
+            percent = self._position_percent(data)
+            if percent is not None:
+                # 进度事件只更新位置，不单独发送
+                state['percent'] = percent
+            if event_type == 'playback.pause':
+                state['pause_count'] += 1
+
+            if event_type == 'playback.stop':
+                state['stopped'] = True
+                finished.append(state)
+            else:
+                self.sessions[key] = state
+                while len(self.sessions) > self.max_sessions:
+                    _, evicted = self.sessions.popitem(last=False)
+                    evicted['stopped'] = False
+                    finished.append(evicted)
+
+        for state in finished:
+            self._emit(state)
+
+    def sweep(self):
+        """清理长时间没有事件的会话(通常是客户端未发送停止事件)"""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            while self.sessions:
+                key, state = next(iter(self.sessions.items()))
+                if now - state['last_seen'] < self.idle_timeout:
+                    break
+                del self.sessions[key]
+                state['stopped'] = False
+                expired.append(state)
+        for state in expired:
+            self._emit(state)
+        return len(expired)
+
+    def flush(self):
+        """立即输出所有未结束的会话"""
+        with self.lock:
+            remaining = list(self.sessions.values())
+            self.sessions.clear()
+        for state in remaining:
+            state['stopped'] = False
+            self._emit(state)
+
+    def _emit(self, state):
+        try:
+            self.emit({
+                'data': state['data'],
+                'started': state['started'],
+                'stopped': state['stopped'],
+                'pause_count': state['pause_count'],
+                'event_count': state['event_count'],
+                'percent': state['percent'],
+                'first_date': state['first_date'],
+                'last_date': state.get('last_date'),
+            })
+        except Exception as e:
+            print(f"输出播放汇总失败: {e}")
+
+    def _run(self):
+        while not self.stop_event.wait(self.sweep_interval):
+            self.sweep()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="playback-coalescer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
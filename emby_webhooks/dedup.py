@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class WebhookDeduplicator:
+    """记录最近处理过的 webhook 指纹，过滤 Emby 的重试请求"""
+
+    def __init__(self, ttl=600, max_entries=10000, snapshot_file=None, snapshot_interval=60):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        # 指纹 -> 过期时间(time.time())，按插入顺序排列，最早的在最前
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        if snapshot_file:
+            self.load_snapshot()
+
+    @staticmethod
+    def fingerprint(data):
+        """由事件类型、事件时间、媒体ID和用户ID生成指纹"""
+        item = data.get('Item') or {}
+        user = data.get('User') or {}
+        key = '\x1f'.join(str(value) for value in (
+            data.get('Event', ''),
+            data.get('Date', ''),
+            item.get('Id', ''),
+            user.get('Id', ''),
+        ))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _expire(self, now):
+        while self.entries:
+            fingerprint, expires = next(iter(self.entries.items()))
+            if expires > now:
+                break
+            del self.entries[fingerprint]
+
+    def seen(self, data):
+        """已处理过返回 True；否则记录该请求并返回 False"""
+        # 没有事件时间的请求无法区分重试和新事件，不做去重
+        if not data.get('Date'):
+            return False
+        fingerprint = self.fingerprint(data)
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            if fingerprint in self.entries:
+                self.hits += 1
+                return True
+            self.misses += 1
+            self.entries[fingerprint] = now + self.ttl
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return False
+
+    def forget(self, data):
+        """处理失败时移除记录，让 Emby 的重试可以再次处理"""
+        fingerprint = self.fingerprint(data)
+        with self.lock:
+            self.entries.pop(fingerprint, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+    def load_snapshot(self):
+        """从快照恢复未过期的指纹"""
+        if not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"加载去重快照失败: {e}")
+            return
+        now = time.time()
+        with self.lock:
+            for fingerprint, expires in sorted(snapshot.items(), key=lambda pair: pair[1]):
+                if expires > now:
+                    self.entries[fingerprint] = expires
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save_snapshot(self):
+        """原子写入快照文件"""
+        if not self.snapshot_file:
+            return
+        with self.lock:
+            self._expire(time.time())
+            snapshot = dict(self.entries)
+        tmp_path = self.snapshot_file + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.snapshot_file)
+        except OSError as e:
+            print(f"保存去重快照失败: {e}")
+
+    def _run(self):
+        while not self.stop_event.wait(self.snapshot_interval):
+            self.save_snapshot()
+
+    def start(self):
+        if self.snapshot_file:
+            self.thread = threading.Thread(target=self._run, name="webhook-dedup", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.save_snapshot()
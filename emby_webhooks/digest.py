@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict
+
+LIBRARY_EVENTS = {
+    "library.new",
+    "library.deleted",
+}
+
+
+class LibraryDigest:
+    """按剧集/媒体库合并新增、删除媒体事件，定时输出一条汇总
+
+    媒体库名称通过 routing.LibraryMap 由 ParentId 和 Path 换算，同一媒体库不同文件夹的事件合并为一组。
+    """
+
+    def __init__(self, emit, window=300, quiet_period=30, max_groups=200,
+                 max_titles=500, sweep_interval=1, library_map=None):
+        self.emit = emit
+        self.library_map = library_map
+        # 从第一条事件起最多等待 window 秒
+        self.window = window
+        # 超过 quiet_period 秒没有新事件就立即输出，保证单条事件也能及时发送
+        self.quiet_period = quiet_period
+        self.max_groups = max_groups
+        self.max_titles = max_titles
+        self.sweep_interval = sweep_interval
+        self.groups = OrderedDict()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def handles(event_type):
+        return event_type in LIBRARY_EVENTS
+
+    def library_name(self, item):
+        """项目所属的媒体库名称，未配置时为空"""
+        if self.library_map is None:
+            return ''
+        names = self.library_map.library_names(item)
+        return min(names) if names else ''
+
+    def group_key(self, data, library=''):
+        """同一剧集的事件合并，否则按媒体库合并，媒体库未知时按所在文件夹合并"""
+        item = data.get('Item') or {}
+        series = item.get('SeriesName') or item.get('SeriesId')
+        if series:
+            return (data.get('Event'), 'series', str(series))
+        if library:
+            return (data.get('Event'), 'library', library)
+        parent = item.get('ParentId')
+        if parent:
+            return (data.get('Event'), 'folder', str(parent))
+        return (data.get('Event'), 'other', '')
+
+    @staticmethod
+    def item_title(data):
+        item = data.get('Item') or {}
+        name = item.get('Name') or data.get('Title') or '未知'
+        season = item.get('ParentIndexNumber')
+        episode = item.get('IndexNumber')
+        if season is not None and episode is not None:
+            return f"S{season:02d}E{episode:02d} {name}"
+        return name
+
+    def add(self, data):
+        item = data.get('Item') or {}
+        library = self.library_name(item)
+        key = self.group_key(data, library)
+        now = time.monotonic()
+        overflow = []
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = {
+                    'data': data,
+                    'group_name': item.get('SeriesName') or '',
+                    'library_name': library,
+                    'titles': [],
+                    'count': 0,
+                    'first_seen': now,
+                }
+                self.groups[key] = group
+                while len(self.groups) > self.max_groups:
+                    _, evicted = self.groups.popitem(last=False)
+                    overflow.append(evicted)
+            group['count'] += 1
+            group['last_seen'] = now
+            if len(group['titles']) < self.max_titles:
+                group['titles'].append(self.item_title(data))
+
+        for evicted in overflow:
+            self._emit(evicted)
+
+    def _due(self, group, now):
+        return (now - group['last_seen'] >= self.quiet_period
+                or now - group['first_seen'] >= self.window)
+
+    def sweep(self):
+        """输出已到期的分组"""
+        now = time.monotonic()
+        with self.lock:
+            due = [key for key, group in self.groups.items() if self._due(group, now)]
+            ready = [self.groups.pop(key) for key in due]
+        for group in ready:
+            self._emit(group)
+        return len(ready)
+
+    def flush(self):
+        with self.lock:
+            remaining = list(self.groups.values())
+            self.groups.clear()
+        for group in remaining:
+            self._emit(group)
+
+    def _emit(self, group):
+        try:
+            self.emit({
+                'data': group['data'],
+                'group_name': group['group_name'],
+                'library_name': group['library_name'],
+                'titles': group['titles'],
+                'count': group['count'],
+            })
+        except Exception as e:
+            print(f"输出媒体库汇总失败: {e}")
+
+    def _run(self):
+        while not self.stop_event.wait(self.sweep_interval):
+            self.sweep()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="library-digest", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
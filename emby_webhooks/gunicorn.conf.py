@@ -0,0 +1,20 @@
+# 生产环境运行: gunicorn -c gunicorn.conf.py wsgi:app
+# gevent worker 在单个事件循环中处理大量并发请求，requests 等阻塞调用会被自动协程化
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.getenv('FLASK_HOST') or '0.0.0.0'}:{os.getenv('FLASK_PORT', 5003)}"
+worker_class = 'gevent'
+# 磁盘发送队列和播放事件合并状态都在进程内，保持单进程
+workers = 1
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+graceful_timeout = 30
+
+
+def worker_exit(server, worker):
+    """worker 退出前等待发送中的消息完成"""
+    from app import stop_background_workers
+    stop_background_workers()
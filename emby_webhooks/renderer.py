@@ -0,0 +1,314 @@
+import html
+import json
+from datetime import datetime, timezone
+from functools import lru_cache
+from string import Formatter
+
+# 事件类型 -> 中文名称
+NOTIFICATION_TYPES = {
+    # 播放相关
+    "playback.start": "开始播放",
+    "playback.stop": "停止播放",
+    "playback.pause": "暂停播放",
+    "playback.unpause": "继续播放",
+    "playback.progress": "播放进度",
+
+    # 系统相关
+    "system.webhooktest": "系统测试",
+    "system.notificationtest": "通知测试",
+    "system.wakingup": "系统唤醒",
+    "system.shuttingdown": "系统关闭",
+    "system.resumed": "系统恢复",
+    "system.update.available": "系统更新可用",
+    "system.updateavailable": "系统更新可用",
+    "system.update.installed": "系统更新完成",
+    "system.serverrestartrequired": "服务器需要重启",
+
+    # 库相关
+    "library.new": "新增媒体",
+    "library.update": "库更新",
+    "library.deleted": "删除媒体",
+    "library.scanning": "库扫描中",
+    "library.scancomplete": "库扫描完成",
+
+    # 用户相关
+    "user.login": "用户登录",
+    "user.logout": "用户登出",
+    "user.new": "新用户创建",
+    "user.delete": "用户删除",
+    "user.authenticated": "用户验证成功",
+    "user.authentication.success": "用户验证成功",
+    "user.authenticationfailed": "用户认证失败",
+    "user.authenticationerror": "用户认证错误",
+    "user.password.reset": "用户密码重置",
+    "user.policyupdated": "用户策略更新",
+
+    # 会话相关
+    "session.start": "会话开始",
+    "session.end": "会话结束",
+    "session.timeout": "会话超时",
+
+    # 设备相关
+    "device.new": "新设备连接",
+    "device.delete": "设备移除",
+
+    # 任务相关
+    "task.completed": "任务完成",
+    "task.failed": "任务失败",
+
+    # 转码相关
+    "transcoding.start": "开始转码",
+    "transcoding.end": "转码完成",
+    "transcoding.error": "转码错误",
+
+    # 插件相关
+    "plugins.pluginupdated": "插件已更新",
+    "plugins.plugininstalled": "插件已安装",
+
+    # 项目相关
+    "item.rate": "项目评分",
+
+    # 本服务生成的汇总消息
+    "playback.summary": "播放汇总",
+}
+
+# 模板中可用的字段
+TEMPLATE_FIELDS = {
+    "event_type", "notification_type", "server_name", "server_label", "server_version",
+    "user_name", "device_name", "title", "description", "event_time", "notify_time",
+    "steps", "group_name", "library_name", "count", "page", "titles",
+}
+
+# 每行模板中任一字段为空时整行省略；字段值会做 HTML 转义，模板文字本身不转义
+DEFAULT_TEMPLATE = [
+    "<b>🎬 Emby 通知</b>",
+    "📺 服务器: {server_label}",
+    "📝 类型: {notification_type}",
+    "👤 用户: {user_name}",
+    "🎵 标题: {title}",
+    "📝 描述: {description}",
+    "⏰ 事件时间: {event_time}",
+    "⌚ 通知时间: {notify_time}",
+]
+
+DEFAULT_TEMPLATES = {
+    "default": DEFAULT_TEMPLATE,
+    "playback.summary": [
+        "<b>🎬 Emby 通知</b>",
+        "📺 服务器: {server_name}",
+        "📝 类型: {notification_type}",
+        "👤 用户: {user_name}",
+        "📱 设备: {device_name}",
+        "🎵 标题: {title}",
+        "▶️ 过程: {steps}",
+        "⌚ 通知时间: {notify_time}",
+    ],
+    "library.digest": [
+        "<b>🎬 Emby 通知</b>",
+        "📺 服务器: {server_label}",
+        "📝 类型: {notification_type}",
+        "📂 剧集: {group_name}",
+        "🗂 媒体库: {library_name}",
+        "🔢 数量: {count}",
+        "📄 分页: {page}",
+        "{titles}",
+        "⌚ 通知时间: {notify_time}",
+    ],
+}
+
+LINE_SEPARATOR = "\n\n"
+
+# Telegram 单条消息最大长度
+MAX_MESSAGE_LENGTH = 4096
+
+
+def format_notification_type(notification_type):
+    """格式化通知类型"""
+    name = NOTIFICATION_TYPES.get(notification_type)
+    if name is None:
+        return f"未知事件({notification_type})"
+    return name
+
+
+@lru_cache(maxsize=4096)
+def format_event_date(event_date):
+    """把 Emby 的 ISO 时间转换为本地时间字符串，结果按原字符串缓存"""
+    try:
+        # Emby 时间形如 2024-01-01T12:00:00.0000000Z，小数位超过 6 位时 fromisoformat 无法解析
+        if len(event_date) >= 20 and event_date[10] == 'T' and event_date.endswith('Z'):
+            dt = datetime(
+                int(event_date[0:4]), int(event_date[5:7]), int(event_date[8:10]),
+                int(event_date[11:13]), int(event_date[14:16]), int(event_date[17:19]),
+                tzinfo=timezone.utc
+            )
+        else:
+            dt = datetime.fromisoformat(event_date.replace('Z', '+00:00'))
+        return dt.astimezone().strftime('%Y-%m-%d %H:%M:%S')
+    except (ValueError, TypeError, AttributeError) as e:
+        print(f"时间格式化错误: {e}")
+        return ''
+
+
+def escape_truncated(text, limit):
+    """转义 HTML 并截断到 limit 个字符以内，截断点落在原文字符之间，不会切开 &amp; 等实体"""
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    pieces = []
+    size = 0
+    for char in text:
+        piece = html.escape(char)
+        if size + len(piece) > limit:
+            break
+        pieces.append(piece)
+        size += len(piece)
+    return ''.join(pieces)
+
+
+def compile_line(line):
+    """把单行模板编译为渲染函数，返回 None 表示该行被省略"""
+    literals = []
+    fields = []
+    for literal, field_name, format_spec, conversion in Formatter().parse(line):
+        literals.append(literal)
+        if field_name is not None:
+            if field_name not in TEMPLATE_FIELDS:
+                raise ValueError(f"未知模板字段: {field_name}")
+            if format_spec or conversion:
+                raise ValueError(f"模板字段不支持格式说明: {field_name}")
+            fields.append(field_name)
+
+    if not fields:
+        text = ''.join(literals)
+        return lambda context: text
+
+    trailing = literals[len(fields)] if len(literals) > len(fields) else ''
+    pairs = list(zip(literals, fields))
+
+    def render(context):
+        parts = []
+        for literal, field in pairs:
+            value = context.get(field)
+            if not value:
+                return None
+            parts.append(literal)
+            parts.append(value)
+        parts.append(trailing)
+        return ''.join(parts)
+
+    return render
+
+
+def compile_template(lines):
+    """把整条消息模板编译为渲染函数"""
+    renderers = [compile_line(line) for line in lines]
+
+    def render(context):
+        rendered = [line for line in (r(context) for r in renderers) if line is not None]
+        return LINE_SEPARATOR.join(rendered)
+
+    return render
+
+
+class MessageRenderer:
+    """启动时编译各事件的消息模板，可通过 JSON 配置文件覆盖"""
+
+    def __init__(self, default_server_name=None, now_func=None, template_file=None):
+        self.default_server_name = default_server_name
+        self.now_func = now_func
+        templates = dict(DEFAULT_TEMPLATES)
+        if template_file:
+            templates.update(self.load_templates(template_file))
+        self.compiled = {}
+        for event_type, lines in templates.items():
+            try:
+                self.compiled[event_type] = compile_template(lines)
+            except ValueError as e:
+                print(f"模板 {event_type} 编译失败，使用默认模板: {e}")
+                self.compiled[event_type] = compile_template(DEFAULT_TEMPLATES.get(event_type, DEFAULT_TEMPLATE))
+        self.default = self.compiled["default"]
+
+    @staticmethod
+    def load_templates(template_file):
+        """读取模板配置文件，格式: {"事件类型或 default": ["行1", "行2", ...]}"""
+        try:
+            with open(template_file, 'r', encoding='utf-8') as f:
+                templates = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"加载消息模板失败: {e}")
+            return {}
+        if not isinstance(templates, dict):
+            print("消息模板文件格式错误，应为 JSON 对象")
+            return {}
+        return {key: value for key, value in templates.items()
+                if isinstance(value, list) and all(isinstance(line, str) for line in value)}
+
+    def context(self, data, **extra):
+        """从 webhook 数据中提取模板字段并做 HTML 转义"""
+        escape = html.escape
+        event_type = data.get('Event', '未知事件')
+        server_info = data.get('Server') or {}
+        server_name = server_info.get('Name') or self.default_server_name or '未知'
+        server_version = server_info.get('Version') or ''
+        user_info = data.get('User') or {}
+        session_info = data.get('Session') or {}
+        title = data.get('Title') or ''
+        event_date = data.get('Date')
+
+        server_label = server_name
+        if server_version:
+            server_label = f"{server_name} (v{server_version})"
+
+        context = {
+            "event_type": escape(str(event_type)),
+            "notification_type": escape(format_notification_type(event_type)),
+            "server_name": escape(str(server_name)),
+            "server_label": escape(str(server_label)),
+            "server_version": escape(str(server_version)),
+            "user_name": escape(str(user_info.get('Name') or '')),
+            "device_name": escape(str(session_info.get('DeviceName') or '')),
+            "title": escape(str(title)),
+            "description": escape(str(data.get('Description') or '')),
+            "event_time": format_event_date(event_date) if isinstance(event_date, str) else '',
+            "notify_time": self.now_func() if self.now_func else '',
+        }
+        for key, value in extra.items():
+            context[key] = escape(str(value)) if value else ''
+        return context
+
+    def render(self, event_type, context):
+        return self.compiled.get(event_type, self.default)(context)
+
+    def format_message(self, data, **extra):
+        return self.render(data.get('Event'), self.context(data, **extra))
+
+    def format_paged(self, template_key, data, items, field='titles', **extra):
+        """把 items 逐行填入 field 字段，超过 Telegram 长度限制时拆成多条消息"""
+        context = self.context(data, **extra)
+        # 分页信息最长约为 "99/99"，先按此预留长度；emoji 在 Telegram 中按两个字符计算，再留少量余量
+        context['page'] = '99/99'
+        context[field] = ' '
+        budget = MAX_MESSAGE_LENGTH - len(self.render(template_key, context)) - 32
+
+        pages = []
+        current = []
+        size = 0
+        for item in items:
+            line = escape_truncated(str(item), budget)
+            extra_size = len(line) + (1 if current else 0)
+            if current and size + extra_size > budget:
+                pages.append(current)
+                current = []
+                extra_size = len(line)
+                size = 0
+            current.append(line)
+            size += extra_size
+        if current or not pages:
+            pages.append(current)
+
+        messages = []
+        for index, page in enumerate(pages, 1):
+            context[field] = '\n'.join(page)
+            context['page'] = f"{index}/{len(pages)}" if len(pages) > 1 else ''
+            messages.append(self.render(template_key, context))
+        return messages
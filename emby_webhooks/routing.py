@@ -0,0 +1,150 @@
+import json
+
+
+class LibraryMap:
+    """媒体库名称 -> 文件夹ID / 路径前缀
+
+    Emby 的 webhook 中项目不带媒体库名称，只有 ParentId(所在文件夹)和 Path，
+    按配置把这两个字段换算成媒体库名称后再匹配规则。
+    """
+
+    def __init__(self, libraries=None):
+        # 文件夹ID -> 媒体库名称集合
+        self.folder_ids = {}
+        # (路径前缀, 媒体库名称)，长前缀在前
+        self.paths = []
+        for name, config in (libraries or {}).items():
+            for folder_id in config.get('parent_ids', ()):
+                self.folder_ids.setdefault(str(folder_id), set()).add(name)
+            for prefix in config.get('paths', ()):
+                self.paths.append((self._normalize(prefix).rstrip('/') + '/', name))
+        self.paths.sort(key=lambda pair: len(pair[0]), reverse=True)
+
+    @staticmethod
+    def _normalize(path):
+        return str(path).replace('\\', '/')
+
+    def library_names(self, item):
+        """项目所属的媒体库名称"""
+        names = set()
+        for key in ('ParentId', 'SeriesId'):
+            folder_id = item.get(key)
+            if folder_id is not None:
+                names.update(self.folder_ids.get(str(folder_id), ()))
+        path = item.get('Path')
+        if path:
+            path = self._normalize(path)
+            for prefix, name in self.paths:
+                if path.startswith(prefix):
+                    names.add(name)
+        return names
+
+    def resolve(self, item):
+        """项目所属的媒体库名称，以及原始的 ParentId(规则也可以直接写文件夹ID)"""
+        names = self.library_names(item)
+        if item.get('ParentId') is not None:
+            names.add(str(item['ParentId']))
+        return names
+
+
+class Rule:
+    """一条路由规则，未配置的条件视为匹配任意值"""
+
+    def __init__(self, chat_id, events=None, users=None, libraries=None, servers=None):
+        self.chat_id = str(chat_id)
+        self.events = list(events or [])
+        self.users = set(users or [])
+        self.libraries = set(libraries or [])
+        self.servers = set(servers or [])
+
+    def matches(self, data, libraries=()):
+        """libraries 为 LibraryMap.resolve 得到的媒体库名称"""
+        if self.users:
+            user = data.get('User') or {}
+            if user.get('Name') not in self.users and user.get('Id') not in self.users:
+                return False
+        if self.libraries and not self.libraries.intersection(libraries):
+            return False
+        if self.servers:
+            server = data.get('Server') or {}
+            if server.get('Name') not in self.servers and server.get('Id') not in self.servers:
+                return False
+        return True
+
+
+class EventRouter:
+    """按事件类型建立规则索引，每个事件只检查可能匹配的规则"""
+
+    def __init__(self, rules, default_chat_id=None, library_map=None):
+        self.default_chat_id = default_chat_id
+        self.rules = rules
+        self.library_map = library_map or LibraryMap()
+        # 精确事件 -> 规则，"playback.*" 这类前缀 -> 规则，未限制事件的规则
+        self.exact = {}
+        self.prefix = {}
+        self.any_event = []
+        for order, rule in enumerate(rules):
+            if not rule.events:
+                self.any_event.append((order, rule))
+            for pattern in rule.events:
+                if pattern == '*':
+                    self.any_event.append((order, rule))
+                elif pattern.endswith('.*'):
+                    self.prefix.setdefault(pattern[:-2], []).append((order, rule))
+                else:
+                    self.exact.setdefault(pattern, []).append((order, rule))
+
+    @classmethod
+    def from_file(cls, path, default_chat_id=None):
+        """读取规则文件，格式:
+        {"libraries": {"电影": {"paths": ["/mnt/media/movies"], "parent_ids": ["3"]}},
+         "rules": [{"chat_id": "...", "events": ["playback.*"], "users": [...], "libraries": ["电影"]}]}
+        也可以只写规则列表
+        """
+        if not path:
+            return cls([], default_chat_id)
+        library_map = None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            if isinstance(config, dict):
+                library_map = LibraryMap(config.get('libraries'))
+                config = config.get('rules', [])
+            rules = [Rule(
+                item['chat_id'],
+                events=item.get('events'),
+                users=item.get('users'),
+                libraries=item.get('libraries'),
+                servers=item.get('servers'),
+            ) for item in config]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"加载路由规则失败，全部发送到默认聊天: {e}")
+            rules = []
+            library_map = None
+        return cls(rules, default_chat_id, library_map)
+
+    def candidates(self, event_type):
+        found = list(self.exact.get(event_type, ()))
+        # "a.b.c" 依次检查前缀 "a.b" 和 "a"
+        prefix = event_type
+        while '.' in prefix:
+            prefix = prefix.rsplit('.', 1)[0]
+            found.extend(self.prefix.get(prefix, ()))
+        found.extend(self.any_event)
+        found.sort(key=lambda pair: pair[0])
+        return [rule for _, rule in found]
+
+    def route(self, data):
+        """返回需要发送到的聊天ID列表(去重且保持规则顺序)，无匹配时使用默认聊天"""
+        chat_ids = []
+        libraries = None
+        for rule in self.candidates(data.get('Event', '')):
+            if rule.chat_id in chat_ids:
+                continue
+            if rule.libraries and libraries is None:
+                libraries = self.library_map.resolve(data.get('Item') or {})
+            if rule.matches(data, libraries or ()):
+                chat_ids.append(rule.chat_id)
+        if not chat_ids and self.default_chat_id:
+            chat_ids.append(str(self.default_chat_id))
+        return chat_ids
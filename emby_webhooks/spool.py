@@ -0,0 +1,165 @@
+import json
+import os
+import queue
+import signal
+import threading
+import time
+import uuid
+
+
+class DeliverySpool:
+    """磁盘队列: 消息先落盘再由后台线程池发送，发送成功后删除"""
+
+    def __init__(self, spool_dir, send_func, workers=2, max_attempts=8,
+                 base_delay=1.0, max_delay=300.0):
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, 'failed')
+        self.send_func = send_func
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # 按 (优先级, 记录ID) 排序，记录ID以时间戳开头
+        self.queue = queue.PriorityQueue()
+        self.stop_event = threading.Event()
+        self.threads = []
+        # 已在内存队列中的记录ID，避免重放时重复入队
+        self.queued_ids = set()
+        self.lock = threading.Lock()
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def _path(self, entry_id):
+        return os.path.join(self.spool_dir, f"{entry_id}.json")
+
+    def _write(self, entry):
+        """原子写入单条记录(先写临时文件再重命名)"""
+        path = self._path(entry['id'])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def enqueue(self, message, priority=1, chat_id=None):
+        """追加消息到磁盘队列，返回记录ID；priority 越小越先发送，chat_id 为空时发送到默认聊天"""
+        # 时间戳前缀保证重放时按入队顺序发送
+        entry_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        entry = {'id': entry_id, 'message': message, 'priority': priority, 'chat_id': chat_id, 'attempts': 0}
+        self._write(entry)
+        with self.lock:
+            self.queued_ids.add(entry_id)
+        self._put(entry)
+        return entry_id
+
+    def replay(self):
+        """启动时重新加载上次未发送的消息"""
+        count = 0
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if name.endswith('.tmp'):
+                # 写入中途崩溃留下的残片
+                os.remove(path)
+                continue
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"读取队列记录失败 {name}: {e}")
+                continue
+            with self.lock:
+                if entry['id'] in self.queued_ids:
+                    continue
+                self.queued_ids.add(entry['id'])
+            self._put(entry)
+            count += 1
+        return count
+
+    def _put(self, entry):
+        self.queue.put((entry.get('priority', 1), entry['id'], entry))
+
+    def pending(self):
+        """队列中尚未发送的消息数"""
+        return self.queue.qsize()
+
+    def _backoff(self, attempts):
+        return min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+
+    def _deliver(self, entry):
+        try:
+            success = self.send_func(entry['message'], entry.get('priority', 1), entry.get('chat_id'))
+        except Exception as e:
+            print(f"发送队列消息异常: {e}")
+            success = False
+
+        if success:
+            try:
+                os.remove(self._path(entry['id']))
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                self.queued_ids.discard(entry['id'])
+            return
+
+        entry['attempts'] = entry.get('attempts', 0) + 1
+        if entry['attempts'] >= self.max_attempts:
+            # 超过重试次数，移入 failed 目录留待人工处理
+            print(f"消息 {entry['id']} 重试 {entry['attempts']} 次仍失败，已放弃")
+            os.replace(self._path(entry['id']),
+                       os.path.join(self.failed_dir, f"{entry['id']}.json"))
+            with self.lock:
+                self.queued_ids.discard(entry['id'])
+            return
+
+        self._write(entry)
+        delay = self._backoff(entry['attempts'])
+        # 延迟后重新入队，期间不占用工作线程
+        timer = threading.Timer(delay, self._put, args=(entry,))
+        timer.daemon = True
+        timer.start()
+
+    def _worker(self):
+        while not self.stop_event.is_set():
+            try:
+                _, _, entry = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._deliver(entry)
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        """重放遗留消息并启动工作线程"""
+        replayed = self.replay()
+        if replayed:
+            print(f"重放 {replayed} 条未发送消息")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"spool-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=10.0):
+        """停止接收新任务，等待正在发送的消息完成；未发送的留在磁盘上"""
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self.threads = []
+
+    def install_signal_handlers(self, *cleanups):
+        """收到 SIGTERM/SIGINT 时优雅退出，cleanups 在停止发送线程前依次调用"""
+        def handle(signum, frame):
+            print(f"收到信号 {signum}，等待发送中的消息完成...")
+            for cleanup in cleanups:
+                try:
+                    cleanup()
+                except Exception as e:
+                    print(f"退出清理失败: {e}")
+            self.stop()
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, handle)
+        signal.signal(signal.SIGINT, handle)
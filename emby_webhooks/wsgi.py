@@ -0,0 +1,4 @@
+"""生产环境入口: gunicorn -c gunicorn.conf.py wsgi:app"""
+from app import app, start_background_workers
+
+start_background_workers()
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+
+from telegram import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+
+
+def to_input_media(message, caption=None, caption_entities=None):
+    """把相册中的一条消息转换为 send_media_group 使用的 InputMedia，不支持的类型返回 None"""
+    kwargs = {'caption': caption, 'caption_entities': caption_entities}
+    if message.photo:
+        return InputMediaPhoto(message.photo[-1].file_id, has_spoiler=message.has_media_spoiler, **kwargs)
+    if message.video:
+        return InputMediaVideo(message.video.file_id, has_spoiler=message.has_media_spoiler, **kwargs)
+    if message.document:
+        return InputMediaDocument(message.document.file_id, **kwargs)
+    if message.audio:
+        return InputMediaAudio(message.audio.file_id, **kwargs)
+    return None
+
+
+class MediaGroupCollector:
+    """按 media_group_id 收集相册中的消息
+
+    Telegram 把相册拆成多条更新依次送达，多副本部署时可能分散到不同副本；
+    消息保存在状态存储中，最后一条到达 delay 秒后认为相册已完整，
+    按消息ID排序后交给 on_complete(messages) 一次处理。
+    每个收到相册消息的进程都设置定时器，由存储决定谁取出消息: 其他副本刚收到新消息时
+    重新等待，已被其他副本取走时得到空列表。
+    """
+
+    def __init__(self, on_complete, store, delay=1.0):
+        self.on_complete = on_complete
+        self.store = store
+        self.delay = delay
+        # (chat_id, media_group_id) -> [定时器, bot]
+        self.timers = {}
+        self.tasks = set()
+
+    async def add(self, message):
+        await self.store.media_group_add(message.chat_id, message.media_group_id, message)
+        self._schedule((message.chat_id, message.media_group_id), self.delay, message.get_bot())
+
+    def _schedule(self, key, delay, bot):
+        entry = self.timers.get(key)
+        if entry is not None:
+            entry[0].cancel()
+        self.timers[key] = [asyncio.get_running_loop().call_later(delay, self._complete, key), bot]
+
+    def _complete(self, key, quiet=None):
+        _, bot = self.timers.pop(key)
+        task = asyncio.ensure_future(self._run(key, bot, self.delay if quiet is None else quiet))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, key, bot, quiet):
+        try:
+            wait, messages = await self.store.media_group_take(*key, quiet, bot)
+            if wait > 0:
+                if key not in self.timers:
+                    self._schedule(key, wait, bot)
+                return
+            if messages:
+                messages.sort(key=lambda message: message.message_id)
+                await self.on_complete(messages)
+        except Exception as e:
+            logging.error(f"处理相册时出错: {e}")
+
+    async def flush(self):
+        """立即处理所有未完成的相册并等待处理结束(退出前调用)"""
+        for key, (timer, _) in list(self.timers.items()):
+            timer.cancel()
+            self._complete(key, quiet=0)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
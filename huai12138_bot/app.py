@@ -1,11 +1,24 @@
 import logging
 import asyncio
-import time
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from block import BlockManager
-from dotenv import load_dotenv
+import datetime
 import os
+import sys
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes
+
+# 共享模块位于仓库根目录的 common 目录
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from rate_limiter import TelegramRateLimiter
+from bot_rate_limiter import BotRateLimiter
+from block import BlockManager, JournaledUserSet
+from verification import VerificationScheduler
+from reply_index import ReplyIndex
+from state_store import LocalStateStore, RedisStateStore, StateUpdateProcessor
+from album import MediaGroupCollector, to_input_media
+from broadcast import BroadcastCheckpoint, BroadcastManager
+from archive import MessageArchive
+from flood import FloodControl, ALLOW, BLOCK
+from dotenv import load_dotenv
 
 # 加载环境变量
 load_dotenv()
@@ -24,11 +37,88 @@ ADMIN_ID = os.getenv('ADMIN_ID')
 if not TOKEN or not ADMIN_ID:
     raise ValueError("请在.env文件中设置 BOT_TOKEN 和 ADMIN_ID")
 
-# 替换 BANNED_USERS 集合
-block_manager = BlockManager()
+# 新用户验证超时秒数
+VERIFICATION_TIMEOUT = int(os.getenv('VERIFICATION_TIMEOUT', 30))
+
+# 每个用户转发给管理员的速度限制，超出的消息汇总后告知管理员；令牌桶由状态存储保存
+flood_control = FloodControl(
+    rate=float(os.getenv('FLOOD_RATE', 0.5)),
+    burst=int(os.getenv('FLOOD_BURST', 5)),
+    block_threshold=int(os.getenv('FLOOD_BLOCK_THRESHOLD', 0)),
+    idle_ttl=float(os.getenv('FLOOD_IDLE_TTL', 600))
+)
+
+# 状态存储: local 保存在本进程和本地文件中(单副本)，redis 供多个副本共享
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'local').lower()
+if STATE_BACKEND == 'redis':
+    state_store = RedisStateStore(
+        os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+        prefix=os.getenv('REDIS_PREFIX', 'huai12138_bot'),
+        verification_timeout=VERIFICATION_TIMEOUT,
+        reply_ttl=int(os.getenv('REPLY_INDEX_TTL', 30 * 86400)),
+        flood_control=flood_control
+    )
+else:
+    state_store = LocalStateStore(
+        # 封禁操作先写日志，后台线程合并 fsync 并定期压缩为快照
+        BlockManager(
+            fsync_interval=float(os.getenv('BLOCK_FSYNC_INTERVAL', 0.5)),
+            compact_threshold=int(os.getenv('BLOCK_COMPACT_THRESHOLD', 1000))
+        ),
+        # 给管理员发过消息的用户，广播的接收者
+        JournaledUserSet(
+            os.getenv('KNOWN_USERS_FILE', 'known_users.json'),
+            fsync_interval=float(os.getenv('BLOCK_FSYNC_INTERVAL', 0.5)),
+            compact_threshold=int(os.getenv('BLOCK_COMPACT_THRESHOLD', 1000))
+        ),
+        # 管理员聊天中的消息(用户信息和转发的消息) -> 来源用户ID，用于回复、/ban、/unban
+        ReplyIndex(
+            os.getenv('REPLY_INDEX_FILE', 'reply_index.log'),
+            max_entries=int(os.getenv('REPLY_INDEX_SIZE', 10000))
+        ),
+        # 需要验证的用户及其截止时间，由一个后台任务统一检查，重启后恢复
+        VerificationScheduler(
+            os.getenv('VERIFICATION_FILE', 'pending_verification.json'),
+            timeout=VERIFICATION_TIMEOUT
+        ),
+        flood_control=flood_control,
+        # 广播的接收者列表和进度
+        broadcast_checkpoint=BroadcastCheckpoint(os.getenv('BROADCAST_CHECKPOINT', 'broadcast.json'))
+    )
+# 同时处理的更新数，同一用户的更新总是依次处理
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 16))
+# 已接收、正在等待用户锁或处理名额的更新数上限
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1024))
 
-# 存储需要验证的用户和验证开始时间
-pending_verification = {}  # 格式: {user_id: start_time}
+# 群发消息，进度写入状态存储，重启后(redis 模式下由任一副本)继续
+broadcast_manager = BroadcastManager(
+    state_store,
+    concurrency=int(os.getenv('BROADCAST_CONCURRENCY', 10))
+)
+
+# 用户消息和管理员回复的全文检索存档，后台线程批量写入；redis 模式下各副本共用同一个数据库文件
+message_archive = MessageArchive(os.getenv('ARCHIVE_DB', 'archive.db'))
+ARCHIVE_PAGE_SIZE = int(os.getenv('ARCHIVE_PAGE_SIZE', 10))
+
+FLOOD_SUMMARY_DELAY = float(os.getenv('FLOOD_SUMMARY_DELAY', 10))
+# 已安排发送限流汇总的用户
+flood_summary_pending = set()
+flood_summary_tasks = set()
+
+def archive_record(user_id, direction, message):
+    """记录到会话存档"""
+    message_archive.record(user_id, direction, message)
+
+async def resolve_reply_user(reply_to_message):
+    """找出管理员回复的消息来自哪个用户，找不到返回 None"""
+    user_id = await state_store.reply_index_get(reply_to_message.message_id)
+    if user_id is not None:
+        return user_id
+    # 索引建立之前的消息，从用户信息文本中解析
+    original_text = reply_to_message.text or reply_to_message.caption or ''
+    if "用户ID: " in original_text:
+        return original_text.split("用户ID: ")[1].split("\n")[0]
+    return None
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /start 命令"""
@@ -40,39 +130,32 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # 如果用户被封禁，则不需要验证
-    if block_manager.is_blocked(user_id):
+    if await state_store.is_blocked(user_id):
         await update.message.reply_text('您已被封禁，无法使用此机器人。')
         return
         
-    # 添加用户到验证列表
-    pending_verification[user_id] = time.time()
+    # 添加用户到验证列表，重复 /start 保持原来的截止时间
+    await state_store.verification_add(user_id)
     
     # 发送验证提示
-    await update.message.reply_text('欢迎使用！请在30秒内发送 "hi" 完成验证，否则将被自动封禁。')
-    
-    # 启动验证检查任务
-    asyncio.create_task(check_verification(user_id, context))
+    await update.message.reply_text(f'欢迎使用！请在{VERIFICATION_TIMEOUT}秒内发送 "hi" 完成验证，否则将被自动封禁。')
 
-async def check_verification(user_id: str, context: ContextTypes.DEFAULT_TYPE):
-    """检查用户是否在30秒内完成验证"""
-    await asyncio.sleep(30)  # 等待30秒
-    
+async def verification_expired(user_id: str, bot):
+    """用户未能在规定时间内完成验证"""
     # 如果是管理员，不进行封禁
     if user_id == ADMIN_ID:
-        if user_id in pending_verification:
-            del pending_verification[user_id]
         return
     
-    if user_id in pending_verification:
-        # 用户未能完成验证
-        del pending_verification[user_id]
-        block_manager.block_user(user_id)
-        
-        try:
-            await context.bot.send_message(user_id, "您未能在30秒内完成验证，已被自动封禁。")
-            await context.bot.send_message(ADMIN_ID, f"用户 {user_id} 未能完成验证，已被自动封禁。")
-        except Exception as e:
-            logging.error(f"发送封禁通知时出错: {e}")
+    # 与该用户正在处理的消息依次进行；封禁生效后才移出验证队列，期间的消息不会被当作已验证
+    async with state_store.user_lock(user_id):
+        if not await state_store.verification_expire(user_id):
+            return
+    
+    try:
+        await bot.send_message(user_id, f"您未能在{VERIFICATION_TIMEOUT}秒内完成验证，已被自动封禁。")
+        await bot.send_message(ADMIN_ID, f"用户 {user_id} 未能完成验证，已被自动封禁。")
+    except Exception as e:
+        logging.error(f"发送封禁通知时出错: {e}")
 
 async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /ban 命令"""
@@ -83,10 +166,9 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # 检查是否是回复消息
         if update.message.reply_to_message:
-            original_text = update.message.reply_to_message.text
-            if "用户ID: " in original_text:
-                user_id = original_text.split("用户ID: ")[1].split("\n")[0]
-                block_manager.block_user(user_id)
+            user_id = await resolve_reply_user(update.message.reply_to_message)
+            if user_id:
+                await state_store.block_user(user_id)
                 await update.message.reply_text(f"已封禁用户 {user_id}")
                 await context.bot.send_message(user_id, "您已被管理员封禁。")
                 return
@@ -97,7 +179,7 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             
         user_id = context.args[0]
-        block_manager.block_user(user_id)
+        await state_store.block_user(user_id)
         await update.message.reply_text(f"已封禁用户 {user_id}")
         await context.bot.send_message(user_id, "您已被管理员封禁。")
     except Exception as e:
@@ -112,10 +194,9 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # 检查是否是回复消息
         if update.message.reply_to_message:
-            original_text = update.message.reply_to_message.text
-            if "用户ID: " in original_text:
-                user_id = original_text.split("用户ID: ")[1].split("\n")[0]
-                if block_manager.unblock_user(user_id):
+            user_id = await resolve_reply_user(update.message.reply_to_message)
+            if user_id:
+                if await state_store.unblock_user(user_id):
                     await update.message.reply_text(f"已解封用户 {user_id}")
                     await context.bot.send_message(user_id, "您已被管理员解封。")
                 else:
@@ -128,7 +209,7 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             
         user_id = context.args[0]
-        if block_manager.unblock_user(user_id):
+        if await state_store.unblock_user(user_id):
             await update.message.reply_text(f"已解封用户 {user_id}")
             await context.bot.send_message(user_id, "您已被管理员解封。")
         else:
@@ -136,6 +217,134 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"解封用户时出错: {str(e)}")
 
+# copy: 复制消息并附上用户信息，通常只需一次 API 调用
+# forward: 先发送用户信息，再转发原消息
+FORWARD_MODE = os.getenv('FORWARD_MODE', 'copy').lower()
+# 相册最后一条消息到达后等待的秒数
+ALBUM_DELAY = float(os.getenv('ALBUM_DELAY', 1.0))
+MAX_TEXT_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+
+def format_sender_info(user, chat_id):
+    return f"来自用户: {user.first_name} (@{user.username if user.username else '无用户名'})\n" \
+           f"用户ID: {chat_id}"
+
+def utf16_length(text):
+    """Telegram 按 UTF-16 码元计算长度"""
+    return len(text.encode('utf-16-le')) // 2
+
+async def send_to_admin(message, bot):
+    """把一条用户消息发给管理员，并记录管理员聊天中的消息来自哪个用户"""
+    user_id = str(message.chat.id)
+    sender_info = format_sender_info(message.from_user, user_id)
+    # 用户信息附在原内容之后，原有的格式实体偏移不需要调整
+    footer = "\n------------------------\n" + sender_info
+
+    if FORWARD_MODE == 'forward':
+        sent = await bot.send_message(ADMIN_ID, sender_info + "\n------------------------\n")
+        forwarded = await message.forward(ADMIN_ID)
+        sent_ids = [sent.message_id, forwarded.message_id]
+    elif message.text and utf16_length(message.text + footer) <= MAX_TEXT_LENGTH:
+        sent = await bot.send_message(ADMIN_ID, message.text + footer, entities=message.entities)
+        sent_ids = [sent.message_id]
+    elif (message.photo or message.video or message.document or message.audio
+          or message.animation or message.voice) \
+            and utf16_length((message.caption or '') + footer) <= MAX_CAPTION_LENGTH:
+        copied = await message.copy(ADMIN_ID, caption=(message.caption or '') + footer,
+                                    caption_entities=message.caption_entities)
+        sent_ids = [copied.message_id]
+    else:
+        # 贴纸、位置等不能附加说明的消息，用户信息和消息副本并发发送
+        sent, copied = await asyncio.gather(
+            bot.send_message(ADMIN_ID, sender_info),
+            message.copy(ADMIN_ID)
+        )
+        sent_ids = [sent.message_id, copied.message_id]
+
+    # 管理员回复用户信息或消息副本都能找到该用户
+    for message_id in sent_ids:
+        await state_store.reply_index_add(message_id, user_id)
+
+async def send_album_to_admin(messages, bot):
+    """把相册作为一个整体发给管理员，用户信息附在第一项的说明中"""
+    first = messages[0]
+    user_id = str(first.chat.id)
+    sender_info = format_sender_info(first.from_user, user_id)
+    footer = "\n------------------------\n" + sender_info
+    caption = (first.caption or '') + footer
+    media = [to_input_media(first, caption, first.caption_entities)] + \
+            [to_input_media(message, message.caption, message.caption_entities) for message in messages[1:]]
+
+    if FORWARD_MODE != 'forward' and None not in media and utf16_length(caption) <= MAX_CAPTION_LENGTH:
+        sent = await bot.send_media_group(ADMIN_ID, media)
+        sent_ids = [message.message_id for message in sent]
+    else:
+        # 保持相册分组，整体复制/转发，另外发送用户信息
+        message_ids = [message.message_id for message in messages]
+        if FORWARD_MODE == 'forward':
+            copy_album = bot.forward_messages(ADMIN_ID, first.chat.id, message_ids)
+        else:
+            copy_album = bot.copy_messages(ADMIN_ID, first.chat.id, message_ids)
+        header, copied = await asyncio.gather(bot.send_message(ADMIN_ID, sender_info), copy_album)
+        sent_ids = [header.message_id] + [message_id.message_id for message_id in copied]
+
+    for message_id in sent_ids:
+        await state_store.reply_index_add(message_id, user_id)
+
+async def forward_album(messages):
+    """相册收齐后转发给管理员，并只回复用户一次"""
+    first = messages[0]
+    for message in messages:
+        archive_record(first.chat.id, 'in', message)
+    forwarded, _ = await asyncio.gather(
+        send_album_to_admin(messages, first.get_bot()),
+        first.reply_text("消息已转发给管理员，请等待回复。"),
+        return_exceptions=True
+    )
+    if isinstance(forwarded, Exception):
+        logging.error(f"转发相册时出错: {forwarded}")
+        await first.reply_text("转发消息时出错。")
+
+# 相册的消息保存在状态存储中，多副本时可能分到不同副本
+album_collector = MediaGroupCollector(forward_album, state_store, delay=ALBUM_DELAY)
+
+async def send_flood_summary(user_id, bot):
+    """把一段时间内被限流的消息数一次告知管理员"""
+    flood_summary_pending.discard(user_id)
+    async with state_store.user_lock(user_id):
+        count = await state_store.flood_take_suppressed(user_id)
+    if not count:
+        return
+    try:
+        sent = await bot.send_message(
+            ADMIN_ID, f"用户 {user_id} 又发送了 {count} 条消息，因发送过快未转发。\n用户ID: {user_id}\n"
+                      f"使用 /history {user_id} 查看")
+        await state_store.reply_index_add(sent.message_id, user_id)
+    except Exception as e:
+        logging.error(f"发送限流汇总时出错: {e}")
+
+def schedule_flood_summary(user_id, bot):
+    if user_id in flood_summary_pending:
+        return
+    flood_summary_pending.add(user_id)
+
+    def fire():
+        task = asyncio.ensure_future(send_flood_summary(user_id, bot))
+        flood_summary_tasks.add(task)
+        task.add_done_callback(flood_summary_tasks.discard)
+
+    asyncio.get_running_loop().call_later(FLOOD_SUMMARY_DELAY, fire)
+
+async def flood_block(user_id, bot):
+    """连续刷屏达到阈值，自动封禁"""
+    await state_store.block_user(user_id)
+    await state_store.flood_forget(user_id)
+    try:
+        await bot.send_message(user_id, "您发送消息过于频繁，已被自动封禁。")
+        await bot.send_message(ADMIN_ID, f"用户 {user_id} 刷屏，已被自动封禁。\n用户ID: {user_id}")
+    except Exception as e:
+        logging.error(f"发送封禁通知时出错: {e}")
+
 async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """将用户消息转发给管理员"""
     message = update.message
@@ -144,21 +353,24 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(chat_id)
     
     # 检查用户是否被封禁
-    if block_manager.is_blocked(user_id):
+    if await state_store.is_blocked(user_id):
         await message.reply_text("您已被封禁，无法使用此机器人。")
         return
     
     # 检查是否是待验证用户
-    if user_id in pending_verification:
+    if await state_store.verification_pending(user_id):
         # 检查是否发送了正确的验证消息
         if message.text and message.text.lower() == "hi":
-            # 验证成功
-            del pending_verification[user_id]
+            # 验证成功；超时处理已经认领了该用户时以封禁为准
+            if not await state_store.verification_cancel(user_id):
+                await message.reply_text("验证已超时。")
+                return
             await message.reply_text("验证成功！您现在可以正常使用机器人了。请直接发送消息，我会转发给管理员。")
             
             # 通知管理员
             admin_msg = f"新用户完成验证:\n用户名: {user.first_name} (@{user.username if user.username else '无用户名'})\n用户ID: {user_id}"
-            await context.bot.send_message(ADMIN_ID, admin_msg)
+            sent = await context.bot.send_message(ADMIN_ID, admin_msg)
+            await state_store.reply_index_add(sent.message_id, user_id)
             return
         else:
             # 提醒用户发送正确的验证消息
@@ -166,25 +378,34 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     
     if str(chat_id) != ADMIN_ID:  # 如果不是管理员发送的消息
-        try:
-            # 转发给管理员，并在消息前加上用户信息
-            sender_info = f"来自用户: {user.first_name} (@{user.username if user.username else '无用户名'})\n"
-            sender_info += f"用户ID: {chat_id}\n"
-            sender_info += "------------------------\n"
-            
-            # 首先发送用户信息
-            await context.bot.send_message(ADMIN_ID, sender_info)
-            # 然后转发原始消息
-            await message.forward(ADMIN_ID)
-            
-            # 保存用户ID到context，用于回复
-            if 'user_chat_ids' not in context.bot_data:
-                context.bot_data['user_chat_ids'] = {}
-            context.bot_data['user_chat_ids'][str(chat_id)] = chat_id
-            
-            await message.reply_text("消息已转发给管理员，请等待回复。")
-        except Exception as e:
-            logging.error(f"转发消息时出错: {e}")
+        # 记录用户ID，用于广播
+        await state_store.add_known_user(user_id)
+
+        # 同一相册整体计入限流，其余消息沿用第一条消息的结果
+        verdict = await state_store.flood_check(user_id, media_group_id=message.media_group_id)
+        if verdict != ALLOW:
+            archive_record(user_id, 'in', message)
+            if verdict == BLOCK:
+                await flood_block(user_id, context.bot)
+            else:
+                schedule_flood_summary(user_id, context.bot)
+            return
+
+        # 相册的多条消息收齐后一次转发
+        if message.media_group_id:
+            await album_collector.add(message)
+            return
+
+        archive_record(user_id, 'in', message)
+
+        # 转发给管理员的同时回复用户
+        forwarded, _ = await asyncio.gather(
+            send_to_admin(message, context.bot),
+            message.reply_text("消息已转发给管理员，请等待回复。"),
+            return_exceptions=True
+        )
+        if isinstance(forwarded, Exception):
+            logging.error(f"转发消息时出错: {forwarded}")
             await message.reply_text("转发消息时出错。")
     
     else:  # 如果是管理员发送的消息
@@ -192,27 +413,28 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if message.reply_to_message:
             try:
                 # 获取原始用户信息
-                original_text = message.reply_to_message.text
-                if "用户ID: " in original_text:
-                    user_id = original_text.split("用户ID: ")[1].split("\n")[0]
+                user_id = await resolve_reply_user(message.reply_to_message)
+                if user_id:
+                    command = message.text.lower() if message.text else ''
                     
                     # 检查是否是封禁命令
-                    if message.text.lower() == "/ban":
-                        block_manager.block_user(user_id)
+                    if command == "/ban":
+                        await state_store.block_user(user_id)
                         await message.reply_text(f"已封禁用户 {user_id}")
                         await context.bot.send_message(user_id, "您已被管理员封禁。")
                         return
                     # 检查是否是解封命令
-                    elif message.text.lower() == "/unban":
-                        if block_manager.unblock_user(user_id):
+                    elif command == "/unban":
+                        if await state_store.unblock_user(user_id):
                             await message.reply_text(f"已解封用户 {user_id}")
                             await context.bot.send_message(user_id, "您已被管理员解封。")
                         else:
                             await message.reply_text(f"用户 {user_id} 未被封禁")
                         return
                         
-                    # 发送普通回复消息给用户
-                    await context.bot.send_message(user_id, message.text)
+                    # 发送回复给用户，图片、贴纸等非文本消息原样复制
+                    await message.copy(user_id)
+                    archive_record(user_id, 'out', message)
                     await message.reply_text("回复已发送。")
                 else:
                     await message.reply_text("请回复包含用户ID的消息。")
@@ -220,15 +442,153 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logging.error(f"回复消息时出错: {e}")
                 await message.reply_text("发送回复时出错。")
 
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /broadcast 命令: 群发文本，或回复一条消息将其复制给所有用户"""
+    if str(update.effective_user.id) != ADMIN_ID:
+        await update.message.reply_text("只有管理员可以使用此命令。")
+        return
+
+    if broadcast_manager.running:
+        await update.message.reply_text("已有广播正在进行，请等待完成。")
+        return
+
+    reply = update.message.reply_to_message
+    # 保留原文中的换行
+    parts = (update.message.text or '').split(None, 1)
+    text = parts[1] if len(parts) > 1 else None
+    if not reply and not text:
+        await update.message.reply_text("用法: /broadcast <消息内容> 或回复要群发的消息")
+        return
+
+    recipients = sorted([user_id for user_id in await state_store.known_user_ids()
+                         if user_id != ADMIN_ID and not await state_store.is_blocked(user_id)])
+    status_message = await update.message.reply_text(f"广播开始: 0/{len(recipients)}")
+    if reply:
+        started = await broadcast_manager.start(
+            context.bot, recipients, status_message,
+            source_chat_id=reply.chat_id, source_message_id=reply.message_id,
+            is_blocked=state_store.is_blocked, on_unreachable=state_store.remove_known_user)
+    else:
+        started = await broadcast_manager.start(
+            context.bot, recipients, status_message, text=text,
+            is_blocked=state_store.is_blocked, on_unreachable=state_store.remove_known_user)
+    if not started:
+        # 其他副本上的广播正在进行或等待继续
+        await status_message.edit_text("已有广播正在进行，请等待完成。")
+
+def format_archive_page(title, rows):
+    if not rows:
+        return f"{title}\n没有找到消息。"
+    lines = [title]
+    for message_id, user_id, direction, text, created in rows:
+        arrow = '⬅️' if direction == 'in' else '➡️'
+        created = datetime.datetime.fromtimestamp(created).strftime('%Y-%m-%d %H:%M')
+        if len(text) > 200:
+            text = text[:200] + '…'
+        lines.append(f"{created} {arrow} {user_id}: {text}")
+    return '\n'.join(lines)
+
+def archive_page_markup(callback_prefix, next_before, keyword=None):
+    if next_before is None:
+        return None
+    data = f"{callback_prefix}:{next_before}"
+    # 按钮数据最长 64 字节，放得下时带上关键词，翻页可以由任一副本处理
+    if keyword is not None and len(f"{data}:{keyword}".encode()) <= 64:
+        data = f"{data}:{keyword}"
+    return InlineKeyboardMarkup([[InlineKeyboardButton("下一页", callback_data=data)]])
+
+async def archive_search_page(keyword, before_id=None):
+    rows, next_before = await asyncio.to_thread(message_archive.search, keyword, before_id, ARCHIVE_PAGE_SIZE)
+    return format_archive_page(f"🔍 {keyword}", rows), archive_page_markup("search", next_before, keyword)
+
+async def archive_history_page(user_id, before_id=None):
+    rows, next_before = await asyncio.to_thread(message_archive.history, user_id, before_id, ARCHIVE_PAGE_SIZE)
+    return format_archive_page(f"📜 用户 {user_id}", rows), archive_page_markup(f"history:{user_id}", next_before)
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /search 命令: 全文搜索会话存档"""
+    if str(update.effective_user.id) != ADMIN_ID:
+        await update.message.reply_text("只有管理员可以使用此命令。")
+        return
+
+    parts = (update.message.text or '').split(None, 1)
+    if len(parts) < 2:
+        await update.message.reply_text("用法: /search <关键词>")
+        return
+    keyword = parts[1].strip()
+    # 关键词超过按钮数据的长度限制时，翻页从 chat_data 中读取
+    context.chat_data['archive_search'] = keyword
+    text, markup = await archive_search_page(keyword)
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /history 命令: 查看某个用户的会话记录"""
+    if str(update.effective_user.id) != ADMIN_ID:
+        await update.message.reply_text("只有管理员可以使用此命令。")
+        return
+
+    if context.args:
+        user_id = context.args[0]
+    elif update.message.reply_to_message:
+        user_id = await resolve_reply_user(update.message.reply_to_message)
+    else:
+        user_id = None
+    if not user_id:
+        await update.message.reply_text("用法: /history <用户ID> 或回复该用户的消息")
+        return
+    text, markup = await archive_history_page(user_id)
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def archive_next_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理存档结果的“下一页”按钮"""
+    query = update.callback_query
+    if str(query.from_user.id) != ADMIN_ID:
+        await query.answer("只有管理员可以使用此功能。")
+        return
+    await query.answer()
+
+    parts = query.data.split(':', 2)
+    if parts[0] == 'search':
+        keyword = parts[2] if len(parts) > 2 else context.chat_data.get('archive_search')
+        if not keyword:
+            return
+        text, markup = await archive_search_page(keyword, int(parts[1]))
+    else:
+        text, markup = await archive_history_page(parts[1], int(parts[2]))
+    await query.edit_message_text(text, reply_markup=markup)
+
+async def post_init(application: Application):
+    """启动状态存储和验证截止时间检查(停机期间已超时的用户会立即处理)，继续未完成的广播"""
+    await state_store.start(lambda user_id: verification_expired(user_id, application.bot))
+    broadcast_manager.watch(application.bot, is_blocked=state_store.is_blocked,
+                            on_unreachable=state_store.remove_known_user)
+
+async def post_shutdown(application: Application):
+    """退出前转发未完成的相册，保存待验证用户、封禁日志、用户列表、回复索引和会话存档"""
+    await album_collector.flush()
+    await broadcast_manager.stop()
+    await state_store.stop()
+    message_archive.stop()
+
 def main():
     """启动机器人"""
+    message_archive.start()
+
     # 创建应用
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN) \
+        .concurrent_updates(StateUpdateProcessor(state_store, UPDATE_CONCURRENCY, UPDATE_QUEUE_SIZE)) \
+        .rate_limiter(BotRateLimiter(TelegramRateLimiter.from_env(),
+                                     acquire_timeout=float(os.getenv('TELEGRAM_ACQUIRE_TIMEOUT', 60)))) \
+        .post_init(post_init).post_shutdown(post_shutdown).build()
 
     # 添加处理程序
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("ban", ban))
     application.add_handler(CommandHandler("unban", unban))
+    application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("search", search))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CallbackQueryHandler(archive_next_page, pattern=r'^(search|history):'))
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, forward_to_admin))
 
     # 获取运行模式
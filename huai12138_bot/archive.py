@@ -0,0 +1,199 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    text, content='messages', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_grams USING fts5 (
+    grams, content='', detail=none, columnsize=0
+);
+"""
+
+# trigram 分词至少需要 3 个字符，更短的关键词查 messages_grams 中的单字和双字索引
+MIN_FTS_QUERY = 3
+
+# messages_grams 的版本，旧存档启动时补建索引
+GRAMS_VERSION = 1
+
+_STOP = object()
+
+MEDIA_KINDS = ('photo', 'video', 'document', 'audio', 'voice', 'sticker', 'animation', 'video_note',
+               'location', 'contact', 'poll')
+
+
+def gram_token(gram):
+    """单字或双字转成 FTS5 词元: 编码为十六进制，标点和空白也不会被分词器拆开"""
+    return 'g' + gram.encode('utf-8').hex()
+
+
+def short_grams(text):
+    """文本中所有不含空白的单字和双字，按 FTS5 词元拼接"""
+    text = text.lower()
+    grams = {char for char in text if not char.isspace()}
+    grams.update(text[index:index + 2] for index in range(len(text) - 1)
+                 if not text[index].isspace() and not text[index + 1].isspace())
+    return ' '.join(gram_token(gram) for gram in grams)
+
+
+def message_kind(message):
+    """消息类型: text、photo、sticker 等"""
+    for kind in MEDIA_KINDS:
+        if getattr(message, kind, None):
+            return kind
+    return 'text' if message.text else 'other'
+
+
+class MessageArchive:
+    """SQLite FTS5 会话存档
+
+    处理函数只把记录放入队列；后台线程把一段时间内的记录合并为一个事务写入，
+    查询在单独的连接上进行，按 id 倒序做键集分页。
+    3 个字符以上的关键词查 trigram 索引，更短的查单字和双字索引，都不需要全表扫描。
+    """
+
+    def __init__(self, db_path='archive.db', batch_size=500, flush_interval=1.0):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = None
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._build_grams(conn)
+        conn.close()
+
+    def _build_grams(self, conn):
+        """为建立单字和双字索引之前的存档补建索引"""
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= GRAMS_VERSION:
+            return
+        last_id = 0
+        while True:
+            rows = conn.execute('SELECT id, text FROM messages WHERE id > ? ORDER BY id LIMIT 10000',
+                                (last_id,)).fetchall()
+            if not rows:
+                break
+            with conn:
+                conn.executemany('INSERT INTO messages_grams (rowid, grams) VALUES (?, ?)',
+                                 [(message_id, short_grams(text)) for message_id, text in rows])
+            last_id = rows[-1][0]
+        conn.execute(f'PRAGMA user_version = {GRAMS_VERSION}')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def record(self, user_id, direction, message):
+        """记录一条消息: direction 为 in(用户发来) 或 out(管理员回复)"""
+        kind = message_kind(message)
+        text = message.text or message.caption or ''
+        if kind != 'text':
+            text = f"[{kind}] {text}".strip()
+        self.queue.put((str(user_id), direction, kind, text, time.time()))
+
+    def _write(self, conn, rows):
+        try:
+            with conn:
+                grams = []
+                for row in rows:
+                    cursor = conn.execute(
+                        'INSERT INTO messages (user_id, direction, kind, text, created) VALUES (?, ?, ?, ?, ?)', row)
+                    grams.append((cursor.lastrowid, short_grams(row[3])))
+                conn.executemany('INSERT INTO messages_grams (rowid, grams) VALUES (?, ?)', grams)
+        except sqlite3.Error as e:
+            logging.error(f"写入会话存档时出错: {e}")
+
+    def _run(self):
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            rows = [item]
+            # 等待 flush_interval 或凑满一批后一起写入
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                rows.append(item)
+            self._write(conn, rows)
+        # 写入停止前剩余的记录
+        rows = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                rows.append(item)
+        if rows:
+            self._write(conn, rows)
+        conn.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="message-archive", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(_STOP)
+        if self.thread:
+            self.thread.join()
+
+    def search(self, keyword, before_id=None, limit=10):
+        """全文搜索，返回 (结果列表, 下一页的 before_id 或 None)"""
+        if len(keyword) >= MIN_FTS_QUERY:
+            # 作为短语搜索，避免 FTS5 语法字符报错
+            sql = ('SELECT m.id, m.user_id, m.direction, m.text, m.created FROM messages_fts f '
+                   'JOIN messages m ON m.id = f.rowid WHERE messages_fts MATCH ?')
+            params = ['"' + keyword.replace('"', '""') + '"']
+            # 分页条件和排序放在 FTS 表的 rowid 上，由 FTS5 直接按范围倒序返回
+            return self._page(sql, params, before_id, limit, id_column='f.rowid')
+        # 单字和双字索引只记录消息是否包含该词元，分页同样按 rowid 倒序
+        sql = ('SELECT m.id, m.user_id, m.direction, m.text, m.created FROM messages_grams f '
+               'JOIN messages m ON m.id = f.rowid WHERE messages_grams MATCH ?')
+        return self._page(sql, [gram_token(keyword.lower())], before_id, limit, id_column='f.rowid')
+
+    def history(self, user_id, before_id=None, limit=10):
+        """某个用户的会话记录，返回 (结果列表, 下一页的 before_id 或 None)"""
+        sql = 'SELECT id, user_id, direction, text, created FROM messages m WHERE user_id = ?'
+        return self._page(sql, [str(user_id)], before_id, limit)
+
+    def _page(self, sql, params, before_id, limit, id_column='m.id'):
+        if before_id is not None:
+            sql += f' AND {id_column} < ?'
+            params.append(before_id)
+        sql += f' ORDER BY {id_column} DESC LIMIT ?'
+        params.append(limit + 1)
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        next_before = rows[limit - 1][0] if len(rows) > limit else None
+        return rows[:limit], next_before
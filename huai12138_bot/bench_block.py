@@ -0,0 +1,79 @@
+"""比较字符串 set 与 UserIdSet 的内存占用和查询速度
+
+用法: python bench_block.py --sizes 10000 100000 1000000 --lookups 200000
+查询中一半命中封禁ID，一半是未封禁的ID(模拟正常用户发消息)。
+另外测量持续封禁新用户时单次 add() 的最长耗时(归并是增量进行的，不应随ID数线性增长)。
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from idset import UserIdSet
+
+
+def make_ids(count, seed):
+    rng = random.Random(seed)
+    # Telegram 用户ID目前在 10 位以内
+    return [str(value) for value in rng.sample(range(10 ** 6, 8 * 10 ** 9), count)]
+
+
+def measure_memory(factory):
+    gc.collect()
+    tracemalloc.start()
+    structure = factory()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return structure, current
+
+
+def measure_lookups(structure, queries):
+    started = time.perf_counter()
+    hits = 0
+    for user_id in queries:
+        if user_id in structure:
+            hits += 1
+    elapsed = time.perf_counter() - started
+    return len(queries) / elapsed, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="封禁列表数据结构基准测试")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--lookups', type=int, default=200000)
+    parser.add_argument('--adds', type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"{'ID数':>9} {'结构':<18} {'内存(MB)':>9} {'字节/ID':>8} {'查询/秒':>12} {'命中':>7}")
+    for size in args.sizes:
+        # 字符串在各结构之外创建，内存统计只计入结构本身；str set 另加字符串本身的开销
+        ids = make_ids(size, seed=size)
+        rng = random.Random(1)
+        misses = make_ids(args.lookups // 2, seed=size + 1)
+        queries = [rng.choice(ids) for _ in range(args.lookups - len(misses))] + misses
+        rng.shuffle(queries)
+
+        candidates = [
+            ('set[str]', lambda: {str(int(user_id)) for user_id in ids}),
+            ('UserIdSet', lambda: UserIdSet(ids)),
+        ]
+        for name, factory in candidates:
+            structure, memory = measure_memory(factory)
+            rate, hits = measure_lookups(structure, queries)
+            print(f"{size:>9} {name:<18} {memory / 1e6:>9.2f} {memory / size:>8.1f} {rate:>12,.0f} {hits:>7}")
+            del structure
+
+        users = UserIdSet(ids)
+        worst = 0.0
+        started = time.perf_counter()
+        for user_id in make_ids(args.adds, seed=size + 2):
+            began = time.perf_counter()
+            users.add(user_id)
+            worst = max(worst, time.perf_counter() - began)
+        elapsed = time.perf_counter() - started
+        print(f"{size:>9} 连续 add {args.adds} 次: 平均 {elapsed / args.adds * 1e6:.1f}µs, 最长 {worst * 1e3:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""多副本共享状态测试: 多个进程通过 Redis 协议桩服务共享状态
+
+每个更新随机投递给两个副本(模拟 Telegram 重试)，检查每个更新恰好处理一次、
+同一用户的更新不会同时处理、晚到的更新照常处理并被计数，
+每个超时的待验证用户只被一个副本处理。
+更新按 --rate 的速度到达，每次投递有随机的网络延迟。
+用法: python bench_replicas.py --replicas 4 --users 50 --updates 2000 --rate 100
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from redis_stub import start_stub  # noqa: E402
+from state_store import RedisStateStore, StateUpdateProcessor  # noqa: E402
+from telegram import Chat, Message, Update, User  # noqa: E402
+
+
+def make_update(update_id, user_id):
+    user = User(user_id, 'u', False)
+    message = Message(update_id, None, Chat(user_id, 'private'), from_user=user, text='x')
+    return Update(update_id, message=message)
+
+
+async def replica(index, url, deliveries, users, results, rate, jitter):
+    store = RedisStateStore(url, prefix='bench', verification_timeout=0.5, poll_interval=0.05)
+    expired = []
+
+    async def on_expire(user_id):
+        async with store.user_lock(user_id):
+            if await store.verification_expire(user_id):
+                expired.append(user_id)
+
+    await store.start(on_expire)
+    processor = StateUpdateProcessor(store, 32)
+    processed = []
+    # 处理时在 Redis 中占用用户标记，检查跨进程的互斥；记录用户处理过的最大 update_id，统计晚到的更新
+    overlaps = 0
+    reordered = 0
+
+    async def handle(update):
+        nonlocal overlaps, reordered
+        user_id = update.effective_user.id
+        key = f"bench:busy:{user_id}"
+        if not await store.redis.set(key, index, nx=True):
+            overlaps += 1
+        last = await store.redis.get(f"bench:order:{user_id}")
+        if last is not None and update.update_id <= int(last):
+            reordered += 1
+        else:
+            await store.redis.set(f"bench:order:{user_id}", update.update_id)
+        await asyncio.sleep(random.uniform(0, 0.003))
+        await store.redis.delete(key)
+        processed.append(update.update_id)
+
+    # 每个副本都把同一批用户加入验证队列(只有第一次生效)，全部副本都会尝试认领
+    for user_id in users:
+        await store.verification_add(str(user_id))
+    started = time.perf_counter()
+
+    async def deliver(update_id, user_id):
+        # 第 update_id 个更新在 update_id / rate 秒时发出，经过随机延迟到达本副本
+        await asyncio.sleep(update_id / rate + random.uniform(0, jitter))
+        update = make_update(update_id, user_id)
+        await processor.process_update(update, handle(update))
+
+    await asyncio.gather(*(deliver(*item) for item in deliveries))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(1.5)
+    await store.stop()
+    results.put((index, processed, overlaps, expired, elapsed, reordered, processor.out_of_order))
+
+
+def run_replica(*args):
+    asyncio.run(replica(*args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多副本共享状态测试")
+    parser.add_argument('--replicas', type=int, default=4)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=100, help="每秒到达的更新数")
+    parser.add_argument('--jitter', type=float, default=0.005, help="投递的最大随机延迟秒数")
+    args = parser.parse_args()
+
+    server, url = start_stub()
+    updates = [(update_id, random.randint(1, args.users)) for update_id in range(1, args.updates + 1)]
+    deliveries = [[] for _ in range(args.replicas)]
+    for item in updates:
+        for index in random.sample(range(args.replicas), min(2, args.replicas)):
+            deliveries[index].append(item)
+    pending_users = list(range(10001, 10001 + args.users))
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_replica, args=(index, url, deliveries[index], pending_users, results,
+                                                                 args.rate, args.jitter))
+                 for index in range(args.replicas)]
+    for process in processes:
+        process.start()
+    outputs = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    processed = [update_id for output in outputs for update_id in output[1]]
+    overlaps = sum(output[2] for output in outputs)
+    expired = [user_id for output in outputs for user_id in output[3]]
+    slowest = max(output[4] for output in outputs)
+    reordered = sum(output[5] for output in outputs)
+    late = sum(output[6] for output in outputs)
+    print(f"副本: {args.replicas}  更新: {args.updates}  投递: {sum(map(len, deliveries))}")
+    for index, ids, _, users, elapsed, _, out_of_order in sorted(outputs):
+        print(f"  副本 {index}: 处理 {len(ids)} 个更新，其中 {out_of_order} 个晚到，"
+              f"认领 {len(users)} 个超时用户，用时 {elapsed:.2f}s")
+    print(f"Redis 命令数: {server.command_count}  最慢副本吞吐: {args.updates / slowest:.0f} 更新/秒  "
+          f"晚到: {late} 个")
+
+    ok = True
+    if sorted(processed) != list(range(1, args.updates + 1)):
+        print(f"错误: 处理了 {len(processed)} 次，不同更新 {len(set(processed))} 个，应为各 {args.updates} 个")
+        ok = False
+    if overlaps:
+        print(f"错误: 同一用户的更新同时处理 {overlaps} 次")
+        ok = False
+    # 晚到的更新照常处理，处理顺序的倒退次数应与处理器统计的一致
+    if reordered != late:
+        print(f"错误: 处理顺序倒退 {reordered} 次，处理器记录晚到 {late} 个")
+        ok = False
+    if sorted(expired) != [str(user_id) for user_id in pending_users]:
+        print(f"错误: 超时用户处理了 {len(expired)} 次，应为 {len(pending_users)} 次")
+        ok = False
+    print("状态一致" if ok else "状态不一致")
+    server.shutdown()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
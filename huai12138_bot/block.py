@@ -1,47 +1,251 @@
 import json
 import os
+import threading
 
-class BlockManager:
-    def __init__(self, file_path='blocked_users.json'):
+from idset import UserIdSet
+
+class JournaledUserSet:
+    """用户ID集合 = 快照文件 + 追加写入的操作日志
+
+    添加/删除只向日志追加一行("+ID" 或 "-ID")，不会阻塞事件循环；
+    后台线程合并多次写入后统一 fsync，日志条目过多时压缩为新的快照
+    (写临时文件后原子替换)。启动时加载快照，再按顺序回放日志。
+    集合保存在 UserIdSet 中(有序 int64 数组)。
+    """
+
+    def __init__(self, file_path, journal_path=None,
+                 fsync_interval=0.5, compact_threshold=1000):
         self.file_path = file_path
-        self.blocked_users = set()
-        self.load_blocked_users()
+        self.journal_path = journal_path or os.path.splitext(file_path)[0] + '.journal'
+        # 压缩过程中被轮换出来的日志，压缩完成后删除
+        self.compacting_path = self.journal_path + '.compacting'
+        # 上一次压缩未完成时轮换出的日志，稍后追加到 compacting_path
+        self.rotated_path = self.journal_path + '.rotated'
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self.users = UserIdSet()
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.journal = None
+        self.journal_entries = 0
+        self.dirty = False
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.load()
 
-    def load_blocked_users(self):
-        """从文件加载封禁用户列表"""
+    def load(self):
+        """从快照和日志加载用户列表"""
         if os.path.exists(self.file_path):
             try:
                 with open(self.file_path, 'r', encoding='utf-8') as f:
-                    self.blocked_users = set(json.load(f))
+                    self.users = UserIdSet(json.load(f))
             except Exception as e:
-                print(f"加载封禁用户列表时出错: {e}")
+                print(f"加载用户列表 {self.file_path} 时出错: {e}")
+        interrupted = os.path.exists(self.compacting_path) or os.path.exists(self.rotated_path)
+        # 上次压缩中断时，轮换出的日志可能尚未并入快照；重复回放结果相同
+        for path in (self.compacting_path, self.rotated_path, self.journal_path):
+            self.journal_entries += self._replay(path)
+        self._open_journal()
+        if interrupted or self.journal_entries:
+            # 启动时把日志并入快照，之后从空日志开始
+            self.compact()
+
+    def _replay(self, path):
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    # 最后一行可能因崩溃只写了一半
+                    if not line.endswith('\n') or len(line) < 3:
+                        continue
+                    op, user_id = line[0], line[1:-1]
+                    if op == '+':
+                        self.users.add(user_id)
+                    elif op == '-':
+                        self.users.discard(user_id)
+                    else:
+                        continue
+                    count += 1
+        except Exception as e:
+            print(f"回放日志 {path} 时出错: {e}")
+        return count
+
+    def _open_journal(self):
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _append(self, op, user_id):
+        """在持有锁时调用：写入日志(不 fsync)并唤醒后台线程"""
+        try:
+            self.journal.write(f"{op}{user_id}\n")
+            self.journal.flush()
+        except Exception as e:
+            print(f"写入日志 {self.journal_path} 时出错: {e}")
+            return
+        self.journal_entries += 1
+        self.dirty = True
+        self.condition.notify()
+
+    def save(self):
+        """把未落盘的日志 fsync 到磁盘"""
+        with self.lock:
+            if not self.dirty or self.journal is None:
+                return
+            self.dirty = False
+            journal = self.journal
+        try:
+            os.fsync(journal.fileno())
+        except Exception as e:
+            print(f"保存用户列表 {self.file_path} 时出错: {e}")
+
+    def _rotate_journal(self):
+        """在持有锁时调用：把当前日志改名移走，换一个空日志继续写
+
+        只做改名和打开文件；返回旧日志的文件对象，由调用方在锁外 fsync 并关闭。
+        """
+        self.journal.flush()
+        journal = self.journal
+        # 上一次压缩没有完成时，先放到 rotated_path，稍后接在尚未并入快照的日志之后
+        target = self.rotated_path if os.path.exists(self.compacting_path) else self.compacting_path
+        os.replace(self.journal_path, target)
+        self._open_journal()
+        return journal
+
+    def _merge_rotated(self):
+        """把 rotated_path 追加到 compacting_path；只由执行压缩的线程调用"""
+        if not os.path.exists(self.rotated_path):
+            return
+        if not os.path.exists(self.compacting_path):
+            os.replace(self.rotated_path, self.compacting_path)
+            return
+        with open(self.rotated_path, 'r', encoding='utf-8') as src, \
+                open(self.compacting_path, 'a+', encoding='utf-8') as dst:
+            dst.seek(0, os.SEEK_END)
+            if dst.tell():
+                # 崩溃留下的半行不能和追加的第一行连在一起
+                dst.seek(dst.tell() - 1)
+                if dst.read(1) != '\n':
+                    dst.write('\n')
+            dst.write(src.read())
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(self.rotated_path)
+
+    def compact(self):
+        """把当前集合写成新快照，并丢弃已并入快照的日志
 
-    def save_blocked_users(self):
-        """保存封禁用户列表到文件"""
+        锁内只轮换日志并取得集合的只读副本，序列化和 fsync 在锁外进行，不阻塞 add()。
+        """
         try:
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(list(self.blocked_users), f)
+            self._merge_rotated()
         except Exception as e:
-            print(f"保存封禁用户列表时出错: {e}")
+            print(f"合并日志 {self.rotated_path} 时出错: {e}")
+            return
+        with self.lock:
+            try:
+                old_journal = self._rotate_journal()
+            except Exception as e:
+                print(f"轮换日志 {self.journal_path} 时出错: {e}")
+                if self.journal.closed:
+                    self._open_journal()
+                return
+            snapshot = self.users.snapshot()
+            self.journal_entries = 0
+            self.dirty = False
+        tmp_path = self.file_path + '.tmp'
+        try:
+            os.fsync(old_journal.fileno())
+            old_journal.close()
+            self._merge_rotated()
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                # 数字ID以整数写入快照，体积更小
+                json.dump(list(snapshot.values()), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.file_path)
+            os.remove(self.compacting_path)
+        except Exception as e:
+            print(f"压缩用户列表 {self.file_path} 时出错: {e}")
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            with self.condition:
+                # 在锁内检查停止标志，stop() 在 wait() 之前通知也不会丢失
+                while not self.dirty and not self.stop_event.is_set():
+                    self.condition.wait()
+                needs_compact = self.journal_entries >= self.compact_threshold
+            # 等待一小段时间，让这段时间内的写入共用一次 fsync
+            self.stop_event.wait(self.fsync_interval)
+            self.save()
+            if needs_compact:
+                self.compact()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"journal-{os.path.basename(self.file_path)}",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """落盘剩余日志并压缩为快照"""
+        with self.condition:
+            self.stop_event.set()
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+        self.compact()
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def add(self, user_id: str) -> bool:
+        """添加用户，已存在时返回 False"""
+        with self.lock:
+            if user_id in self.users:
+                return False
+            self.users.add(user_id)
+            self._append('+', user_id)
+        return True
+
+    def discard(self, user_id: str) -> bool:
+        """移除用户，不存在时返回 False"""
+        with self.lock:
+            if user_id not in self.users:
+                return False
+            self.users.remove(user_id)
+            self._append('-', user_id)
+        return True
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def get_all(self) -> set:
+        return set(self.users)
+
+
+class BlockManager(JournaledUserSet):
+    """封禁用户列表"""
+
+    def __init__(self, file_path='blocked_users.json', **kwargs):
+        super().__init__(file_path, **kwargs)
 
     def block_user(self, user_id: str) -> bool:
         """封禁用户"""
-        self.blocked_users.add(user_id)
-        self.save_blocked_users()
+        self.add(user_id)
         return True
 
     def unblock_user(self, user_id: str) -> bool:
         """解封用户"""
-        if user_id in self.blocked_users:
-            self.blocked_users.remove(user_id)
-            self.save_blocked_users()
-            return True
-        return False
+        return self.discard(user_id)
 
     def is_blocked(self, user_id: str) -> bool:
         """检查用户是否被封禁"""
-        return user_id in self.blocked_users
+        return user_id in self.users
 
     def get_blocked_users(self) -> set:
         """获取所有被封禁的用户"""
-        return self.blocked_users
\ No newline at end of file
+        return self.get_all()
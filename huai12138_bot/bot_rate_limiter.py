@@ -0,0 +1,60 @@
+import asyncio
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from rate_limiter import PRIORITY_NORMAL, RateLimitError
+
+
+def retry_after_seconds(error):
+    delay = error.retry_after
+    if isinstance(delay, datetime.timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class BotRateLimiter(BaseRateLimiter):
+    """让机器人的所有请求经过 common/rate_limiter.py 的 TelegramRateLimiter
+
+    普通回复、转发和广播共用同一个全局令牌桶和每个聊天的令牌桶，按优先级放行；
+    调用 Bot 方法时用 rate_limit_args 指定优先级(默认 PRIORITY_NORMAL)，广播使用 PRIORITY_LOW。
+    TelegramRateLimiter.acquire 是阻塞调用，在专用线程池中等待，不阻塞事件循环。
+    没有 chat_id 的请求(getMe、answerCallbackQuery 等)不限流。
+    遇到 429 时暂停对应聊天，最多重试 max_retries 次。
+    """
+
+    def __init__(self, limiter, acquire_timeout=None, max_retries=3):
+        self.limiter = limiter
+        self.acquire_timeout = acquire_timeout
+        self.max_retries = max_retries
+        # 每个等待中的请求占用一个线程，上限与调度器的等待队列长度相同
+        self.executor = ThreadPoolExecutor(max_workers=limiter.max_waiting, thread_name_prefix='rate-limiter')
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        priority = PRIORITY_NORMAL if rate_limit_args is None else rate_limit_args
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            acquired = await loop.run_in_executor(self.executor, self.limiter.acquire, chat_id, priority,
+                                                  self.acquire_timeout)
+            if not acquired:
+                raise RateLimitError(f"发送到 {chat_id} 的请求 {endpoint} 等待超时或队列已满")
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = retry_after_seconds(e)
+                self.limiter.observe(chat_id, 429, {'parameters': {'retry_after': retry_after}})
+                logging.warning(f"触发 Telegram 限流，{retry_after} 秒后重试 {endpoint}")
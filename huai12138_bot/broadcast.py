@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+from rate_limiter import PRIORITY_LOW
+
+
+class BroadcastCheckpoint:
+    """单进程模式的广播检查点: 接收者列表和进度分别保存在两个 JSON 文件中"""
+
+    def __init__(self, checkpoint_path='broadcast.json'):
+        self.checkpoint_path = checkpoint_path
+        self.recipients_path = os.path.splitext(checkpoint_path)[0] + '_recipients.json'
+
+    def _write_json(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def begin(self, job, recipients):
+        self._write_json(self.recipients_path, recipients)
+        self._write_json(self.checkpoint_path, job)
+
+    def save(self, job):
+        self._write_json(self.checkpoint_path, job)
+
+    def load(self):
+        """返回 (进度, 接收者列表)，没有未完成的广播时返回 None"""
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            job = json.load(f)
+        with open(self.recipients_path, 'r', encoding='utf-8') as f:
+            recipients = json.load(f)
+        return job, recipients
+
+    def clear(self):
+        for path in (self.checkpoint_path, self.recipients_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class BroadcastManager:
+    """向所有已知用户群发消息
+
+    接收者列表和进度(已处理的位置和计数)通过状态存储保存: 单进程模式写入本地文件，
+    redis 模式保存在 Redis 中。每处理一批保存一次进度，重启后从检查点继续，最多重复发送一批。
+    同一时间只运行一个广播: 运行广播的进程(副本)持有存储中的广播锁，
+    其他副本每 resume_interval 秒尝试获得锁，持有者退出或崩溃后由获得锁的副本继续。
+    发送速度由机器人的限流器(BotRateLimiter)控制: 广播以 PRIORITY_LOW 排队，
+    与普通回复和转发共用全局速率，不会挤占它们；429 的暂停和重试也由限流器处理。
+    """
+
+    def __init__(self, store, concurrency=10, progress_interval=3.0, resume_interval=30.0):
+        self.store = store
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.resume_interval = resume_interval
+        self.job = None
+        self.recipients = []
+        self.task = None
+        self.watch_task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    async def _save_checkpoint(self):
+        try:
+            await self.store.broadcast_save(self.job)
+        except Exception as e:
+            logging.error(f"保存广播进度时出错: {e}")
+
+    async def start(self, bot, recipients, status_message, text=None, source_chat_id=None, source_message_id=None,
+                    is_blocked=None, on_unreachable=None):
+        """开始新的广播: 发送 text，或复制 source_chat_id 中的 source_message_id
+
+        已有广播在本进程或其他副本上运行时返回 False。
+        is_blocked 和 on_unreachable 是异步函数，参数为用户ID
+        """
+        if self.running or not await self.store.broadcast_acquire():
+            return False
+        try:
+            if await self.store.broadcast_load() is not None:
+                # 上一个广播还没有完成，由 watch 继续
+                await self.store.broadcast_release()
+                return False
+            self.recipients = list(recipients)
+            self.job = {
+                'text': text,
+                'source_chat_id': source_chat_id,
+                'source_message_id': source_message_id,
+                'status_chat_id': status_message.chat_id,
+                'status_message_id': status_message.message_id,
+                'total': len(self.recipients),
+                'position': 0,
+                'sent': 0,
+                'failed': 0,
+                'dropped': 0,
+                'skipped': 0,
+            }
+            await self.store.broadcast_begin(self.job, self.recipients)
+        except BaseException:
+            await self.store.broadcast_release()
+            raise
+        self.task = asyncio.create_task(self._run_locked(bot, is_blocked, on_unreachable))
+        return True
+
+    async def resume(self, bot, is_blocked=None, on_unreachable=None):
+        """继续未完成的广播，返回是否有需要继续的广播"""
+        if self.running or not await self.store.broadcast_acquire():
+            return False
+        try:
+            checkpoint = await self.store.broadcast_load()
+        except Exception as e:
+            logging.error(f"读取广播进度时出错: {e}")
+            checkpoint = None
+        if checkpoint is None:
+            await self.store.broadcast_release()
+            return False
+        self.job, self.recipients = checkpoint
+        logging.info(f"继续广播: {self.job['position']}/{self.job['total']}")
+        self.task = asyncio.create_task(self._run_locked(bot, is_blocked, on_unreachable))
+        return True
+
+    async def _run_locked(self, bot, is_blocked, on_unreachable):
+        try:
+            await self.run(bot, is_blocked, on_unreachable)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"广播时出错: {e}")
+        finally:
+            await self.store.broadcast_release()
+
+    async def _watch(self, bot, is_blocked, on_unreachable):
+        while True:
+            try:
+                await self.resume(bot, is_blocked, on_unreachable)
+            except Exception as e:
+                logging.error(f"检查未完成的广播时出错: {e}")
+            await asyncio.sleep(self.resume_interval)
+
+    def watch(self, bot, is_blocked=None, on_unreachable=None):
+        """立即并定期继续未完成的广播(启动时调用)"""
+        self.watch_task = asyncio.create_task(self._watch(bot, is_blocked, on_unreachable))
+
+    async def stop(self):
+        """停止广播，检查点保留，由下次启动或其他副本继续"""
+        for task in (self.watch_task, self.task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                if task is self.task:
+                    # 任务在开始运行前被取消时不会执行 _run_locked 中的释放
+                    await self.store.broadcast_release()
+
+    def format_progress(self, finished=False):
+        job = self.job
+        title = "广播完成" if finished else "广播中"
+        return f"{title}: {job['position']}/{job['total']}\n" \
+               f"成功: {job['sent']}  失败: {job['failed']}  " \
+               f"已移除: {job['dropped']}  跳过: {job['skipped']}"
+
+    async def _report(self, bot, finished=False):
+        try:
+            await bot.edit_message_text(self.format_progress(finished), chat_id=self.job['status_chat_id'],
+                                        message_id=self.job['status_message_id'], rate_limit_args=PRIORITY_LOW)
+        except TelegramError as e:
+            # 内容未变化等错误不影响广播
+            logging.warning(f"更新广播进度时出错: {e}")
+
+    async def _send_one(self, bot, user_id):
+        job = self.job
+        try:
+            if job['text'] is not None:
+                await bot.send_message(user_id, job['text'], rate_limit_args=PRIORITY_LOW)
+            else:
+                await bot.copy_message(user_id, job['source_chat_id'], job['source_message_id'],
+                                       rate_limit_args=PRIORITY_LOW)
+            return 'sent'
+        except Forbidden:
+            # 用户屏蔽了机器人或账号已注销
+            return 'dropped'
+        except BadRequest as e:
+            if 'chat not found' in str(e).lower():
+                return 'dropped'
+            logging.error(f"向用户 {user_id} 广播时出错: {e}")
+            return 'failed'
+        except Exception as e:
+            # 包括限流器重试多次后仍然 429、等待超时
+            logging.error(f"向用户 {user_id} 广播时出错: {e}")
+            return 'failed'
+
+    async def run(self, bot, is_blocked=None, on_unreachable=None):
+        job = self.job
+        last_report = time.monotonic()
+        await self._report(bot)
+        while job['position'] < job['total']:
+            if not await self.store.broadcast_held():
+                # 广播锁过期后被其他副本获得，由它继续
+                logging.error("广播锁已失去，停止本进程的广播")
+                return
+            batch = self.recipients[job['position']:job['position'] + self.concurrency]
+            targets = [user_id for user_id in batch if not (is_blocked and await is_blocked(user_id))]
+            job['skipped'] += len(batch) - len(targets)
+            results = await asyncio.gather(*(self._send_one(bot, user_id) for user_id in targets))
+            for user_id, result in zip(targets, results):
+                job[result] += 1
+                if result == 'dropped' and on_unreachable:
+                    await on_unreachable(user_id)
+            job['position'] += len(batch)
+            await self._save_checkpoint()
+            if time.monotonic() - last_report >= self.progress_interval:
+                last_report = time.monotonic()
+                await self._report(bot)
+        await self._report(bot, finished=True)
+        await self.store.broadcast_clear()
+        logging.info(self.format_progress(finished=True))
@@ -0,0 +1,94 @@
+import time
+from collections import OrderedDict
+
+ALLOW = 'allow'
+SUPPRESS = 'suppress'
+BLOCK = 'block'
+
+
+class FloodControl:
+    """每个用户一个令牌桶，限制转发给管理员的消息速度
+
+    桶按最近使用时间排列在 OrderedDict 中，超过 idle_ttl 未发消息的用户
+    从头部淘汰，内存只与最近活跃的用户数有关。被限流的消息计数，
+    由调用方汇总后一次告知管理员；连续被限流达到 block_threshold 条时建议封禁。
+    同一相册的消息作为一个整体: 第一条消息计费并决定结果，其余消息沿用该结果，
+    不会出现相册只转发了一部分的情况。
+    """
+
+    def __init__(self, rate=0.5, burst=5, block_threshold=0, idle_ttl=600, group_ttl=60):
+        self.rate = rate
+        self.burst = burst
+        # 0 表示不自动封禁
+        self.block_threshold = block_threshold
+        self.idle_ttl = idle_ttl
+        # 用户ID -> [剩余令牌, 更新时间, 待汇总的限流条数, 连续限流条数]
+        self.buckets = OrderedDict()
+        # (用户ID, media_group_id) -> [结果, 首条消息时间]，按时间先后排列
+        self.group_ttl = group_ttl
+        self.groups = OrderedDict()
+
+    def _evict(self, now):
+        while self.buckets:
+            bucket = next(iter(self.buckets.values()))
+            if now - bucket[1] < self.idle_ttl:
+                break
+            self.buckets.popitem(last=False)
+
+    def check(self, user_id, now=None, media_group_id=None):
+        """返回 ALLOW(转发)、SUPPRESS(限流) 或 BLOCK(达到自动封禁阈值)
+
+        指定 media_group_id 时，同一相册只有第一条消息消耗令牌，其余消息返回相同结果。
+        """
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        if media_group_id is not None:
+            while self.groups and now - next(iter(self.groups.values()))[1] >= self.group_ttl:
+                self.groups.popitem(last=False)
+            group = self.groups.get((user_id, media_group_id))
+            if group is not None:
+                bucket = self.buckets.get(user_id)
+                if group[0] != ALLOW and bucket is not None:
+                    # 计入待汇总的条数，但不算作新的连续限流
+                    bucket[2] += 1
+                return group[0]
+            verdict = self.check(user_id, now)
+            self.groups[(user_id, media_group_id)] = [verdict, now]
+            return verdict
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = self.new_bucket(now)
+        else:
+            self.buckets.move_to_end(user_id)
+        return self.apply(bucket, now)
+
+    def new_bucket(self, now):
+        return [float(self.burst), now, 0, 0]
+
+    def apply(self, bucket, now):
+        """补充令牌后为一条消息计费，直接修改 bucket；Redis 中保存的桶也用它计算"""
+        bucket[0] = min(self.burst, bucket[0] + max(0.0, now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[3] = 0
+            return ALLOW
+        bucket[2] += 1
+        bucket[3] += 1
+        if self.block_threshold and bucket[3] >= self.block_threshold:
+            return BLOCK
+        return SUPPRESS
+
+    def take_suppressed(self, user_id):
+        """取出并清零待汇总的限流条数"""
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            return 0
+        count, bucket[2] = bucket[2], 0
+        return count
+
+    def forget(self, user_id):
+        self.buckets.pop(user_id, None)
+
+    def __len__(self):
+        return len(self.buckets)
@@ -0,0 +1,191 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import filterfalse, islice
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+def parse_user_id(user_id):
+    """把规范的十进制用户ID转换为 int64，其他格式返回 None"""
+    if isinstance(user_id, int):
+        return user_id if INT64_MIN <= user_id <= INT64_MAX else None
+    # 常见情况: 不以 0 开头的正整数，不需要再做往返校验
+    if isinstance(user_id, str) and 0 < len(user_id) < 19 and user_id.isascii() \
+            and user_id.isdigit() and user_id[0] != '0':
+        return int(user_id)
+    try:
+        value = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    # "007"、" 7" 之类的写法按原样作为字符串保存，避免和 "7" 混为一个用户
+    if str(value) != user_id or not INT64_MIN <= value <= INT64_MAX:
+        return None
+    return value
+
+
+class UserIdSet:
+    """以有序 int64 数组保存的用户ID集合，每个ID约 8 字节
+
+    新增/删除先记在两个小集合中，累计到一定数量后再与有序数组归并，
+    避免每次修改都移动整个数组。非数字ID单独保存在字符串集合中。
+
+    归并是增量进行的: 开始时把当前的修改冻结为 pending_added/pending_removed，
+    之后每次修改只向新数组追加一段，完成后整体替换 base。base 不会被原地修改，
+    归并期间的查询和新修改照常使用旧数组 + 冻结的修改 + 新的修改集合。
+    """
+
+    # 每次修改推进归并的元素数；只要大于 64，下一次归并前本次一定已经完成
+    MERGE_STEP = 8192
+
+    def __init__(self, user_ids=(), merge_threshold=4096):
+        self.base = array('q')
+        # 正在归并进 base 的修改: 有序的新增ID / 要删除的ID，归并期间不再修改
+        self.pending_added = ()
+        self.pending_added_set = frozenset()
+        self.pending_removed = frozenset()
+        # 相对于 base + pending 的新增ID / 已删除的ID
+        self.added = set()
+        self.removed = set()
+        self.others = set()
+        self.merge_threshold = merge_threshold
+        # 正在构建的新数组和剩余的归并结果
+        self.next_base = None
+        self.merging = None
+        self.update(user_ids)
+
+    def _in_base(self, value):
+        base = self.base
+        index = bisect_left(base, value)
+        return index < len(base) and base[index] == value
+
+    def _in_merged(self, value):
+        """是否在 base + pending 中"""
+        if value in self.pending_removed:
+            return False
+        return value in self.pending_added_set or self._in_base(value)
+
+    def __contains__(self, user_id):
+        value = parse_user_id(user_id)
+        if value is None:
+            return str(user_id) in self.others
+        if value in self.added:
+            return True
+        if value in self.removed:
+            return False
+        return self._in_merged(value)
+
+    def __len__(self):
+        return (len(self.base) - len(self.pending_removed) + len(self.pending_added)
+                - len(self.removed) + len(self.added) + len(self.others))
+
+    def __iter__(self):
+        """按字符串形式遍历所有ID"""
+        for value in self.values():
+            yield str(value)
+
+    def _merged_values(self):
+        """base + pending 的有序遍历"""
+        return filterfalse(self.pending_removed.__contains__, heapq.merge(self.base, self.pending_added))
+
+    def values(self):
+        """遍历所有ID，数字ID为 int，其余为原字符串"""
+        removed = self.removed
+        for value in heapq.merge(self._merged_values(), sorted(self.added)):
+            if value not in removed:
+                yield value
+        yield from self.others
+
+    def snapshot(self):
+        """当前内容的只读副本: 有序数组和冻结的修改不会原地修改，直接共享；
+        只复制尚未归并的少量修改"""
+        copy = UserIdSet.__new__(UserIdSet)
+        copy.base = self.base
+        copy.pending_added = self.pending_added
+        copy.pending_added_set = self.pending_added_set
+        copy.pending_removed = self.pending_removed
+        copy.added = set(self.added)
+        copy.removed = set(self.removed)
+        copy.others = set(self.others)
+        copy.merge_threshold = self.merge_threshold
+        copy.next_base = None
+        copy.merging = None
+        return copy
+
+    def add(self, user_id):
+        value = parse_user_id(user_id)
+        if value is None:
+            self.others.add(str(user_id))
+            return
+        if value in self.removed:
+            self.removed.discard(value)
+        elif value not in self.added and not self._in_merged(value):
+            self.added.add(value)
+        self._maybe_merge()
+
+    def discard(self, user_id):
+        value = parse_user_id(user_id)
+        if value is None:
+            self.others.discard(str(user_id))
+            return
+        if value in self.added:
+            self.added.discard(value)
+        elif value not in self.removed and self._in_merged(value):
+            self.removed.add(value)
+        self._maybe_merge()
+
+    def remove(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        self.discard(user_id)
+
+    def update(self, user_ids):
+        """批量添加，之后一次归并完成"""
+        for user_id in user_ids:
+            value = parse_user_id(user_id)
+            if value is None:
+                self.others.add(str(user_id))
+            elif value in self.removed:
+                self.removed.discard(value)
+            elif value not in self.added and not self._in_merged(value):
+                self.added.add(value)
+        self.merge()
+
+    def _maybe_merge(self):
+        """推进正在进行的归并；修改累计过多时开始新的归并"""
+        if self.merging is not None:
+            self._merge_step(self.MERGE_STEP)
+        elif len(self.added) + len(self.removed) > max(self.merge_threshold, len(self.base) >> 6):
+            self._start_merge()
+
+    def _start_merge(self):
+        self.pending_added = sorted(self.added)
+        self.pending_added_set = self.added
+        self.pending_removed = frozenset(self.removed)
+        self.added = set()
+        self.removed = set()
+        self.next_base = array('q')
+        self.merging = self._merged_values()
+
+    def _merge_step(self, count):
+        """向新数组追加最多 count 个元素，全部完成后替换 base"""
+        size = len(self.next_base)
+        self.next_base.extend(islice(self.merging, count))
+        if len(self.next_base) - size == count:
+            return
+        # 先替换数组再清空冻结的修改，中间的查询结果也不会出错
+        self.base = self.next_base
+        self.pending_added = ()
+        self.pending_added_set = frozenset()
+        self.pending_removed = frozenset()
+        self.next_base = None
+        self.merging = None
+
+    def merge(self):
+        """立即完成所有修改的归并"""
+        if self.merging is not None:
+            self._merge_step(len(self.base) + len(self.pending_added) + 1)
+        if self.added or self.removed:
+            self._start_merge()
+            self._merge_step(len(self.base) + len(self.pending_added) + 1)
@@ -0,0 +1,83 @@
+import logging
+import os
+from collections import OrderedDict
+
+
+class ReplyIndex:
+    """管理员聊天中的消息ID -> 来源用户ID，容量有限的 LRU
+
+    每条新映射追加一行到文件，文件行数超过容量两倍时按当前内容重写(原子替换)；
+    启动时按顺序回放文件，超出容量的旧条目被淘汰。
+    """
+
+    def __init__(self, file_path='reply_index.log', max_entries=10000):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lines = 0
+        self.file = None
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.file_path):
+            try:
+                with open(self.file_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        parts = line.split()
+                        # 跳过崩溃时只写了一半的行
+                        if len(parts) != 2 or not line.endswith('\n'):
+                            continue
+                        self._put(int(parts[0]), parts[1])
+                        self.lines += 1
+            except Exception as e:
+                logging.error(f"加载回复索引时出错: {e}")
+        self.file = open(self.file_path, 'a', encoding='utf-8')
+
+    def _put(self, message_id, user_id):
+        self.entries[message_id] = user_id
+        self.entries.move_to_end(message_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def add(self, message_id, user_id):
+        """记录管理员聊天中的一条消息来自哪个用户"""
+        user_id = str(user_id)
+        self._put(message_id, user_id)
+        try:
+            self.file.write(f"{message_id} {user_id}\n")
+            self.file.flush()
+        except Exception as e:
+            logging.error(f"写入回复索引时出错: {e}")
+            return
+        self.lines += 1
+        if self.lines > 2 * self.max_entries:
+            self.compact()
+
+    def get(self, message_id):
+        """查找消息对应的用户ID，找不到返回 None"""
+        user_id = self.entries.get(message_id)
+        if user_id is not None:
+            self.entries.move_to_end(message_id)
+        return user_id
+
+    def compact(self):
+        """按当前内容重写文件"""
+        tmp_path = self.file_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for message_id, user_id in self.entries.items():
+                    f.write(f"{message_id} {user_id}\n")
+            self.file.close()
+            os.replace(tmp_path, self.file_path)
+            self.lines = len(self.entries)
+        except Exception as e:
+            logging.error(f"压缩回复索引时出错: {e}")
+        finally:
+            if self.file.closed:
+                self.file = open(self.file_path, 'a', encoding='utf-8')
+
+    def close(self):
+        if self.file is not None:
+            self.compact()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,542 @@
+import asyncio
+import contextlib
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from telegram import Message, Update
+from telegram.ext import BaseUpdateProcessor
+
+from broadcast import BroadcastCheckpoint
+from flood import ALLOW, FloodControl
+
+# 只有锁的持有者才能释放: 值等于自己的令牌时才删除
+UNLOCK_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) else return 0 end"
+)
+# 续期同样只对持有者生效
+RENEW_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+)
+
+
+class KeyedLocks:
+    """每个键一把 asyncio.Lock，没有人等待时释放，等待者按到达顺序获得锁"""
+
+    def __init__(self):
+        # 键 -> [锁, 持有和等待的数量]
+        self.locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    def __len__(self):
+        return len(self.locks)
+
+
+class LocalStateStore:
+    """单进程状态: 封禁列表、已知用户、回复索引、待验证用户、转发限流、
+    广播进度和收集中的相册保存在本进程和本地文件中
+
+    两种存储提供相同的异步接口，处理函数只通过接口访问状态。
+    """
+
+    def __init__(self, block_manager, known_users, reply_index, verification_scheduler, dedup_size=10000,
+                 flood_control=None, broadcast_checkpoint=None):
+        self.block_manager = block_manager
+        self.known_users = known_users
+        self.reply_index = reply_index
+        self.verification_scheduler = verification_scheduler
+        self.dedup_size = dedup_size
+        self.flood_control = FloodControl() if flood_control is None else flood_control
+        self.broadcast_checkpoint = BroadcastCheckpoint() if broadcast_checkpoint is None else broadcast_checkpoint
+        self.broadcasting = False
+        # (chat_id, media_group_id) -> 消息列表
+        self.media_groups = {}
+        self.seen_updates = OrderedDict()
+        # 用户ID -> 最后处理的 update_id，最久没有更新的在头部
+        self.last_updates = OrderedDict()
+        self.locks = KeyedLocks()
+
+    async def start(self, on_verification_expired):
+        self.block_manager.start()
+        self.known_users.start()
+        self.verification_scheduler.start(on_verification_expired)
+
+    async def stop(self):
+        await self.verification_scheduler.stop()
+        self.block_manager.stop()
+        self.known_users.stop()
+        self.reply_index.close()
+
+    async def is_blocked(self, user_id):
+        return self.block_manager.is_blocked(user_id)
+
+    async def block_user(self, user_id):
+        return self.block_manager.block_user(user_id)
+
+    async def unblock_user(self, user_id):
+        return self.block_manager.unblock_user(user_id)
+
+    async def known_user_ids(self):
+        return self.known_users.get_all()
+
+    async def add_known_user(self, user_id):
+        return self.known_users.add(user_id)
+
+    async def remove_known_user(self, user_id):
+        return self.known_users.discard(user_id)
+
+    async def reply_index_add(self, message_id, user_id):
+        self.reply_index.add(message_id, user_id)
+
+    async def reply_index_get(self, message_id):
+        return self.reply_index.get(message_id)
+
+    async def verification_add(self, user_id):
+        """加入验证队列，已在队列中时保持原来的截止时间并返回 False"""
+        return self.verification_scheduler.add(user_id)
+
+    async def verification_cancel(self, user_id):
+        """在用户锁内调用: 验证通过，返回是否移出队列(已超时返回 False)"""
+        return self.verification_scheduler.cancel(user_id)
+
+    async def verification_expire(self, user_id):
+        """在用户锁内调用: 用户仍待验证且已超时时封禁，封禁生效后才移出队列，返回是否封禁"""
+        if not self.verification_scheduler.overdue(user_id):
+            return False
+        self.block_manager.block_user(user_id)
+        self.verification_scheduler.finish(user_id)
+        return True
+
+    async def verification_pending(self, user_id):
+        return user_id in self.verification_scheduler
+
+    async def is_duplicate_update(self, update_id):
+        """同一更新第二次到达时返回 True"""
+        if update_id in self.seen_updates:
+            return True
+        self.seen_updates[update_id] = None
+        if len(self.seen_updates) > self.dedup_size:
+            self.seen_updates.popitem(last=False)
+        return False
+
+    async def accept_update(self, user_id, update_id):
+        """在用户锁内调用: 比该用户已处理的更新旧时返回 False，否则记为最后处理的更新"""
+        last = self.last_updates.get(user_id)
+        if last is not None and update_id <= last:
+            self.last_updates.move_to_end(user_id)
+            return False
+        self.last_updates[user_id] = update_id
+        self.last_updates.move_to_end(user_id)
+        if len(self.last_updates) > self.dedup_size:
+            self.last_updates.popitem(last=False)
+        return True
+
+    async def flood_check(self, user_id, media_group_id=None):
+        """在用户锁内调用: 返回 ALLOW、SUPPRESS 或 BLOCK"""
+        return self.flood_control.check(user_id, media_group_id=media_group_id)
+
+    async def flood_take_suppressed(self, user_id):
+        return self.flood_control.take_suppressed(user_id)
+
+    async def flood_forget(self, user_id):
+        self.flood_control.forget(user_id)
+
+    async def broadcast_acquire(self):
+        """获得广播锁，已有广播在运行时返回 False"""
+        if self.broadcasting:
+            return False
+        self.broadcasting = True
+        return True
+
+    async def broadcast_release(self):
+        self.broadcasting = False
+
+    async def broadcast_held(self):
+        return self.broadcasting
+
+    async def broadcast_begin(self, job, recipients):
+        self.broadcast_checkpoint.begin(job, recipients)
+
+    async def broadcast_save(self, job):
+        self.broadcast_checkpoint.save(job)
+
+    async def broadcast_load(self):
+        """返回 (进度, 接收者列表)，没有未完成的广播时返回 None"""
+        return self.broadcast_checkpoint.load()
+
+    async def broadcast_clear(self):
+        self.broadcast_checkpoint.clear()
+
+    async def media_group_add(self, chat_id, media_group_id, message):
+        self.media_groups.setdefault((chat_id, media_group_id), []).append(message)
+
+    async def media_group_take(self, chat_id, media_group_id, quiet, bot):
+        """相册的最后一条消息到达 quiet 秒后取出全部消息，返回 (还需等待的秒数, 消息列表)
+
+        单进程时收集器的定时器在每条消息到达时重置，到期时相册一定已经安静了 quiet 秒。
+        """
+        return 0, self.media_groups.pop((chat_id, media_group_id), [])
+
+    def user_lock(self, user_id):
+        return self.locks.hold(user_id)
+
+
+class RedisStateStore:
+    """多副本共享状态，保存在 Redis 中
+
+    封禁列表和已知用户是集合，回复索引是带过期时间的字符串，
+    转发限流的令牌桶是 JSON 字符串，在用户锁内读写，空闲 idle_ttl 秒后过期；
+    广播的进度和接收者列表是 JSON 字符串，运行广播的副本持有带续期的广播锁；
+    收集中的相册是消息 JSON 的集合，记录最后一条到达的时间，取出时加短锁，只有一个副本转发。
+    待验证用户是按截止时间排序的有序集合: 各副本轮询到期的用户，
+    用 SET NX 认领，只有认领成功的副本处理超时；超时封禁和验证通过都在用户锁内
+    检查截止时间后 ZREM，封禁生效后才移出队列，期间的消息仍按待验证处理。
+    更新去重用 SET NX，用户锁用 SET NX PX 加令牌，持有期间每 lock_ttl/3 续期一次，
+    处理时间超过 lock_ttl 也不会被其他副本抢走；每个用户最后处理的 update_id 在用户锁内读写。
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='huai12138_bot', verification_timeout=30,
+                 reply_ttl=30 * 86400, dedup_ttl=3600, lock_ttl=60.0, poll_interval=1.0, flood_control=None,
+                 album_ttl=600):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.verification_timeout = verification_timeout
+        self.reply_ttl = reply_ttl
+        self.dedup_ttl = dedup_ttl
+        self.lock_ttl_ms = int(lock_ttl * 1000)
+        self.poll_interval = poll_interval
+        self.flood_control = FloodControl() if flood_control is None else flood_control
+        self.album_ttl = album_ttl
+        self.locks = KeyedLocks()
+        self.task = None
+        self.expire_tasks = set()
+        # 本进程持有广播锁时的令牌和续期任务
+        self.broadcast_token = None
+        self.broadcast_renew = None
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + tuple(str(part) for part in parts))
+
+    async def start(self, on_verification_expired):
+        await self.redis.ping()
+        self.task = asyncio.create_task(self._run_verification(on_verification_expired))
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.expire_tasks:
+            await asyncio.gather(*self.expire_tasks, return_exceptions=True)
+        await self.broadcast_release()
+        await self.redis.aclose()
+
+    async def is_blocked(self, user_id):
+        return bool(await self.redis.sismember(self._key('blocked'), user_id))
+
+    async def block_user(self, user_id):
+        await self.redis.sadd(self._key('blocked'), user_id)
+        return True
+
+    async def unblock_user(self, user_id):
+        return bool(await self.redis.srem(self._key('blocked'), user_id))
+
+    async def known_user_ids(self):
+        return set(await self.redis.smembers(self._key('known_users')))
+
+    async def add_known_user(self, user_id):
+        return bool(await self.redis.sadd(self._key('known_users'), user_id))
+
+    async def remove_known_user(self, user_id):
+        return bool(await self.redis.srem(self._key('known_users'), user_id))
+
+    async def reply_index_add(self, message_id, user_id):
+        await self.redis.set(self._key('reply', message_id), user_id, ex=self.reply_ttl)
+
+    async def reply_index_get(self, message_id):
+        return await self.redis.get(self._key('reply', message_id))
+
+    async def verification_add(self, user_id):
+        deadline = time.time() + self.verification_timeout
+        return bool(await self.redis.zadd(self._key('verification'), {user_id: deadline}, nx=True))
+
+    async def verification_cancel(self, user_id):
+        """在用户锁内调用: 验证通过，返回是否移出队列(已超时返回 False)"""
+        key = self._key('verification')
+        deadline = await self.redis.zscore(key, user_id)
+        if deadline is None or float(deadline) <= time.time():
+            return False
+        return bool(await self.redis.zrem(key, user_id))
+
+    async def verification_expire(self, user_id):
+        """在用户锁内调用: 用户仍待验证且已超时时封禁，封禁生效后才移出队列，返回是否封禁"""
+        key = self._key('verification')
+        deadline = await self.redis.zscore(key, user_id)
+        if deadline is None or float(deadline) > time.time():
+            return False
+        await self.block_user(user_id)
+        await self.redis.zrem(key, user_id)
+        return True
+
+    async def verification_pending(self, user_id):
+        return await self.redis.zscore(self._key('verification'), user_id) is not None
+
+    async def _run_verification(self, on_expire):
+        key = self._key('verification')
+        while True:
+            try:
+                due = await self.redis.zrangebyscore(key, '-inf', time.time(), start=0, num=100)
+                for user_id in due:
+                    # 多个副本同时看到到期用户，只有认领成功的一个处理；
+                    # 处理失败时认领过期后重新处理
+                    if await self.redis.set(self._key('verification_claim', user_id), 1,
+                                            nx=True, px=self.lock_ttl_ms):
+                        task = asyncio.create_task(on_expire(user_id))
+                        self.expire_tasks.add(task)
+                        task.add_done_callback(self.expire_tasks.discard)
+            except Exception as e:
+                logging.error(f"检查验证超时时出错: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def is_duplicate_update(self, update_id):
+        first = await self.redis.set(self._key('update', update_id), 1, nx=True, ex=self.dedup_ttl)
+        return not first
+
+    async def accept_update(self, user_id, update_id):
+        # 只在持有用户锁时调用，读取和写入之间不会有该用户的其他更新
+        key = self._key('last_update', user_id)
+        last = await self.redis.get(key)
+        if last is not None and update_id <= int(last):
+            return False
+        await self.redis.set(key, update_id, ex=self.dedup_ttl)
+        return True
+
+    async def _save_flood_bucket(self, user_id, bucket):
+        await self.redis.set(self._key('flood', user_id), json.dumps(bucket),
+                             ex=max(1, int(self.flood_control.idle_ttl)))
+
+    async def flood_check(self, user_id, media_group_id=None):
+        """在用户锁内调用: 返回 ALLOW、SUPPRESS 或 BLOCK，令牌桶由各副本共用"""
+        flood = self.flood_control
+        now = time.time()
+        raw = await self.redis.get(self._key('flood', user_id))
+        bucket = json.loads(raw) if raw is not None else None
+        if media_group_id is not None:
+            group_key = self._key('flood_group', user_id, media_group_id)
+            verdict = await self.redis.get(group_key)
+            if verdict is not None:
+                if verdict != ALLOW and bucket is not None:
+                    # 计入待汇总的条数，但不算作新的连续限流
+                    bucket[2] += 1
+                    await self._save_flood_bucket(user_id, bucket)
+                return verdict
+        if bucket is None:
+            bucket = flood.new_bucket(now)
+        verdict = flood.apply(bucket, now)
+        await self._save_flood_bucket(user_id, bucket)
+        if media_group_id is not None:
+            await self.redis.set(group_key, verdict, ex=max(1, int(flood.group_ttl)))
+        return verdict
+
+    async def flood_take_suppressed(self, user_id):
+        """在用户锁内调用: 取出并清零待汇总的限流条数"""
+        raw = await self.redis.get(self._key('flood', user_id))
+        if raw is None:
+            return 0
+        bucket = json.loads(raw)
+        count, bucket[2] = bucket[2], 0
+        if count:
+            await self._save_flood_bucket(user_id, bucket)
+        return count
+
+    async def flood_forget(self, user_id):
+        await self.redis.delete(self._key('flood', user_id))
+
+    async def broadcast_acquire(self):
+        """获得广播锁，其他副本或本进程已持有时返回 False"""
+        if self.broadcast_token is not None:
+            return False
+        key = self._key('broadcast', 'lock')
+        token = uuid.uuid4().hex
+        if not await self.redis.set(key, token, nx=True, px=self.lock_ttl_ms):
+            return False
+        self.broadcast_token = token
+        self.broadcast_renew = asyncio.create_task(self._renew_lock(key, token))
+        return True
+
+    async def broadcast_release(self):
+        if self.broadcast_token is None:
+            return
+        token, self.broadcast_token = self.broadcast_token, None
+        self.broadcast_renew.cancel()
+        try:
+            await self.redis.eval(UNLOCK_SCRIPT, 1, self._key('broadcast', 'lock'), token)
+        except Exception as e:
+            # 锁会在 lock_ttl 后自动过期
+            logging.error(f"释放广播锁时出错: {e}")
+
+    async def broadcast_held(self):
+        """续期失败(锁被其他副本获得)后返回 False"""
+        return self.broadcast_token is not None and not self.broadcast_renew.done()
+
+    async def broadcast_begin(self, job, recipients):
+        await self.redis.set(self._key('broadcast', 'recipients'), json.dumps(recipients))
+        await self.broadcast_save(job)
+
+    async def broadcast_save(self, job):
+        await self.redis.set(self._key('broadcast', 'job'), json.dumps(job))
+
+    async def broadcast_load(self):
+        """返回 (进度, 接收者列表)，没有未完成的广播时返回 None"""
+        job = await self.redis.get(self._key('broadcast', 'job'))
+        if job is None:
+            return None
+        recipients = await self.redis.get(self._key('broadcast', 'recipients'))
+        return json.loads(job), json.loads(recipients or '[]')
+
+    async def broadcast_clear(self):
+        await self.redis.delete(self._key('broadcast', 'job'), self._key('broadcast', 'recipients'))
+
+    async def media_group_add(self, chat_id, media_group_id, message):
+        key = self._key('album', chat_id, media_group_id)
+        await self.redis.sadd(key, json.dumps(message.to_dict()))
+        await self.redis.expire(key, self.album_ttl)
+        await self.redis.set(self._key('album_last', chat_id, media_group_id), time.time(), ex=self.album_ttl)
+
+    async def media_group_take(self, chat_id, media_group_id, quiet, bot):
+        """相册的最后一条消息(在任一副本上)到达 quiet 秒后取出全部消息，返回 (还需等待的秒数, 消息列表)
+
+        已被其他副本取走时返回空列表；取走之后才到达的消息由收到它的副本另行转发。
+        """
+        last = await self.redis.get(self._key('album_last', chat_id, media_group_id))
+        if last is not None:
+            wait = float(last) + quiet - time.time()
+            if wait > 0:
+                return wait, []
+        key = self._key('album', chat_id, media_group_id)
+        lock_key = self._key('album_lock', chat_id, media_group_id)
+        token = uuid.uuid4().hex
+        if not await self.redis.set(lock_key, token, nx=True, px=self.lock_ttl_ms):
+            # 其他副本正在取出，稍后再看是否还有剩下的消息
+            return max(quiet, 0.1), []
+        try:
+            members = await self.redis.smembers(key)
+            if members:
+                await self.redis.srem(key, *members)
+        finally:
+            await self.redis.eval(UNLOCK_SCRIPT, 1, lock_key, token)
+        return 0, [Message.de_json(json.loads(member), bot) for member in members]
+
+    async def _renew_lock(self, key, token):
+        """持有锁(用户锁、广播锁)期间定期续期，直到被取消"""
+        while True:
+            await asyncio.sleep(self.lock_ttl_ms / 3000)
+            try:
+                if not await self.redis.eval(RENEW_SCRIPT, 1, key, token, self.lock_ttl_ms):
+                    logging.error(f"锁 {key} 已过期并被其他副本获得")
+                    return
+            except Exception as e:
+                # 下一次续期时重试，锁在 lock_ttl 内仍然有效
+                logging.error(f"续期锁 {key} 时出错: {e}")
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id):
+        # 本进程内先排队，只有队首去争 Redis 锁
+        async with self.locks.hold(user_id):
+            key = self._key('lock', user_id)
+            token = uuid.uuid4().hex
+            delay = 0.01
+            while not await self.redis.set(key, token, nx=True, px=self.lock_ttl_ms):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.2)
+            renew = asyncio.create_task(self._renew_lock(key, token))
+            try:
+                yield
+            finally:
+                renew.cancel()
+                try:
+                    await self.redis.eval(UNLOCK_SCRIPT, 1, key, token)
+                except Exception as e:
+                    # 锁会在 lock_ttl 后自动过期
+                    logging.error(f"释放用户锁时出错: {e}")
+
+
+class StateUpdateProcessor(BaseUpdateProcessor):
+    """并发处理更新: 重复的 update_id 直接丢弃，同一用户的更新依次处理
+
+    多个副本部署在同一个 webhook 路径后面时，Telegram 重试的更新只会处理一次，
+    同一用户的消息不会在不同副本上同时处理。本进程内按到达顺序获得用户锁；
+    比该用户已处理的更新还旧的更新(在其他副本上被后来的更新抢先)照常处理，只计数和记录，
+    不会丢弃任何消息。
+
+    先获得用户锁，再占用 max_concurrent_updates 个处理名额之一: 等待同一用户前一条更新的
+    更新不占用名额，不会挡住其他用户。父类的信号量只限制已进入处理器的更新总数(max_pending_updates)。
+    """
+
+    def __init__(self, store, max_concurrent_updates=16, max_pending_updates=1024):
+        super().__init__(max(max_concurrent_updates, max_pending_updates))
+        self.store = store
+        self.slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # 晚于同一用户后续更新到达的更新数
+        self.out_of_order = 0
+
+    async def _check(self, update, coroutine, user_id=None):
+        """重复时关闭 coroutine 并返回 False"""
+        try:
+            duplicate = await self.store.is_duplicate_update(update.update_id)
+            in_order = duplicate or user_id is None or await self.store.accept_update(user_id, update.update_id)
+        except Exception:
+            coroutine.close()
+            raise
+        if duplicate:
+            coroutine.close()
+            logging.debug(f"忽略重复的更新 {update.update_id}")
+            return False
+        if not in_order:
+            self.out_of_order += 1
+            logging.info(f"用户 {user_id} 的更新 {update.update_id} 晚于后续更新到达，照常处理")
+        return True
+
+    async def do_process_update(self, update, coroutine):
+        if not isinstance(update, Update):
+            async with self.slots:
+                await coroutine
+            return
+        user = update.effective_user or update.effective_chat
+        if user is None:
+            if await self._check(update, coroutine):
+                async with self.slots:
+                    await coroutine
+            return
+        # 先排队获得用户锁再检查，本进程内同一用户的更新按到达顺序处理；获得锁之后才占用处理名额
+        async with self.store.user_lock(str(user.id)):
+            if await self._check(update, coroutine, str(user.id)):
+                async with self.slots:
+                    await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
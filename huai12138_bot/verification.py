@@ -0,0 +1,159 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+
+
+class VerificationScheduler:
+    """所有待验证用户共用一个截止时间小顶堆和一个后台任务
+
+    同一用户重复 /start 不会产生新的计时；验证通过时从字典中删除(O(1))，
+    堆中留下的旧条目在出堆时丢弃。超时的用户在封禁生效后才从字典中删除，
+    这之前收到的消息仍按待验证处理。待验证列表定期写入文件，
+    重启后恢复，停机期间已超时的用户在启动后立即处理。
+    """
+
+    def __init__(self, file_path='pending_verification.json', timeout=30, save_interval=1.0):
+        self.file_path = file_path
+        self.timeout = timeout
+        self.save_interval = save_interval
+        # 用户ID -> 截止时间(time.time())
+        self.deadlines = {}
+        self.heap = []
+        # 已到期、正在等待超时处理的用户
+        self.expiring = set()
+        self.dirty = False
+        self.last_save = 0.0
+        self.wakeup = None
+        self.task = None
+        self.stopping = False
+        self.expire_tasks = set()
+        self.load()
+
+    def load(self):
+        """从文件恢复待验证用户"""
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                self.deadlines = {str(user_id): float(deadline) for user_id, deadline in json.load(f).items()}
+        except Exception as e:
+            logging.error(f"加载待验证用户时出错: {e}")
+            return
+        self.heap = [(deadline, user_id) for user_id, deadline in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+    def save(self):
+        """原子写入待验证用户"""
+        tmp_path = self.file_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.deadlines, f)
+            os.replace(tmp_path, self.file_path)
+            self.dirty = False
+        except Exception as e:
+            logging.error(f"保存待验证用户时出错: {e}")
+
+    def _mark_dirty(self):
+        if not self.dirty:
+            self.dirty = True
+            # 唤醒后台任务安排下一次保存
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+    def __contains__(self, user_id):
+        return user_id in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, user_id, now=None):
+        """加入验证队列，已在队列中时保持原来的截止时间并返回 False"""
+        if user_id in self.deadlines:
+            return False
+        deadline = (time.time() if now is None else now) + self.timeout
+        earliest = self.heap[0][0] if self.heap else None
+        self.deadlines[user_id] = deadline
+        heapq.heappush(self.heap, (deadline, user_id))
+        self._mark_dirty()
+        if self.wakeup is not None and (earliest is None or deadline < earliest):
+            self.wakeup.set()
+        return True
+
+    def overdue(self, user_id, now=None):
+        """用户仍在队列中且已超过截止时间"""
+        deadline = self.deadlines.get(user_id)
+        return deadline is not None and deadline <= (time.time() if now is None else now)
+
+    def cancel(self, user_id, now=None):
+        """验证通过，返回是否移出队列；已超时的用户留在队列中等待封禁，返回 False"""
+        if user_id not in self.deadlines or self.overdue(user_id, now):
+            return False
+        del self.deadlines[user_id]
+        self._mark_dirty()
+        # 堆中大部分都是已取消的条目时重建
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(deadline, user_id) for user_id, deadline in self.deadlines.items()
+                         if user_id not in self.expiring]
+            heapq.heapify(self.heap)
+        return True
+
+    def finish(self, user_id):
+        """超时处理(封禁)完成后移出队列"""
+        self.expiring.discard(user_id)
+        if self.deadlines.pop(user_id, None) is not None:
+            self._mark_dirty()
+
+    def pop_expired(self, now=None):
+        """取出所有已到期的用户，它们留在队列中直到 finish()"""
+        now = time.time() if now is None else now
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self.heap)
+            if self.deadlines.get(user_id) == deadline and user_id not in self.expiring:
+                self.expiring.add(user_id)
+                expired.append(user_id)
+        return expired
+
+    async def run(self, on_expire):
+        """后台任务: 到期时对每个用户调用 await on_expire(user_id)"""
+        self.wakeup = asyncio.Event()
+        # wait_for 在等待的事件恰好完成时会吞掉取消，所以另外检查停止标志
+        while not self.stopping:
+            for user_id in self.pop_expired():
+                task = asyncio.create_task(on_expire(user_id))
+                self.expire_tasks.add(task)
+                task.add_done_callback(self.expire_tasks.discard)
+                # 处理失败时用户留在队列中，重启后重新处理
+                task.add_done_callback(lambda _, user_id=user_id: self.expiring.discard(user_id))
+            now = time.time()
+            # 合并一段时间内的修改，最多每 save_interval 秒写一次文件
+            if self.dirty and now - self.last_save >= self.save_interval:
+                self.save()
+                self.last_save = now
+            waits = []
+            if self.heap:
+                waits.append(self.heap[0][0] - now)
+            if self.dirty:
+                waits.append(self.last_save + self.save_interval - now)
+            wait = max(0.0, min(waits)) if waits else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, on_expire):
+        self.task = asyncio.create_task(self.run(on_expire))
+
+    async def stop(self):
+        self.stopping = True
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.save()
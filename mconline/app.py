@@ -1,20 +1,32 @@
-from flask import Flask, jsonify
-import requests
+from flask import Flask, jsonify, request
 import os
+import re
+import atexit
+import sys
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import datetime
 import platform
 import socket
 import pytz  # 添加 pytz 库
 
+# 共享模块位于仓库根目录的 common 目录
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from telegram_client import TelegramClient
+from rate_limiter import PRIORITY_HIGH
+from metrics import install_flask_metrics
+from uptime import UptimeHistory
+from heartbeat import HeartbeatMonitor, MemoryHeartbeatStore, TooManyHosts
+from state_store import SQLiteStateStore
+
 load_dotenv()
 
 app = Flask(__name__)
+install_flask_metrics(app, prefix='mconline')
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Global variables
-online_timestamp = None
 hostname = socket.gethostname()
 system_info = platform.system() + " " + platform.release()
 china_timezone = pytz.timezone('Asia/Shanghai')  # 定义东八区时区
@@ -22,12 +34,43 @@ china_timezone = pytz.timezone('Asia/Shanghai')  # 定义东八区时区
 # Telegram Bot Configuration
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", "YOUR_CHAT_ID")
+FLASK_HOST = os.environ.get("FLASK_HOST", "0.0.0.0")
+FLASK_PORT = int(os.environ.get("FLASK_PORT", 5007))
+DEBUG = os.environ.get("DEBUG", "False").lower() == "true"
+UPTIME_LOG = os.environ.get("UPTIME_LOG", "uptime.log")
+UPTIME_STATE = os.environ.get("UPTIME_STATE", "uptime_state.json")
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", 90))
+HEARTBEAT_MAX_HOSTS = int(os.environ.get("HEARTBEAT_MAX_HOSTS", 10000))
+HEARTBEAT_FORGET_AFTER = float(os.environ.get("HEARTBEAT_FORGET_AFTER", 7 * 86400))
+# file: 日志文件 + 进程内心跳状态，只能单进程运行；sqlite: 多个 worker 进程共享状态
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "file").lower()
+STATE_DB = os.environ.get("STATE_DB", "mconline.db")
+telegram_client = TelegramClient.from_env(TELEGRAM_BOT_TOKEN)
+
+# 上线/下线记录持久化到磁盘，重启后仍能计算在线时长
+if STATE_BACKEND == 'sqlite':
+    state_store = SQLiteStateStore(STATE_DB, china_timezone, max_hosts=HEARTBEAT_MAX_HOSTS)
+    uptime_history = state_store
+    heartbeat_store = state_store
+    # worker 退出时关闭本进程的数据库连接
+    atexit.register(state_store.close)
+else:
+    uptime_history = UptimeHistory(UPTIME_LOG, UPTIME_STATE, china_timezone)
+    # state 文件合并写入，退出前保存最后的变化
+    atexit.register(uptime_history.close)
+    heartbeat_store = MemoryHeartbeatStore(HEARTBEAT_MAX_HOSTS)
+
+def format_duration(seconds):
+    """格式化时长为 X小时 X分钟 X秒"""
+    hours, remainder = divmod(seconds, 3600)
+    minutes, remainder = divmod(remainder, 60)
+    return f"{int(hours)}小时 {int(minutes)}分钟 {int(remainder)}秒"
 
 @app.route('/online')
 def online():
     """Record system coming online and send notification"""
-    global online_timestamp
     online_timestamp = datetime.datetime.now(china_timezone)  # 使用东八区时区
+    uptime_history.record_online(online_timestamp)
     
     # Enhanced message (without hostname and system info)
     message = f"🟢 *大瑶 上线*\n\n" \
@@ -52,17 +95,13 @@ def online():
 @app.route('/offline')
 def offline():
     """Record system going offline and calculate uptime"""
-    global online_timestamp
     offline_timestamp = datetime.datetime.now(china_timezone)  # 使用东八区时区
+    online_timestamp = uptime_history.record_offline(offline_timestamp)
     
     # Calculate uptime
     if online_timestamp:
         time_diff = offline_timestamp - online_timestamp
-        hours, remainder = divmod(time_diff.total_seconds(), 3600)
-        minutes, remainder = divmod(remainder, 60)
-        seconds = int(remainder)
-        
-        uptime_str = f"{int(hours)}小时 {int(minutes)}分钟 {seconds}秒"
+        uptime_str = format_duration(time_diff.total_seconds())
         online_time_str = online_timestamp.strftime("%Y-%m-%d %H:%M:%S")
     else:
         uptime_str = "未知"
@@ -94,16 +133,93 @@ def offline():
         app.logger.error(f"Offline notification exception: {str(e)}")
         return jsonify({"status": "error", "message": "Notification send exception", "details": str(e)}), 500
 
+HOST_PATTERN = re.compile(r'^[A-Za-z0-9_.\-\u4e00-\u9fff]{1,64}$')
+
+def escape_markdown(text):
+    """转义 Telegram Markdown 特殊字符"""
+    return re.sub(r'([_*`\[])', r'\\\1', text)
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, china_timezone).strftime("%Y-%m-%d %H:%M:%S")
+
+def notify_host_online(host, timestamp):
+    message = f"🟢 *{escape_markdown(host)} 上线*\n\n" \
+              f"🕒 *时间*: {format_time(timestamp)}"
+    try:
+        send_telegram_message(message)
+    except Exception as e:
+        app.logger.error(f"Heartbeat online notification exception: {str(e)}")
+
+def notify_host_offline(host, first_seen, last_seen):
+    message = f"🔴 *{escape_markdown(host)} 下线* (心跳超时)\n\n" \
+              f"⬆️ *上线时间*: {format_time(first_seen)}\n" \
+              f"💓 *最后心跳*: {format_time(last_seen)}\n" \
+              f"⏱️ *在线时长*: {format_duration(last_seen - first_seen)}"
+    try:
+        send_telegram_message(message)
+    except Exception as e:
+        app.logger.error(f"Heartbeat offline notification exception: {str(e)}")
+
+# 离线通知在线程池中发送，避免大量主机同时超时阻塞监控线程
+notify_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="heartbeat-notify")
+heartbeat_monitor = HeartbeatMonitor(
+    notify_host_online,
+    lambda host, first_seen, last_seen: notify_executor.submit(notify_host_offline, host, first_seen, last_seen),
+    timeout=HEARTBEAT_TIMEOUT,
+    max_hosts=HEARTBEAT_MAX_HOSTS,
+    forget_after=HEARTBEAT_FORGET_AFTER,
+    store=heartbeat_store
+)
+
+def start_background_workers():
+    """启动心跳监控线程"""
+    heartbeat_monitor.start()
+
+@app.route('/heartbeat/<host>', methods=['GET', 'POST'])
+def heartbeat(host):
+    """Record a heartbeat; hosts that stop sending are reported offline automatically"""
+    if not HOST_PATTERN.match(host):
+        return jsonify({"status": "error", "message": "Invalid host name"}), 400
+    try:
+        came_online = heartbeat_monitor.beat(host)
+    except TooManyHosts as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
+    return jsonify({"status": "success", "host": host, "came_online": came_online, "timeout": HEARTBEAT_TIMEOUT})
+
+@app.route('/stats')
+def stats():
+    """Return uptime statistics, optionally with recent day/week/month buckets"""
+    period = request.args.get('period')
+    if period and period not in ('day', 'week', 'month'):
+        return jsonify({"status": "error", "message": "period must be day, week or month"}), 400
+    limit = request.args.get('limit', 7, type=int)
+    result = uptime_history.stats(period, max(0, limit))
+
+    total = result['total']
+    response = {
+        "status": "success",
+        "total_uptime": format_duration(total['uptime']),
+        "total_uptime_seconds": round(total['uptime'], 3),
+        "sessions": total['sessions'],
+        "longest_session": format_duration(total['longest']),
+        "longest_session_seconds": round(total['longest'], 3),
+        "online": result['online_since'] is not None,
+    }
+    if result['online_since'] is not None:
+        online_since = datetime.datetime.fromtimestamp(result['online_since'], china_timezone)
+        response["online_since"] = online_since.strftime("%Y-%m-%d %H:%M:%S")
+    if period:
+        response[period] = result[period]
+    response["heartbeat"] = heartbeat_monitor.snapshot()
+    return jsonify(response)
+
 def send_telegram_message(message):
     """Send message to Telegram with markdown formatting"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": message,
-        "parse_mode": "Markdown"
-    }
-    response = requests.post(url, json=payload)
+    response = telegram_client.send_message(TELEGRAM_CHAT_ID, message, priority=PRIORITY_HIGH, parse_mode="Markdown")
     return response.json()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5007, debug=True)
\ No newline at end of file
+    # 调试模式下只在重载器的子进程中启动监控线程
+    if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
+    app.run(host=FLASK_HOST, port=FLASK_PORT, debug=DEBUG)
\ No newline at end of file
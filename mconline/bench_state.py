@@ -0,0 +1,170 @@
+"""多进程并发压测 /online、/offline 和 /heartbeat，并校验共享状态的一致性
+
+默认启动本地 Telegram 桩服务和多 worker 的 gunicorn (STATE_BACKEND=sqlite)，
+压测结束后按事件日志顺序重新计算在线统计，与增量维护的统计逐项比较:
+    python bench_state.py --workers 4 --processes 8 -n 300
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import time
+
+import pytz
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, '..', 'common'))
+sys.path.insert(0, BASE_DIR)
+
+from telegram_stub import start_stub
+from uptime import EVENT_ONLINE, session_contributions
+
+china_timezone = pytz.timezone('Asia/Shanghai')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(port, workers, db_path, api_base):
+    env = dict(os.environ)
+    env.update({
+        'FLASK_HOST': '127.0.0.1',
+        'FLASK_PORT': str(port),
+        'WEB_WORKERS': str(workers),
+        'STATE_BACKEND': 'sqlite',
+        'STATE_DB': db_path,
+        'TELEGRAM_API_BASE': api_base,
+        'TELEGRAM_BOT_TOKEN': 'BENCH',
+        'TELEGRAM_CHAT_ID': '1',
+        # 桩服务不限流
+        'TELEGRAM_GLOBAL_RATE': '100000',
+        'TELEGRAM_CHAT_RATE': '100000',
+        'TELEGRAM_MAX_WAITING': '100000',
+    })
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+        cwd=BASE_DIR, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("gunicorn 启动超时")
+
+
+def hammer(args):
+    """单个压测进程: 随机请求 /online、/offline 和若干主机的 /heartbeat"""
+    base_url, index, requests_per_process, hosts = args
+    rng = random.Random(index)
+    session = requests.Session()
+    counts = {'online': 0, 'offline': 0, 'heartbeat': 0, 'errors': 0}
+    for _ in range(requests_per_process):
+        choice = rng.random()
+        if choice < 0.35:
+            path, kind = '/online', 'online'
+        elif choice < 0.7:
+            path, kind = '/offline', 'offline'
+        else:
+            path, kind = f"/heartbeat/bench-{rng.randrange(hosts)}", 'heartbeat'
+        try:
+            response = session.get(base_url + path, timeout=30)
+            if response.status_code != 200:
+                counts['errors'] += 1
+        except requests.RequestException:
+            counts['errors'] += 1
+        counts[kind] += 1
+    return counts
+
+
+def verify(db_path):
+    """按事件 ID 顺序回放日志，返回与增量统计不一致的项"""
+    conn = sqlite3.connect(db_path)
+    expected = {}
+    online_since = None
+    for event, timestamp in conn.execute('SELECT event, ts FROM uptime_events ORDER BY id'):
+        if event == EVENT_ONLINE:
+            online_since = timestamp
+            continue
+        start, online_since = online_since, None
+        if start is None or timestamp < start:
+            continue
+        duration = timestamp - start
+        rows = [(('total', ''), (duration, 1, duration))]
+        rows.extend(session_contributions(start, timestamp, china_timezone).items())
+        for key, (uptime, sessions, longest) in rows:
+            entry = expected.setdefault(key, [0.0, 0, 0.0])
+            entry[0] += uptime
+            entry[1] += sessions
+            entry[2] = max(entry[2], longest)
+
+    mismatches = []
+    actual = {(period, key): (uptime, sessions, longest) for period, key, uptime, sessions, longest
+              in conn.execute('SELECT period, key, uptime, sessions, longest FROM uptime_buckets')}
+    for key, (uptime, sessions, longest) in expected.items():
+        got = actual.get(key)
+        if got is None or got[1] != sessions or abs(got[0] - uptime) > 1e-6 or abs(got[2] - longest) > 1e-9:
+            mismatches.append((key, (uptime, sessions, longest), got))
+    stored_since = conn.execute('SELECT online_since FROM uptime_state WHERE id = 1').fetchone()[0]
+    if stored_since != online_since:
+        mismatches.append(('online_since', online_since, stored_since))
+    events = conn.execute('SELECT COUNT(*) FROM uptime_events').fetchone()[0]
+    hosts = conn.execute('SELECT COUNT(*), COALESCE(SUM(online), 0) FROM heartbeat_hosts').fetchone()
+    conn.close()
+    return mismatches, events, hosts, expected.get(('total', ''), [0.0, 0, 0.0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mconline 多进程状态一致性压测")
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn worker 进程数")
+    parser.add_argument('--processes', type=int, default=8, help="压测客户端进程数")
+    parser.add_argument('-n', '--requests', type=int, default=200, help="每个客户端进程的请求数")
+    parser.add_argument('--hosts', type=int, default=20, help="心跳主机数")
+    args = parser.parse_args()
+
+    stub, api_base = start_stub()
+    db_path = os.path.join(tempfile.mkdtemp(prefix='mconline-bench-'), 'state.db')
+    port = free_port()
+    server = start_gunicorn(port, args.workers, db_path, api_base)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        started = time.perf_counter()
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.map(hammer, [(base_url, index, args.requests, args.hosts)
+                                        for index in range(args.processes)])
+        elapsed = time.perf_counter() - started
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+        stub.shutdown()
+
+    totals = {key: sum(result[key] for result in results) for key in results[0]}
+    mismatches, events, (hosts, online_hosts), (uptime, sessions, _) = verify(db_path)
+    print(f"workers={args.workers} 客户端进程={args.processes} 请求={sum(totals[k] for k in ('online', 'offline', 'heartbeat'))} "
+          f"耗时={elapsed:.2f}s 吞吐={(args.processes * args.requests) / elapsed:.1f} req/s 错误={totals['errors']}")
+    print(f"事件={events} (online={totals['online']} offline={totals['offline']}) "
+          f"会话={sessions} 在线总时长={uptime:.3f}s 心跳主机={hosts} 在线={online_hosts}")
+    if events != totals['online'] + totals['offline']:
+        mismatches.append(('events', totals['online'] + totals['offline'], events))
+    if mismatches:
+        print("状态不一致:")
+        for item in mismatches[:20]:
+            print(f"  {item}")
+        sys.exit(1)
+    print("状态一致")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+# 生产环境运行: gunicorn -c gunicorn.conf.py wsgi:app
+# gevent worker 在单个事件循环中处理大量并发请求，requests 等阻塞调用会被自动协程化
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.getenv('FLASK_HOST') or '0.0.0.0'}:{os.getenv('FLASK_PORT', 5007)}"
+worker_class = 'gevent'
+# 多进程需要 STATE_BACKEND=sqlite，文件后端的状态保存在各自进程内存中
+workers = int(os.getenv('WEB_WORKERS', 1))
+if workers > 1 and os.getenv('STATE_BACKEND', 'file').lower() != 'sqlite':
+    print("STATE_BACKEND 不是 sqlite，只能使用单个 worker")
+    workers = 1
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
@@ -0,0 +1,199 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TooManyHosts(Exception):
+    """监控的主机数量已达上限"""
+
+
+class MemoryHeartbeatStore:
+    """进程内的心跳状态，只适用于单个 worker 进程"""
+
+    def __init__(self, max_hosts=10000):
+        self.max_hosts = max_hosts
+        # 主机 -> [是否在线, 上线时间, 最后心跳]
+        self.hosts = {}
+        self.online = 0
+        self.lock = threading.Lock()
+
+    def beat(self, host, now):
+        """记录心跳，主机新出现或从离线恢复时返回 True"""
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                if len(self.hosts) >= self.max_hosts:
+                    raise TooManyHosts(f"监控主机数已达上限 {self.max_hosts}")
+                self.hosts[host] = [True, now, now]
+                self.online += 1
+                return True
+            if not state[0]:
+                state[:] = [True, now, now]
+                self.online += 1
+                return True
+            state[2] = max(state[2], now)
+            return False
+
+    def expire(self, host, cutoff):
+        """最后心跳不晚于 cutoff 的在线主机标记为离线
+
+        返回 ('expired', 上线时间, 最后心跳)；仍在线时返回 ('alive', ...)；
+        主机不存在或已离线时返回 None。
+        """
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or not state[0]:
+                return None
+            if state[2] > cutoff:
+                return ('alive', state[1], state[2])
+            state[0] = False
+            self.online -= 1
+            return ('expired', state[1], state[2])
+
+    def forget(self, cutoff):
+        """移除最后心跳早于 cutoff 的离线主机"""
+        with self.lock:
+            stale = [host for host, state in self.hosts.items() if not state[0] and state[2] < cutoff]
+            for host in stale:
+                del self.hosts[host]
+        return len(stale)
+
+    def online_hosts(self):
+        with self.lock:
+            return [(host, state[2]) for host, state in self.hosts.items() if state[0]]
+
+    def snapshot(self):
+        with self.lock:
+            return {'hosts': len(self.hosts), 'online': self.online, 'offline': len(self.hosts) - self.online}
+
+
+class HeartbeatMonitor:
+    """基于截止时间小顶堆的心跳监控
+
+    每次心跳只向堆中压入一个新截止时间(O(log n))，被更新的旧条目在出堆时丢弃；
+    堆中过期条目过多时整体重建，内存与主机数成正比。
+
+    主机状态保存在 store 中。多个 worker 进程共享同一个 store 时，
+    每个进程只跟踪自己收到过心跳的主机；截止时间到达后由 store 原子地判断
+    是否真的超时(心跳可能被其他进程收到)，只有完成状态切换的进程发送离线通知。
+    """
+
+    def __init__(self, on_online, on_offline, timeout=90, max_hosts=10000, forget_after=7 * 86400, store=None):
+        self.on_online = on_online
+        self.on_offline = on_offline
+        self.timeout = timeout
+        self.store = store if store is not None else MemoryHeartbeatStore(max_hosts)
+        # 下线超过 forget_after 秒的主机从 store 中移除
+        self.forget_after = forget_after
+        self.last_forget = 0.0
+        # 本进程跟踪的主机 -> 最新截止时间
+        self.deadlines = {}
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _schedule(self, host, deadline):
+        """在持有 condition 时调用"""
+        if self.deadlines.get(host, float('-inf')) >= deadline:
+            return
+        earliest = self.heap[0][0] if self.heap else None
+        self.deadlines[host] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.sequence), host))
+        # 堆中大部分都是过期条目时重建
+        if len(self.heap) > 4 * len(self.deadlines) + 64:
+            self.heap = [(deadline, next(self.sequence), host) for host, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+        if earliest is None or deadline < earliest:
+            self.condition.notify()
+
+    def beat(self, host, now=None):
+        """记录一次心跳，主机从离线恢复时触发上线通知"""
+        now = time.time() if now is None else now
+        came_online = self.store.beat(host, now)
+        with self.condition:
+            self._schedule(host, now + self.timeout)
+        if came_online:
+            self.on_online(host, now)
+        return came_online
+
+    def check(self, now=None):
+        """处理已到期的截止时间，返回下一次需要检查的时间"""
+        now = time.time() if now is None else now
+        due = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, host = heapq.heappop(self.heap)
+                if self.deadlines.get(host) != deadline:
+                    continue
+                del self.deadlines[host]
+                due.append(host)
+
+        expired = []
+        for host in due:
+            try:
+                result = self.store.expire(host, now - self.timeout)
+            except Exception as e:
+                logger.error(f"检查主机 {host} 心跳失败: {e}")
+                result = ('alive', None, now)
+            if result is None:
+                continue
+            status, first_seen, last_seen = result
+            if status == 'expired':
+                expired.append((host, first_seen, last_seen))
+            else:
+                # 心跳被其他进程收到，按最新的心跳时间继续跟踪
+                with self.condition:
+                    self._schedule(host, last_seen + self.timeout)
+
+        if now - self.last_forget >= min(self.forget_after, 3600):
+            self.last_forget = now
+            try:
+                self.store.forget(now - self.forget_after)
+            except Exception as e:
+                logger.error(f"清理离线主机失败: {e}")
+
+        with self.condition:
+            next_deadline = self.heap[0][0] if self.heap else None
+        for host, first_seen, last_seen in expired:
+            try:
+                self.on_offline(host, first_seen, last_seen)
+            except Exception as e:
+                logger.error(f"发送主机 {host} 离线通知失败: {e}")
+        return next_deadline
+
+    def snapshot(self):
+        result = self.store.snapshot()
+        with self.condition:
+            result['tracked'] = len(self.deadlines)
+        return result
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            next_deadline = self.check()
+            with self.condition:
+                if self.stop_event.is_set():
+                    break
+                wait = None if next_deadline is None else max(0.0, next_deadline - time.time())
+                # 有更早的截止时间加入时会被唤醒；定期醒来以便响应停止
+                self.condition.wait(min(wait, 60.0) if wait is not None else 60.0)
+
+    def start(self):
+        # 重启后继续跟踪 store 中仍在线的主机，停机期间超时的会在第一次检查时下线
+        with self.condition:
+            for host, last_seen in self.store.online_hosts():
+                self._schedule(host, last_seen + self.timeout)
+        self.thread = threading.Thread(target=self._run, name="heartbeat-monitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
@@ -0,0 +1,253 @@
+import contextlib
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from heartbeat import TooManyHosts
+from uptime import EVENT_OFFLINE, EVENT_ONLINE, MAX_BUCKETS, session_contributions
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uptime_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event INTEGER NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uptime_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    online_since REAL
+);
+INSERT OR IGNORE INTO uptime_state (id, online_since) VALUES (1, NULL);
+CREATE TABLE IF NOT EXISTS uptime_buckets (
+    period TEXT NOT NULL,
+    key TEXT NOT NULL,
+    uptime REAL NOT NULL DEFAULT 0,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    longest REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, key)
+);
+CREATE TABLE IF NOT EXISTS heartbeat_hosts (
+    host TEXT PRIMARY KEY,
+    online INTEGER NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+-- 主机总数和在线数由触发器维护，新主机检查上限和 /status 不需要扫描整个表
+CREATE TABLE IF NOT EXISTS heartbeat_counts (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    hosts INTEGER NOT NULL,
+    online INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO heartbeat_counts (id, hosts, online)
+    SELECT 1, COUNT(*), COALESCE(SUM(online), 0) FROM heartbeat_hosts;
+CREATE TRIGGER IF NOT EXISTS heartbeat_hosts_ai AFTER INSERT ON heartbeat_hosts BEGIN
+    UPDATE heartbeat_counts SET hosts = hosts + 1, online = online + new.online WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS heartbeat_hosts_ad AFTER DELETE ON heartbeat_hosts BEGIN
+    UPDATE heartbeat_counts SET hosts = hosts - 1, online = online - old.online WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS heartbeat_hosts_au AFTER UPDATE OF online ON heartbeat_hosts
+WHEN new.online != old.online BEGIN
+    UPDATE heartbeat_counts SET online = online + new.online - old.online WHERE id = 1;
+END;
+"""
+
+ADD_BUCKET = """
+INSERT INTO uptime_buckets (period, key, uptime, sessions, longest) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (period, key) DO UPDATE SET
+    uptime = uptime + excluded.uptime,
+    sessions = sessions + excluded.sessions,
+    longest = max(longest, excluded.longest)
+"""
+
+PRUNE_BUCKETS = """
+DELETE FROM uptime_buckets WHERE period = ? AND key NOT IN (
+    SELECT key FROM uptime_buckets WHERE period = ? ORDER BY key DESC LIMIT ?
+)
+"""
+
+
+class SQLiteStateStore:
+    """WAL 模式的 SQLite 状态存储，多个 worker 进程共享同一份在线记录和心跳状态
+
+    上线/下线在 BEGIN IMMEDIATE 事务中完成"写日志 + 更新统计"，
+    事务之间由 SQLite 的写锁串行化，不会出现 A 进程记录上线、B 进程看不到的情况。
+    每个进程只打开一个连接，由锁保护(gevent 下是协程锁)；写锁被其他进程占用时
+    用 time.sleep 退避重试，gevent 下会让出给其他协程，而不是在 SQLite 内部阻塞整个 worker。
+    接口与 UptimeHistory 和 MemoryHeartbeatStore 相同，可直接替换。
+    """
+
+    def __init__(self, path, tz, max_hosts=10000, busy_timeout=5.0):
+        self.path = path
+        self.tz = tz
+        self.max_hosts = max_hosts
+        self.busy_timeout = busy_timeout
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        with self._connection() as conn:
+            self._retry(conn.executescript, SCHEMA)
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """独占本进程的连接；fork 出的 worker 进程打开自己的连接"""
+        with self.lock:
+            if self.conn is None or self.pid != os.getpid():
+                # timeout=0: 忙时立即返回，由 _retry 退避；isolation_level=None: 由我们显式控制事务
+                self.conn = sqlite3.connect(self.path, timeout=0, isolation_level=None, check_same_thread=False)
+                self._retry(self.conn.execute, 'PRAGMA journal_mode=WAL')
+                self.conn.execute('PRAGMA synchronous=NORMAL')
+                self.pid = os.getpid()
+            yield self.conn
+
+    def _retry(self, func, *args):
+        """数据库被其他进程锁住时退避重试，最多等待 busy_timeout 秒"""
+        deadline = time.monotonic() + self.busy_timeout
+        delay = 0.001
+        while True:
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                message = str(e)
+                if ('locked' not in message and 'busy' not in message) or time.monotonic() >= deadline:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None and self.pid == os.getpid():
+                self.conn.close()
+            self.conn = None
+
+    def _transaction(self, conn, func, *args):
+        """执行一次写事务；任何一步出错(包括 COMMIT 时数据库忙)都先回滚，连接上不会留下未结束的事务"""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(conn, *args)
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def _write(self, func, *args):
+        """在写事务中执行 func(conn, *args)，数据库忙时回滚后整个事务重试"""
+        with self._connection() as conn:
+            return self._retry(self._transaction, conn, func, *args)
+
+    # 在线记录 (与 UptimeHistory 相同的接口)
+
+    def _apply(self, conn, event, timestamp):
+        conn.execute('INSERT INTO uptime_events (event, ts) VALUES (?, ?)', (event, timestamp))
+        if event == EVENT_ONLINE:
+            conn.execute('UPDATE uptime_state SET online_since = ? WHERE id = 1', (timestamp,))
+            return None
+        start = conn.execute('SELECT online_since FROM uptime_state WHERE id = 1').fetchone()[0]
+        conn.execute('UPDATE uptime_state SET online_since = NULL WHERE id = 1')
+        if start is None or timestamp < start:
+            return None
+        duration = timestamp - start
+        rows = [('total', '', duration, 1, duration)]
+        for (period, key), (uptime, sessions, longest) in session_contributions(start, timestamp, self.tz).items():
+            rows.append((period, key, uptime, sessions, longest))
+        conn.executemany(ADD_BUCKET, rows)
+        for period, limit in MAX_BUCKETS.items():
+            conn.execute(PRUNE_BUCKETS, (period, period, limit))
+        return start
+
+    def record_online(self, moment):
+        self._write(self._apply, EVENT_ONLINE, moment.timestamp())
+
+    def record_offline(self, moment):
+        """记录下线，返回对应的上线时间(未知时返回 None)"""
+        start = self._write(self._apply, EVENT_OFFLINE, moment.timestamp())
+        if start is None:
+            return None
+        return datetime.datetime.fromtimestamp(start, self.tz)
+
+    def online_since(self):
+        with self._connection() as conn:
+            start = conn.execute('SELECT online_since FROM uptime_state WHERE id = 1').fetchone()[0]
+        if start is None:
+            return None
+        return datetime.datetime.fromtimestamp(start, self.tz)
+
+    def stats(self, period=None, limit=7):
+        """返回总计统计；指定 period(day/week/month) 时附带最近 limit 个桶"""
+        with self._connection() as conn:
+            # 读事务保证总计、分桶和在线状态来自同一个快照
+            self._retry(conn.execute, 'BEGIN')
+            try:
+                row = conn.execute(
+                    "SELECT uptime, sessions, longest FROM uptime_buckets WHERE period = 'total'"
+                ).fetchone() or (0.0, 0, 0.0)
+                result = {'total': {'uptime': row[0], 'sessions': row[1], 'longest': row[2]}}
+                if period:
+                    rows = conn.execute(
+                        'SELECT key, uptime, sessions, longest FROM uptime_buckets '
+                        'WHERE period = ? ORDER BY key DESC LIMIT ?', (period, limit)
+                    ).fetchall() if limit else []
+                    result[period] = {key: {'uptime': uptime, 'sessions': sessions, 'longest': longest}
+                                      for key, uptime, sessions, longest in reversed(rows)}
+                result['online_since'] = conn.execute(
+                    'SELECT online_since FROM uptime_state WHERE id = 1').fetchone()[0]
+            finally:
+                # 只读事务，结束时不会遇到写锁冲突
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+            return result
+
+    # 心跳状态 (与 MemoryHeartbeatStore 相同的接口)
+
+    def _beat(self, conn, host, now):
+        row = conn.execute('SELECT online FROM heartbeat_hosts WHERE host = ?', (host,)).fetchone()
+        if row is None:
+            count = conn.execute('SELECT hosts FROM heartbeat_counts WHERE id = 1').fetchone()[0]
+            if count >= self.max_hosts:
+                raise TooManyHosts(f"监控主机数已达上限 {self.max_hosts}")
+            conn.execute('INSERT INTO heartbeat_hosts (host, online, first_seen, last_seen) VALUES (?, 1, ?, ?)',
+                         (host, now, now))
+            return True
+        if not row[0]:
+            conn.execute('UPDATE heartbeat_hosts SET online = 1, first_seen = ?, last_seen = ? WHERE host = ?',
+                         (now, now, host))
+            return True
+        conn.execute('UPDATE heartbeat_hosts SET last_seen = max(last_seen, ?) WHERE host = ?', (now, host))
+        return False
+
+    def beat(self, host, now):
+        return self._write(self._beat, host, now)
+
+    def _expire(self, conn, host, cutoff):
+        row = conn.execute('SELECT online, first_seen, last_seen FROM heartbeat_hosts WHERE host = ?',
+                           (host,)).fetchone()
+        if row is None or not row[0]:
+            return None
+        online, first_seen, last_seen = row
+        if last_seen > cutoff:
+            return ('alive', first_seen, last_seen)
+        conn.execute('UPDATE heartbeat_hosts SET online = 0 WHERE host = ?', (host,))
+        return ('expired', first_seen, last_seen)
+
+    def expire(self, host, cutoff):
+        return self._write(self._expire, host, cutoff)
+
+    def forget(self, cutoff):
+        return self._write(
+            lambda conn: conn.execute('DELETE FROM heartbeat_hosts WHERE online = 0 AND last_seen < ?',
+                                      (cutoff,)).rowcount)
+
+    def online_hosts(self):
+        with self._connection() as conn:
+            return conn.execute('SELECT host, last_seen FROM heartbeat_hosts WHERE online = 1').fetchall()
+
+    def snapshot(self):
+        with self._connection() as conn:
+            hosts, online = conn.execute('SELECT hosts, online FROM heartbeat_counts WHERE id = 1').fetchone()
+        return {'hosts': hosts, 'online': online, 'offline': hosts - online}
@@ -0,0 +1,238 @@
+import datetime
+import itertools
+import json
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+# 每条记录: 事件类型(1=上线, 0=下线) + Unix 时间戳，共 9 字节
+RECORD = struct.Struct('<Bd')
+EVENT_OFFLINE = 0
+EVENT_ONLINE = 1
+
+logger = logging.getLogger(__name__)
+
+# 保留的聚合桶数量
+MAX_BUCKETS = {'day': 400, 'week': 260, 'month': 240}
+
+
+def _empty_stats():
+    return {'uptime': 0.0, 'sessions': 0, 'longest': 0.0}
+
+
+def bucket_keys(moment):
+    """时间所在的日/周/月统计桶"""
+    iso_year, iso_week, _ = moment.isocalendar()
+    return {
+        'day': moment.strftime('%Y-%m-%d'),
+        'week': f"{iso_year}-W{iso_week:02d}",
+        'month': moment.strftime('%Y-%m'),
+    }
+
+
+def session_contributions(start, end, tz):
+    """计算一次在线对各统计桶的贡献: {(period, key): [在线秒数, 会话数, 最长会话]}
+
+    在线时长按自然日拆分，会话数和最长会话计入结束时间所在的桶。
+    """
+    contributions = {}
+    start_dt = datetime.datetime.fromtimestamp(start, tz)
+    end_dt = datetime.datetime.fromtimestamp(end, tz)
+    cursor = start_dt
+    while cursor < end_dt:
+        next_day = (cursor + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        segment_end = min(end_dt, next_day)
+        seconds = (segment_end - cursor).total_seconds()
+        for period, key in bucket_keys(cursor).items():
+            contributions.setdefault((period, key), [0.0, 0, 0.0])[0] += seconds
+        cursor = segment_end
+
+    duration = end - start
+    for period, key in bucket_keys(end_dt).items():
+        entry = contributions.setdefault((period, key), [0.0, 0, 0.0])
+        entry[1] += 1
+        entry[2] = max(entry[2], duration)
+    return contributions
+
+
+class UptimeHistory:
+    """上线/下线记录追加写入日志，同时增量维护按日/周/月的在线统计
+
+    统计保存在 state 文件中，查询时不需要重新扫描日志；
+    state 记录了已处理的日志偏移，启动时只需回放之后的部分。
+    日志每条都 fsync，state 最多每 save_interval 秒写一次，落后的部分启动时回放。
+    各周期的统计桶按键有序保存，淘汰最早的桶是 O(1)。
+    """
+
+    def __init__(self, log_path, state_path, tz, save_interval=1.0):
+        self.log_path = log_path
+        self.state_path = state_path
+        self.tz = tz
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.timer = None
+        self.state = self._new_state()
+        self._load()
+
+    @staticmethod
+    def _new_state():
+        return {
+            'offset': 0,
+            'online_since': None,
+            'total': _empty_stats(),
+            'day': OrderedDict(),
+            'week': OrderedDict(),
+            'month': OrderedDict(),
+        }
+
+    def _load(self):
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+                for period in MAX_BUCKETS:
+                    self.state[period] = OrderedDict(sorted(self.state[period].items()))
+            except (OSError, ValueError) as e:
+                logger.error(f"读取在线统计失败，将从日志重建: {e}")
+                self.state = self._new_state()
+        self._replay()
+
+    def _replay(self):
+        """回放 state 之后写入的日志记录(例如写日志后、保存 state 前进程退出)"""
+        if not os.path.exists(self.log_path):
+            return
+        size = os.path.getsize(self.log_path)
+        offset = self.state['offset']
+        if offset > size:
+            # 日志被替换过，重新统计
+            self.state = self._new_state()
+            offset = 0
+        if offset == size:
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                chunk = f.read(RECORD.size)
+                if len(chunk) < RECORD.size:
+                    break
+                event, timestamp = RECORD.unpack(chunk)
+                self._apply(event, timestamp)
+                offset += RECORD.size
+        self.state['offset'] = offset
+        self._save()
+
+    def _save(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+        self.dirty = False
+
+    def _schedule_save(self):
+        """合并 save_interval 秒内的状态变化，一次写入 state 文件"""
+        self.dirty = True
+        if self.timer is None:
+            self.timer = threading.Timer(self.save_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if self.dirty:
+                self._save()
+
+    def close(self):
+        """退出前写入未保存的状态"""
+        timer = self.timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+
+    def _bucket(self, period, key):
+        buckets = self.state[period]
+        bucket = buckets.get(key)
+        if bucket is not None:
+            return bucket
+        newest = next(reversed(buckets), None)
+        bucket = buckets[key] = _empty_stats()
+        if newest is not None and key < newest:
+            # 比已有的桶更早(时钟回拨)，重新排序
+            buckets = self.state[period] = OrderedDict(sorted(buckets.items()))
+        while len(buckets) > MAX_BUCKETS[period]:
+            buckets.popitem(last=False)
+        return bucket
+
+    def _add_to_buckets(self, start, end):
+        for (period, key), (uptime, sessions, longest) in session_contributions(start, end, self.tz).items():
+            bucket = self._bucket(period, key)
+            bucket['uptime'] += uptime
+            bucket['sessions'] += sessions
+            bucket['longest'] = max(bucket['longest'], longest)
+
+    def _apply(self, event, timestamp):
+        if event == EVENT_ONLINE:
+            # 未收到下线就再次上线时，上一次会话的结束时间未知，不计入统计
+            self.state['online_since'] = timestamp
+            return None
+        start = self.state['online_since']
+        self.state['online_since'] = None
+        if start is None or timestamp < start:
+            return None
+        duration = timestamp - start
+        total = self.state['total']
+        total['uptime'] += duration
+        total['sessions'] += 1
+        total['longest'] = max(total['longest'], duration)
+        self._add_to_buckets(start, timestamp)
+        return start
+
+    def _record(self, event, moment):
+        timestamp = moment.timestamp()
+        with self.lock:
+            with open(self.log_path, 'ab') as f:
+                size = f.tell()
+                if size % RECORD.size:
+                    # 丢弃上次写入中断留下的半条记录
+                    f.truncate(size - size % RECORD.size)
+                f.write(RECORD.pack(event, timestamp))
+                f.flush()
+                os.fsync(f.fileno())
+                offset = f.tell()
+            start = self._apply(event, timestamp)
+            self.state['offset'] = offset
+            self._schedule_save()
+        return start
+
+    def record_online(self, moment):
+        self._record(EVENT_ONLINE, moment)
+
+    def record_offline(self, moment):
+        """记录下线，返回对应的上线时间(未知时返回 None)"""
+        start = self._record(EVENT_OFFLINE, moment)
+        if start is None:
+            return None
+        return datetime.datetime.fromtimestamp(start, self.tz)
+
+    def online_since(self):
+        with self.lock:
+            start = self.state['online_since']
+        if start is None:
+            return None
+        return datetime.datetime.fromtimestamp(start, self.tz)
+
+    def stats(self, period=None, limit=7):
+        """返回总计统计；指定 period(day/week/month) 时附带最近 limit 个桶"""
+        with self.lock:
+            result = {'total': dict(self.state['total'])}
+            if period:
+                buckets = self.state[period]
+                keys = reversed(list(itertools.islice(reversed(buckets), limit)))
+                result[period] = {key: dict(buckets[key]) for key in keys}
+            online_since = self.state['online_since']
+        result['online_since'] = online_since
+        return result
+
@@ -5,6 +5,8 @@ from dotenv import load_dotenv
 from telegram import Update, ChatPermissions
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 from telegram.error import TelegramError
+from pending import PendingVerifications
+from deletion import DeletionScheduler
 
 # 加载环境变量
 load_dotenv()
@@ -15,6 +17,12 @@ ADMIN_IDS = [int(id_) for id_ in os.getenv('ADMIN_IDS').split(',')]
 DELETE_DELAY = int(os.getenv('DELETE_DELAY', 3))
 BAN_MSG_DELAY = int(os.getenv('BAN_MSG_DELAY', 3))
 VERIFY_TIMEOUT = int(os.getenv('VERIFY_TIMEOUT', 30))
+# 每个群最多同时验证的用户数 / 同时处理的更新数
+MAX_PENDING_PER_CHAT = int(os.getenv('MAX_PENDING_PER_CHAT', 1000))
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 32))
+# 待删除消息保存文件 / 同一群内相差多少秒内到期的消息合并为一次删除
+DELETION_FILE = os.getenv('DELETION_FILE', 'pending_deletions.json')
+DELETE_COALESCE = float(os.getenv('DELETE_COALESCE', 1.0))
 
 # Webhook配置
 WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')  # 例如 'https://example.com'
@@ -38,8 +46,11 @@ logging.basicConfig(
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
-# 存储待验证用户信息
-pending_users = {}
+# 存储待验证用户信息，按 (群ID, 用户ID) 区分，超过验证时间很久仍未清理的条目自动释放
+pending_users = PendingVerifications(ttl=VERIFY_TIMEOUT * 2 + 60, max_per_chat=MAX_PENDING_PER_CHAT)
+
+# 所有延迟删除由一个后台任务按群批量执行，重启后继续
+deletion_scheduler = DeletionScheduler(DELETION_FILE, coalesce=DELETE_COALESCE)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -57,24 +68,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text="你不是管理员，无权使用我。"
         )
     
-    # 创建后台任务来处理延迟删除，而不是直接等待
+    # 交给删除任务延迟删除，而不是直接等待
     chat_id = update.effective_chat.id
-    asyncio.create_task(delayed_delete_messages(
-        chat_id, 
-        [original_message_id, response_message.message_id], 
-        context.bot, 
-        DELETE_DELAY
-    ))
-
-# 添加一个通用的延迟删除消息函数
-async def delayed_delete_messages(chat_id: int, message_ids: list, bot, delay: int):
-    """在指定延迟后删除消息的通用函数"""
-    await asyncio.sleep(delay)
-    for msg_id in message_ids:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=msg_id)
-        except TelegramError as e:
-            logging.error(f"删除消息失败 - 消息ID:{msg_id} - {e}")
+    deletion_scheduler.schedule(chat_id, [original_message_id, response_message.message_id], DELETE_DELAY)
 
 async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理新成员入群事件"""
@@ -82,6 +78,15 @@ async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logging.info(f"新成员入群事件触发 - Chat ID: {chat_id}")
     
     for new_member in update.message.new_chat_members:
+        # 记录用户加入时间和验证状态；先于限制权限记录，并发处理时不会漏掉紧随其后的验证消息
+        state, evicted = pending_users.add(chat_id, new_member.id)
+        # 群内待验证用户过多时淘汰最早的，立即按超时处理，不会停留在只能发文本的状态；
+        # 仍在入群处理中的用户由入群处理在限制权限之后处理
+        for evicted_user_id, evicted_state in evicted:
+            evicted_state['evicted'] = True
+            if evicted_state.get('started'):
+                asyncio.create_task(finish_verification(evicted_user_id, chat_id, context.bot, evicted_state))
+
         # 先限制用户权限
         try:
             await context.bot.restrict_chat_member(
@@ -99,15 +104,9 @@ async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
         except TelegramError as e:
             logging.error(f"Failed to restrict user {new_member.id} - {e}")
+            pending_users.pop(chat_id, new_member.id, state)
             continue
 
-        # 记录用户加入时间和验证状态
-        pending_users[new_member.id] = {
-            'verified': False,
-            'join_time': asyncio.get_event_loop().time(),
-            'messages_to_delete': []  # 存储需要删除的消息ID
-        }
-        
         welcome_message = (
             f"欢迎新成员 {new_member.full_name} 加入！\n"
             f"请在30秒内发送 'hi' 完成验证，否则将被永久禁言。\n"
@@ -120,10 +119,16 @@ async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE)
             chat_id=chat_id,
             text=welcome_message
         )
-        pending_users[new_member.id]['messages_to_delete'].append(welcome_msg.message_id)
-        
+        state['messages_to_delete'].append(welcome_msg.message_id)
+
+        if state.get('evicted'):
+            # 入群处理期间被淘汰
+            await finish_verification(new_member.id, chat_id, context.bot, state)
+            continue
+
         # 启动验证检查任务
-        asyncio.create_task(check_verification(new_member.id, chat_id, context.bot))
+        state['started'] = True
+        asyncio.create_task(check_verification(new_member.id, chat_id, context.bot, state))
         
         logging.info(f"New member joined: ID={new_member.id}, Name={new_member.full_name}")
 
@@ -133,12 +138,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = update.message.text.lower()
     chat_id = update.effective_chat.id
     
-    if user_id in pending_users and not pending_users[user_id]['verified']:
+    state = pending_users.get(chat_id, user_id)
+    if state is not None and not state['verified']:
         # 记录用户发送的验证消息ID
-        pending_users[user_id]['messages_to_delete'].append(update.message.message_id)
+        state['messages_to_delete'].append(update.message.message_id)
         
         if message_text == 'hi':
-            pending_users[user_id]['verified'] = True
+            state['verified'] = True
             try:
                 # 解除用户限制
                 await context.bot.restrict_chat_member(
@@ -162,46 +168,45 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text=f"验证成功，欢迎加入！"
             )
             # 记录验证成功消息ID
-            pending_users[user_id]['messages_to_delete'].append(success_msg.message_id)
+            state['messages_to_delete'].append(success_msg.message_id)
 
-async def check_verification(user_id: int, chat_id: int, bot):
+async def check_verification(user_id: int, chat_id: int, bot, state: dict):
     """检查用户是否在30秒内完成验证"""
     await asyncio.sleep(VERIFY_TIMEOUT)
-    if user_id in pending_users:
-        # 仅删除我们已记录的消息
-        for msg_id in pending_users[user_id]['messages_to_delete']:
-            try:
-                await bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except TelegramError:
-                pass
+    # 期间重新入群或被淘汰的用户由新的检查任务或淘汰时处理
+    state = pending_users.pop(chat_id, user_id, state)
+    if state is not None:
+        await finish_verification(user_id, chat_id, bot, state)
 
-        if not pending_users[user_id]['verified']:
-            try:
-                # 改为永久禁言而非封禁
-                await bot.restrict_chat_member(
-                    chat_id=chat_id, 
-                    user_id=user_id,
-                    permissions=ChatPermissions(
-                        can_send_messages=False,
-                        can_send_other_messages=False,
-                        can_add_web_page_previews=False,
-                        can_send_polls=False,
-                        can_change_info=False,
-                        can_invite_users=False,
-                        can_pin_messages=False
-                    )
-                )
-                ban_msg = await bot.send_message(
-                    chat_id=chat_id,
-                    text=f"用户 ID:{user_id} 未在30秒内完成验证，已被永久禁言。"
+async def finish_verification(user_id: int, chat_id: int, bot, state: dict):
+    """验证结束: 删除记录的消息，未验证的用户永久禁言"""
+    # 仅删除我们已记录的消息
+    deletion_scheduler.schedule(chat_id, state['messages_to_delete'], 0)
+
+    if not state['verified']:
+        try:
+            # 改为永久禁言而非封禁
+            await bot.restrict_chat_member(
+                chat_id=chat_id, 
+                user_id=user_id,
+                permissions=ChatPermissions(
+                    can_send_messages=False,
+                    can_send_other_messages=False,
+                    can_add_web_page_previews=False,
+                    can_send_polls=False,
+                    can_change_info=False,
+                    can_invite_users=False,
+                    can_pin_messages=False
                 )
-                # 等待指定时间后删除禁言提示消息
-                await asyncio.sleep(BAN_MSG_DELAY)
-                await bot.delete_message(chat_id=chat_id, message_id=ban_msg.message_id)
-            except TelegramError as e:
-                logging.error(f"Failed to restrict user ID:{user_id} - {e}")
-        
-        del pending_users[user_id]
+            )
+            ban_msg = await bot.send_message(
+                chat_id=chat_id,
+                text=f"用户 ID:{user_id} 未在30秒内完成验证，已被永久禁言。"
+            )
+            # 指定时间后删除禁言提示消息
+            deletion_scheduler.schedule(chat_id, [ban_msg.message_id], BAN_MSG_DELAY)
+        except TelegramError as e:
+            logging.error(f"Failed to restrict user ID:{user_id} - {e}")
 
 async def set_chinese(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理设置中文语言的命令"""
@@ -216,13 +221,8 @@ async def set_chinese(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
         
-        # 创建后台任务来处理延迟删除
-        asyncio.create_task(delayed_delete_messages(
-            update.effective_chat.id,
-            [original_message_id, reply_message.message_id],
-            context.bot,
-            DELETE_DELAY
-        ))
+        # 交给删除任务延迟删除
+        deletion_scheduler.schedule(update.effective_chat.id, [original_message_id, reply_message.message_id], DELETE_DELAY)
             
     except TelegramError as e:
         logging.error(f"Failed to send language setting message - {e}")
@@ -245,21 +245,17 @@ async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.reply_to_message:
         try:
             error_msg = await update.message.reply_text("请回复要删除的消息。")
-            # 创建后台任务来处理延迟删除
-            asyncio.create_task(delayed_delete_messages(
-                chat_id,
-                [update.message.message_id, error_msg.message_id],
-                context.bot,
-                DELETE_DELAY
-            ))
+            # 交给删除任务延迟删除
+            deletion_scheduler.schedule(chat_id, [update.message.message_id, error_msg.message_id], DELETE_DELAY)
         except TelegramError as e:
             logging.error(f"删除消息失败 - {e}")
         return
         
     try:
-        # 删除被回复的消息和命令消息
-        await update.message.reply_to_message.delete()
-        await update.message.delete()
+        # 一次调用删除被回复的消息和命令消息
+        await context.bot.delete_messages(
+            chat_id, [update.message.reply_to_message.message_id, update.message.message_id]
+        )
     except TelegramError as e:
         logging.error(f"删除消息失败 - {e}")
 
@@ -294,12 +290,7 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "使用方式: /ban <用户ID> [原因] 或回复要封禁的用户消息并使用 /ban [原因]"
             )
             # 延迟删除错误提示和命令消息
-            asyncio.create_task(delayed_delete_messages(
-                chat_id,
-                [update.message.message_id, error_msg.message_id],
-                context.bot,
-                DELETE_DELAY
-            ))
+            deletion_scheduler.schedule(chat_id, [update.message.message_id, error_msg.message_id], DELETE_DELAY)
             return
         
         # 尝试获取用户ID
@@ -311,35 +302,20 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except ValueError:
             error_msg = await update.message.reply_text("无效的用户ID格式，请提供数字ID。")
             # 延迟删除错误提示和命令消息
-            asyncio.create_task(delayed_delete_messages(
-                chat_id,
-                [update.message.message_id, error_msg.message_id],
-                context.bot,
-                DELETE_DELAY
-            ))
+            deletion_scheduler.schedule(chat_id, [update.message.message_id, error_msg.message_id], DELETE_DELAY)
             return
     
     # 检查不要封禁自己或其他管理员
     if target_user_id == user_id:
         error_msg = await update.message.reply_text("不能封禁自己。")
         # 延迟删除错误提示和命令消息
-        asyncio.create_task(delayed_delete_messages(
-            chat_id,
-            [update.message.message_id, error_msg.message_id],
-            context.bot,
-            DELETE_DELAY
-        ))
+        deletion_scheduler.schedule(chat_id, [update.message.message_id, error_msg.message_id], DELETE_DELAY)
         return
     
     if is_admin(target_user_id):
         error_msg = await update.message.reply_text("不能封禁其他管理员。")
         # 延迟删除错误提示和命令消息
-        asyncio.create_task(delayed_delete_messages(
-            chat_id,
-            [update.message.message_id, error_msg.message_id],
-            context.bot,
-            DELETE_DELAY
-        ))
+        deletion_scheduler.schedule(chat_id, [update.message.message_id, error_msg.message_id], DELETE_DELAY)
         return
     
     # 执行封禁操作
@@ -360,26 +336,24 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.delete()
         
         # 延迟删除封禁通知
-        asyncio.create_task(delayed_delete_messages(
-            chat_id,
-            [ban_msg.message_id],
-            context.bot,
-            BAN_MSG_DELAY
-        ))
+        deletion_scheduler.schedule(chat_id, [ban_msg.message_id], BAN_MSG_DELAY)
         
         logging.info(f"Admin {user_id} banned user {target_user_id}. Reason: {reason}")
         
     except TelegramError as e:
         error_msg = await update.message.reply_text(f"封禁失败: {str(e)}")
         # 延迟删除错误提示和命令消息
-        asyncio.create_task(delayed_delete_messages(
-            chat_id,
-            [update.message.message_id, error_msg.message_id],
-            context.bot,
-            DELETE_DELAY
-        ))
+        deletion_scheduler.schedule(chat_id, [update.message.message_id, error_msg.message_id], DELETE_DELAY)
         logging.error(f"Failed to ban user {target_user_id} - {e}")
 
+async def post_init(application):
+    """启动删除任务，停机期间已到期的消息立即删除"""
+    deletion_scheduler.start(application.bot)
+
+async def post_shutdown(application):
+    """保存未删除的消息，记录批量删除节省的 API 调用"""
+    await deletion_scheduler.stop()
+
 if __name__ == '__main__':
     # 设置更详细的日志级别
     logging.getLogger().setLevel(logging.DEBUG)
@@ -391,7 +365,8 @@ if __name__ == '__main__':
         logging.error("缺少 WEBHOOK_HOST 配置，请检查 .env 文件")
         exit(1)
     
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    application = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES) \
+        .post_init(post_init).post_shutdown(post_shutdown).build()
     
     # 按照优先级顺序添加处理器
     # 1. 新成员处理器（最高优先级）
@@ -0,0 +1,147 @@
+"""多群并发入群负载测试
+
+模拟很多群同时有新成员加入，同一批用户会加入多个群，部分用户在部分群里完成验证。
+检查每个 (群, 用户) 的结果互不影响: 未验证的恰好被禁言，已验证的没有被禁言，
+超过 --max-per-chat 被淘汰的用户按超时禁言，结束后待验证状态全部释放。
+用法: python bench_pending.py --chats 300 --joins 20 --users 2000 --timeout 2 --max-per-chat 15
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+parser = argparse.ArgumentParser(description="多群并发入群负载测试")
+parser.add_argument('--chats', type=int, default=300, help="群数量")
+parser.add_argument('--joins', type=int, default=20, help="每个群的入群人数")
+parser.add_argument('--users', type=int, default=2000, help="用户池大小，同一用户会加入多个群")
+parser.add_argument('--timeout', type=int, default=2, help="验证超时秒数")
+parser.add_argument('--max-per-chat', type=int, default=1000, help="每个群最多的待验证用户数")
+parser.add_argument('--latency', type=float, default=0.005, help="模拟的 API 延迟秒数")
+args = parser.parse_args()
+
+os.environ.setdefault('BOT_TOKEN', '1:x')
+os.environ.setdefault('ADMIN_IDS', '1')
+os.environ['VERIFY_TIMEOUT'] = str(args.timeout)
+os.environ['MAX_PENDING_PER_CHAT'] = str(args.max_per_chat)
+os.environ.setdefault('DELETION_FILE', os.path.join(tempfile.mkdtemp(), 'pending_deletions.json'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app  # noqa: E402
+from telegram import Message, Update  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.message_id = 0
+        self.deleted = 0
+        # (群ID, 用户ID) -> 最后一次设置的 (can_send_messages, can_send_other_messages)
+        self.permissions = {}
+
+    async def _call(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    async def restrict_chat_member(self, chat_id, user_id, permissions, **kwargs):
+        await self._call()
+        self.permissions[(chat_id, user_id)] = (permissions.can_send_messages,
+                                                permissions.can_send_other_messages)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call()
+        self.message_id += 1
+        return type('SentMessage', (), {'message_id': self.message_id})()
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        await self._call()
+        self.deleted += len(message_ids)
+
+
+class Context:
+    def __init__(self, bot):
+        self.bot = bot
+        self.args = []
+
+
+def make_update(update_id, chat_id, user_id, text=None):
+    data = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'},
+    }
+    if text is None:
+        data['new_chat_members'] = [{'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'}]
+    else:
+        data['text'] = text
+    return Update(update_id, message=Message.de_json(data, None))
+
+
+async def main():
+    logging.disable(logging.CRITICAL)
+    bot = FakeBot(args.latency)
+    context = Context(bot)
+    chats = [-1000000000000 - index for index in range(args.chats)]
+    pairs = [(chat_id, user_id) for chat_id in chats
+             for user_id in random.sample(range(1000, 1000 + args.users), args.joins)]
+    verified = set(random.sample(pairs, len(pairs) // 2))
+    # 入群按顺序记录，每个群最早加入的用户被淘汰，之后发送的验证消息不再生效
+    evicted = {pair for index, pair in enumerate(pairs) if index % args.joins < args.joins - args.max_per_chat}
+
+    app.deletion_scheduler.start(bot)
+    tracemalloc.start()
+    started = time.perf_counter()
+    update_id = 0
+    joins = []
+    for chat_id, user_id in pairs:
+        update_id += 1
+        joins.append(app.handle_new_members(make_update(update_id, chat_id, user_id), context))
+    await asyncio.gather(*joins)
+    join_elapsed = time.perf_counter() - started
+    peak_entries, peak_chats = len(app.pending_users), app.pending_users.chat_count()
+    _, peak_memory = tracemalloc.get_traced_memory()
+
+    messages = []
+    for chat_id, user_id in pairs:
+        update_id += 1
+        text = 'hi' if (chat_id, user_id) in verified else 'hello'
+        messages.append(app.handle_message(make_update(update_id, chat_id, user_id, text), context))
+    await asyncio.gather(*messages)
+
+    # 等待所有验证检查任务和删除结束
+    await asyncio.sleep(args.timeout + args.latency * 10 + 1)
+    while len(asyncio.all_tasks()) > 2 or len(app.deletion_scheduler):
+        await asyncio.sleep(0.1)
+    await app.deletion_scheduler.stop()
+    tracemalloc.stop()
+
+    shared = len(pairs) - len({user_id for _, user_id in pairs})
+    print(f"群: {args.chats}  入群: {len(pairs)}  加入多个群的重复入群: {shared}")
+    print(f"入群处理: {join_elapsed:.2f}s ({len(pairs) / join_elapsed:.0f} 次/秒)  API 调用: {bot.calls}")
+    print(f"峰值待验证: {peak_entries} 个，分布在 {peak_chats} 个群  峰值内存: {peak_memory / 1024 / 1024:.1f} MB")
+    print(f"结束后待验证: {len(app.pending_users)} 个，{app.pending_users.chat_count()} 个群  被淘汰: {len(evicted)} 个")
+    print(app.deletion_scheduler.report())
+
+    errors = 0
+    for pair in pairs:
+        # 验证通过的解除限制，未验证的最终禁言
+        expected = (True, True) if pair in verified and pair not in evicted else (False, False)
+        if bot.permissions.get(pair) != expected:
+            errors += 1
+    if bot.deleted != app.deletion_scheduler.deleted:
+        errors += 1
+    if errors or len(app.pending_users):
+        print(f"错误: {errors} 个 (群, 用户) 的结果不正确")
+        return 1
+    print("各群验证结果互不影响")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
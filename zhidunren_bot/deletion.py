@@ -0,0 +1,184 @@
+import asyncio
+import datetime
+import heapq
+import json
+import logging
+import os
+import time
+
+from telegram.error import RetryAfter, TelegramError
+
+# deleteMessages 每次最多删除的消息数
+MAX_BATCH = 100
+
+
+class DeletionScheduler:
+    """延迟删除消息，按群合并为批量 deleteMessages 调用
+
+    待删除的消息按群保存: 群ID -> {消息ID: 删除时间}，群的最早删除时间放在小顶堆中，
+    一个后台任务统一处理。某个群有消息到期时，该群 coalesce 秒内将到期的消息一起删除，
+    每次调用最多 100 条。待删除列表定期写入文件，重启后继续删除。
+    """
+
+    def __init__(self, file_path='pending_deletions.json', coalesce=1.0, save_interval=1.0,
+                 report_interval=600):
+        self.file_path = file_path
+        self.coalesce = coalesce
+        self.save_interval = save_interval
+        self.report_interval = report_interval
+        # 群ID -> {消息ID: 删除时间(time.time())}
+        self.pending = {}
+        self.heap = []
+        self.dirty = False
+        self.last_save = 0.0
+        self.wakeup = None
+        self.task = None
+        # 删除的消息数和实际的 API 调用次数，逐条删除时两者相等
+        self.deleted = 0
+        self.api_calls = 0
+        self.last_report = (0, 0)
+        self.load()
+
+    def load(self):
+        """从文件恢复待删除的消息"""
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.pending = {int(chat_id): {int(message_id): float(deadline) for message_id, deadline in messages.items()}
+                            for chat_id, messages in data.items() if messages}
+        except Exception as e:
+            logging.error(f"加载待删除消息时出错: {e}")
+            return
+        self.heap = [(min(messages.values()), chat_id) for chat_id, messages in self.pending.items()]
+        heapq.heapify(self.heap)
+
+    def save(self):
+        """原子写入待删除的消息"""
+        tmp_path = self.file_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.pending, f)
+            os.replace(tmp_path, self.file_path)
+            self.dirty = False
+        except Exception as e:
+            logging.error(f"保存待删除消息时出错: {e}")
+
+    def _mark_dirty(self):
+        if not self.dirty:
+            self.dirty = True
+            # 唤醒后台任务安排下一次保存
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+    def __len__(self):
+        return sum(len(messages) for messages in self.pending.values())
+
+    def schedule(self, chat_id, message_ids, delay, now=None):
+        """delay 秒后删除 chat_id 中的消息"""
+        deadline = (time.time() if now is None else now) + delay
+        messages = self.pending.setdefault(chat_id, {})
+        earliest = self.heap[0][0] if self.heap else None
+        for message_id in message_ids:
+            messages[message_id] = min(deadline, messages.get(message_id, deadline))
+        heapq.heappush(self.heap, (deadline, chat_id))
+        self._mark_dirty()
+        if self.wakeup is not None and (earliest is None or deadline < earliest):
+            self.wakeup.set()
+
+    def pop_due(self, now=None):
+        """取出所有有消息到期的群，以及这些群 coalesce 秒内将到期的消息: [(群ID, [消息ID])]"""
+        now = time.time() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, chat_id = heapq.heappop(self.heap)
+            messages = self.pending.get(chat_id)
+            if not messages:
+                continue
+            limit = now + self.coalesce
+            batch = [message_id for message_id, deadline in messages.items() if deadline <= limit]
+            if not batch:
+                # 堆中的旧条目，该群的消息已经被提前删除
+                continue
+            for message_id in batch:
+                del messages[message_id]
+            if messages:
+                heapq.heappush(self.heap, (min(messages.values()), chat_id))
+            else:
+                del self.pending[chat_id]
+            due.append((chat_id, sorted(batch)))
+        if due:
+            self._mark_dirty()
+        return due
+
+    async def _delete(self, bot, chat_id, message_ids):
+        for start in range(0, len(message_ids), MAX_BATCH):
+            chunk = message_ids[start:start + MAX_BATCH]
+            self.api_calls += 1
+            try:
+                await bot.delete_messages(chat_id, chunk)
+                self.deleted += len(chunk)
+            except RetryAfter as e:
+                delay = e.retry_after
+                if isinstance(delay, datetime.timedelta):
+                    delay = delay.total_seconds()
+                # 剩余的消息稍后重试
+                self.schedule(chat_id, message_ids[start:], float(delay))
+                return
+            except TelegramError as e:
+                logging.error(f"批量删除消息失败 - Chat ID:{chat_id} - 消息ID:{chunk} - {e}")
+
+    def report(self):
+        """批量删除节省的 API 调用次数"""
+        saved = self.deleted - self.api_calls
+        return f"已删除 {self.deleted} 条消息，API 调用 {self.api_calls} 次，批量删除节省 {max(saved, 0)} 次"
+
+    async def run(self, bot):
+        """后台任务: 到期时批量删除"""
+        self.wakeup = asyncio.Event()
+        last_report_time = time.time()
+        while True:
+            due = self.pop_due()
+            if due:
+                try:
+                    await asyncio.gather(*(self._delete(bot, chat_id, message_ids) for chat_id, message_ids in due))
+                except asyncio.CancelledError:
+                    # 停止时正在删除的消息放回列表，重启后再删除一次
+                    for chat_id, message_ids in due:
+                        self.schedule(chat_id, message_ids, 0)
+                    raise
+            now = time.time()
+            # 合并一段时间内的修改，最多每 save_interval 秒写一次文件
+            if self.dirty and now - self.last_save >= self.save_interval:
+                self.save()
+                self.last_save = now
+            if now - last_report_time >= self.report_interval and self.last_report != (self.deleted, self.api_calls):
+                logging.info(self.report())
+                self.last_report = (self.deleted, self.api_calls)
+                last_report_time = now
+            waits = []
+            if self.heap:
+                waits.append(self.heap[0][0] - now)
+            if self.dirty:
+                waits.append(self.last_save + self.save_interval - now)
+            wait = max(0.0, min(waits)) if waits else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot):
+        """启动后台任务，停机期间已到期的消息会立即删除"""
+        self.task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.save()
+        logging.info(self.report())
@@ -0,0 +1,93 @@
+import time
+from collections import OrderedDict
+
+
+class PendingVerifications:
+    """待验证用户，按群分片: 群ID -> OrderedDict(用户ID -> 验证状态)
+
+    同一用户加入多个群时各群的状态互不影响。每个群内的条目按加入时间排列，
+    超过 ttl 仍未被验证检查取走的条目(任务丢失等)从头部清除；
+    群按最近加入时间排列，最新条目也已过期的群整个删除，
+    单个群超过 max_per_chat 个待验证用户时淘汰最早的条目，由调用方对被淘汰的用户执行超时处理。
+    """
+
+    def __init__(self, ttl=120, max_per_chat=1000):
+        self.ttl = ttl
+        self.max_per_chat = max_per_chat
+        # 群ID -> OrderedDict(用户ID -> 验证状态)，按最近加入时间排列
+        self.chats = OrderedDict()
+        self.size = 0
+
+    def _expire_chat(self, chat_id, shard, now):
+        while shard:
+            entry = next(iter(shard.values()))
+            if now - entry['join_time'] < self.ttl:
+                break
+            shard.popitem(last=False)
+            self.size -= 1
+        if not shard:
+            del self.chats[chat_id]
+
+    def _expire(self, now):
+        # 最久没有新成员的群在头部，最新条目过期说明整个群都已过期
+        while self.chats:
+            chat_id, shard = next(iter(self.chats.items()))
+            newest = next(reversed(shard.values()))
+            if now - newest['join_time'] < self.ttl:
+                break
+            self.size -= len(shard)
+            del self.chats[chat_id]
+
+    def add(self, chat_id, user_id, now=None):
+        """开始验证，返回 (该用户在该群的验证状态, 被淘汰的 [(用户ID, 验证状态)])
+
+        重新入群时重新开始验证。
+        """
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        shard = self.chats.get(chat_id)
+        if shard is None:
+            shard = self.chats[chat_id] = OrderedDict()
+        else:
+            self.chats.move_to_end(chat_id)
+            if shard.pop(user_id, None) is not None:
+                self.size -= 1
+        entry = shard[user_id] = {
+            'verified': False,
+            'join_time': now,
+            'messages_to_delete': []  # 存储需要删除的消息ID
+        }
+        self.size += 1
+        evicted = []
+        while len(shard) > self.max_per_chat:
+            evicted.append(shard.popitem(last=False))
+            self.size -= 1
+        return entry, evicted
+
+    def get(self, chat_id, user_id, now=None):
+        """该用户在该群的验证状态，不在验证中返回 None"""
+        shard = self.chats.get(chat_id)
+        if shard is None:
+            return None
+        self._expire_chat(chat_id, shard, time.monotonic() if now is None else now)
+        return shard.get(user_id)
+
+    def pop(self, chat_id, user_id, entry=None):
+        """取出验证状态(验证检查结束时调用)；给出 entry 时只在用户没有重新入群时取出"""
+        shard = self.chats.get(chat_id)
+        if shard is None:
+            return None
+        if entry is not None and shard.get(user_id) is not entry:
+            return None
+        entry = shard.pop(user_id, None)
+        if entry is not None:
+            self.size -= 1
+            if not shard:
+                del self.chats[chat_id]
+        return entry
+
+    def __len__(self):
+        return self.size
+
+    def chat_count(self):
+        return len(self.chats)